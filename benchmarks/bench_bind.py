@@ -0,0 +1,68 @@
+"""
+Graph binding benchmark.
+
+Binds graphs of P passthrough processes and C random connections (C = 5 P) to a GraphEngine and reports the bind
+time. Run from the repository root with:
+
+    python -m benchmarks.bench_bind [--processes 1000 10000] [--edges-per-process 5] [--repeat 3]
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import random
+import time
+from hbflow.core.engine import GraphEngine
+from hbflow.core.graph import Graph
+
+PASSTHROUGH = 'benchmarks.components.Passthrough'
+
+
+def build_graph(processes, edges, seed=0):
+    rnd = random.Random(seed)
+    graph = Graph('bind')
+    for i in range(processes):
+        graph.add_process('p%d' % i, PASSTHROUGH)
+    for i in range(edges):
+        graph.add_connection('c%d' % i, 'p%d' % rnd.randrange(processes), '_out',
+                             'p%d' % rnd.randrange(processes), '_in', 1)
+    return graph
+
+
+async def bind_time(graph, loop):
+    engine = GraphEngine(loop=loop)
+    gc.collect()
+    start = time.perf_counter()
+    await engine.bind(graph)
+    elapsed = time.perf_counter() - start
+    await engine.stop()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, nargs='+', default=[1000, 10000], help="graph sizes in processes")
+    parser.add_argument('--edges-per-process', type=int, default=5, help="connections per process")
+    parser.add_argument('--repeat', type=int, default=3, help="binds per graph size (best time is reported)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    print("%10s %10s %12s %14s" % ("processes", "edges", "bind (ms)", "us/element"))
+    for processes in args.processes:
+        edges = processes * args.edges_per_process
+        graph = build_graph(processes, edges)
+        best = None
+        for i in range(args.repeat):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            elapsed = loop.run_until_complete(bind_time(graph, loop))
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+            best = elapsed if best is None else min(best, elapsed)
+        print("%10d %10d %12.1f %14.2f" % (processes, edges, best * 1000, best * 1000000 / (processes + edges)))
+
+
+if __name__ == '__main__':
+    main()
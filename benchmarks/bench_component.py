@@ -0,0 +1,63 @@
+"""
+Component, port and connection instantiation benchmark.
+
+Reports creation time and memory per process (a component with its ports and packet loop task) and per linked
+connection. Run from the repository root with:
+
+    python -m benchmarks.bench_component [--count 10000]
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+from hbflow.core.component import Connection
+from benchmarks.components import Passthrough
+
+
+def measure(factory, count):
+    """
+    :return: (creation time in microseconds, memory in bytes) per object
+    """
+    gc.collect()
+    start = time.perf_counter()
+    objects = [factory(i) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    del objects
+    gc.collect()
+    tracemalloc.start()
+    objects = [factory(i) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return elapsed * 1000000 / count, size / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000, help="objects created per measure")
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    processes = [Passthrough('p%d' % i) for i in range(2)]
+
+    def new_connection(i):
+        cnx = Connection(capacity=1, loop=loop)
+        cnx.link(processes[0]._out, processes[1]._in)
+        return cnx
+
+    print("%-12s %16s %16s" % ("object", "creation (us)", "memory (bytes)"))
+    for label, factory in (("process", lambda i: Passthrough('p%d' % i, loop)), ("connection", new_connection)):
+        creation, memory = measure(factory, args.count)
+        print("%-12s %16.2f %16.0f" % (label, creation, memory))
+        processes[0]._out.connections.clear()
+        processes[1]._in.connections.clear()
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Fan-in throughput benchmark for InputPort.read_packet.
+
+N producers each push packets into their own connection, all linked to the same input port, while a single consumer
+reads every packet from that port. Run from the repository root with:
+
+    python -m benchmarks.bench_fanin [--packets 200000] [--capacity 1]
+"""
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+from hbflow.core.component import InputPort, OutputPort, Connection
+from hbflow.core.packet import DataPacket
+
+FAN_IN = (1, 8, 64, 512)
+
+
+async def run_fan_in(fan_in, packets, capacity):
+    port = InputPort('in', SimpleNamespace(name='sink'))
+    connections = []
+    for i in range(fan_in):
+        cnx = Connection(capacity=capacity)
+        cnx.link(OutputPort('out', SimpleNamespace(name='source_%d' % i)), port)
+        connections.append(cnx)
+    per_connection = packets // fan_in
+    packet = DataPacket()
+
+    async def producer(cnx):
+        for i in range(per_connection):
+            await cnx.put_packet(packet)
+
+    start = time.perf_counter()
+    producers = [asyncio.ensure_future(producer(cnx)) for cnx in connections]
+    for i in range(per_connection * fan_in):
+        await port.read_packet()
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*producers)
+    return per_connection * fan_in, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=200000, help="packets read per run")
+    parser.add_argument('--capacity', type=int, default=1, help="capacity of each connection")
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print("%10s %12s %12s" % ("fan-in", "packets", "packets/s"))
+    for fan_in in FAN_IN:
+        count, elapsed = loop.run_until_complete(run_fan_in(fan_in, args.packets, args.capacity))
+        print("%10d %12d %12.0f" % (fan_in, count, count / elapsed))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
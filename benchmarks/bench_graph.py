@@ -0,0 +1,252 @@
+"""
+Graph topologies benchmark.
+
+Builds graphs of synthetic components (see benchmarks.components) with GraphEngine.init_from_dictionary and measures
+bind time, start time, packets/s, p50/p99 end-to-end latency and peak RSS. Each case runs in its own Python process so
+that peak RSS is measured per case. Run from the repository root with:
+
+    python -m benchmarks.bench_graph [--packets 20000] [--capacity 16] [--cases linear-10 diamond-16]
+                                     [--output results.json] [--compare baseline.json] [--no-fusion]
+                                     [--latency-target 0.01] [--buffer-budget 1000]
+
+Results are printed as a table and, with --output, written as JSON. --compare prints the packets/s ratio of each case
+against a JSON file written by a previous run (from another commit for example). --latency-target and --buffer-budget
+enable engine flow control (see hbflow.core.flow).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import subprocess
+import sys
+import time
+from hbflow.core.engine import GraphEngine
+from hbflow.core.metrics import LatencyHistogram
+from benchmarks.components import Source, Sink
+
+SOURCE = 'benchmarks.components.Source'
+PASSTHROUGH = 'benchmarks.components.Passthrough'
+SINK = 'benchmarks.components.Sink'
+
+CHAIN_LENGTH = 10
+
+
+class Spec:
+    """
+    Graph specification builder
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.processes = dict()
+        self.connections = []
+
+    def process(self, name, component):
+        self.processes[name] = {'component': component}
+        return name
+
+    def connect(self, source, target):
+        self.connections.append({'source': {'process': source, 'port': '_out'},
+                                 'target': {'process': target, 'port': '_in'}, 'capacity': self.capacity})
+
+    def chain(self, source, target, depth, prefix):
+        previous = source
+        for i in range(depth):
+            current = self.process('%s_%d' % (prefix, i), PASSTHROUGH)
+            self.connect(previous, current)
+            previous = current
+        self.connect(previous, target)
+
+    def as_dict(self, name):
+        return {'graph': {'name': name, 'processes': self.processes, 'connections': self.connections}}
+
+
+def linear(spec, depth):
+    """
+    source -> depth passthroughs -> sink
+    """
+    spec.chain(spec.process('source', SOURCE), spec.process('sink', SINK), depth, 'pass')
+
+
+def fan_out(spec, width):
+    """
+    source -> width sinks
+    """
+    source = spec.process('source', SOURCE)
+    for i in range(width):
+        spec.connect(source, spec.process('sink_%d' % i, SINK))
+
+
+def fan_in(spec, width):
+    """
+    width sources -> sink
+    """
+    sink = spec.process('sink', SINK)
+    for i in range(width):
+        spec.connect(spec.process('source_%d' % i, SOURCE), sink)
+
+
+def diamond(spec, width):
+    """
+    source -> width parallel passthroughs -> sink
+    """
+    source = spec.process('source', SOURCE)
+    sink = spec.process('sink', SINK)
+    for i in range(width):
+        spec.chain(source, sink, 1, 'branch_%d' % i)
+
+
+def large(spec, processes):
+    """
+    Independent chains of CHAIN_LENGTH processes (source, passthroughs, sink), `processes` processes in total
+    """
+    for i in range(max(processes // CHAIN_LENGTH, 1)):
+        spec.chain(spec.process('source_%d' % i, SOURCE), spec.process('sink_%d' % i, SINK), CHAIN_LENGTH - 2,
+                   'pass_%d' % i)
+
+
+TOPOLOGIES = {
+    'linear': linear,
+    'fanout': fan_out,
+    'fanin': fan_in,
+    'diamond': diamond,
+    'large': large,
+}
+
+CASES = ('linear-1', 'linear-10', 'linear-100', 'fanout-64', 'fanin-64', 'diamond-16', 'large-10000')
+
+
+async def run_case(case, packets, capacity, loop, fusion=True, latency_target=None, buffer_budget=None):
+    topology, size = case.rsplit('-', 1)
+    spec = Spec(capacity)
+    TOPOLOGIES[topology](spec, int(size))
+
+    engine = GraphEngine(loop=loop, fusion=fusion, latency_target=latency_target, buffer_budget=buffer_budget)
+    start = time.perf_counter()
+    await engine.init_from_dictionary(spec.as_dict(case))
+    bind_time = time.perf_counter() - start
+
+    sources = [p for p in engine.processes.values() if isinstance(p, Source)]
+    sinks = [p for p in engine.processes.values() if isinstance(p, Sink)]
+    per_source = max(packets // len(sources), 1)
+    for source in sources:
+        source.count = per_source
+    for sink in sinks:
+        sink.expected = _expected_packets(spec, sink.name, per_source)
+
+    start = time.perf_counter()
+    await engine.start()
+    start_time = time.perf_counter() - start
+    await asyncio.gather(*[sink.done.wait() for sink in sinks])
+    elapsed = time.perf_counter() - start
+
+    latency = LatencyHistogram()
+    for sink in sinks:
+        latency.merge(sink.latency)
+    await engine.stop()
+    return {
+        'case': case,
+        'processes': len(spec.processes),
+        'packets': latency.count,
+        'bind_time': bind_time,
+        'start_time': start_time,
+        'packets_per_sec': latency.count / elapsed,
+        'latency_p50': latency.percentile(50),
+        'latency_p99': latency.percentile(99),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _expected_packets(spec, process, per_source):
+    """
+    Number of packets reaching a process: sources send per_source packets, other processes receive what their
+    upstream processes send (fan-out sends every packet to all connections)
+    """
+    if spec.processes[process]['component'] == SOURCE:
+        return per_source
+    return sum(_expected_packets(spec, cnx['source']['process'], per_source) for cnx in spec.connections
+               if cnx['target']['process'] == process)
+
+
+def run_isolated(case, args):
+    """
+    Run a case in a new Python process and return its result
+    """
+    command = [sys.executable, '-m', 'benchmarks.bench_graph', '--run', case, '--packets', str(args.packets),
+               '--capacity', str(args.capacity)]
+    if args.no_fusion:
+        command.append('--no-fusion')
+    if args.latency_target:
+        command.extend(['--latency-target', str(args.latency_target)])
+    if args.buffer_budget:
+        command.extend(['--buffer-budget', str(args.buffer_budget)])
+    output = subprocess.check_output(command)
+    return json.loads(output.decode())
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=20000, help="packets sent per case (split among sources)")
+    parser.add_argument('--capacity', type=int, default=16, help="capacity of each connection")
+    parser.add_argument('--cases', nargs='+', default=CASES, help="cases to run, as <topology>-<size> with topology "
+                                                                   "in %s" % ', '.join(sorted(TOPOLOGIES)))
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON results file to compare packets/s with")
+    parser.add_argument('--no-fusion', action='store_true', help="don't fuse passthrough chains")
+    parser.add_argument('--latency-target', type=float, help="engine end-to-end latency target, in seconds")
+    parser.add_argument('--buffer-budget', type=int, help="maximum number of packets buffered by the engine")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        logging.basicConfig(level=logging.ERROR)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result = loop.run_until_complete(run_case(args.run, args.packets, args.capacity, loop,
+                                                    not args.no_fusion, args.latency_target, args.buffer_budget))
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+        print(json.dumps(result))
+        return
+
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = dict((r['case'], r) for r in json.load(stream)['results'])
+    print("%-12s %9s %9s %10s %10s %12s %10s %10s %9s %8s" % ("case", "processes", "packets", "bind (s)",
+                                                              "start (s)", "packets/s", "p50 (ms)", "p99 (ms)",
+                                                              "RSS (MB)", "vs base"))
+    results = []
+    for case in args.cases:
+        result = run_isolated(case, args)
+        results.append(result)
+        ratio = ''
+        if case in baseline:
+            ratio = '%.2fx' % (result['packets_per_sec'] / baseline[case]['packets_per_sec'])
+        print("%-12s %9d %9d %10.3f %10.3f %12.0f %10.3f %10.3f %9.1f %8s" % (
+            case, result['processes'], result['packets'], result['bind_time'], result['start_time'],
+            result['packets_per_sec'], result['latency_p50'] * 1000, result['latency_p99'] * 1000,
+            result['peak_rss_mb'], ratio))
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump({'revision': git_revision(), 'python': platform.python_version(), 'packets': args.packets,
+                       'capacity': args.capacity, 'fusion': not args.no_fusion,
+                       'latency_target': args.latency_target, 'buffer_budget': args.buffer_budget,
+                       'results': results}, stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
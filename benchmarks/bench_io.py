@@ -0,0 +1,165 @@
+"""
+Throughput benchmark of the I/O components (see hbflow.components).
+
+  - file: FileReader sending the lines of a file, against a naive source sending one packet per readline()
+  - socket-source: SocketSource and FrameDecoder reading records streamed by a local server
+  - socket-sink: FileReader, FrameEncoder and SocketSink writing records to a local server
+
+Servers run on the benchmark event loop and listen on a Unix socket. Run from the repository root with:
+
+    python -m benchmarks.bench_io [--records 1000000] [--size 100] [--connections 4] [--capacity 1024]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from hbflow.core.commands import SET_CONTEXT
+from hbflow.core.engine import GraphEngine
+from hbflow.core.packet import DataPacket
+from hbflow.components import StreamSource, FRAME_HEADER
+
+FILE_READER = 'hbflow.components.FileReader'
+LINE_SOURCE = 'benchmarks.bench_io.LineSource'
+COUNTER = 'benchmarks.components.Counter'
+# Bytes written by the local server at once
+WRITE_SIZE = 1024 * 1024
+
+
+class LineSource(StreamSource):
+    """
+    Naive file source: one readline() and one send_packet() per line
+    """
+    settings = StreamSource.settings + ('path',)
+    path = None
+
+    async def read(self):
+        with open(self.path, 'rb') as stream:
+            for line in stream:
+                await self._out.send_packet(DataPacket(line.rstrip(b'\n')))
+
+
+def chain_spec(components, capacity):
+    processes = dict(('p%d' % index, {'component': component}) for index, component in enumerate(components))
+    connections = [{'capacity': capacity, 'source': {'process': 'p%d' % index, 'port': '_out'},
+                    'target': {'process': 'p%d' % (index + 1), 'port': '_in'}} for index in range(len(components) - 1)]
+    return {'processes': processes, 'connections': connections}
+
+
+async def run_chain(components, settings, capacity, done):
+    """
+    Run a chain of processes p0 -> p1 ...
+    :param settings: SET_CONTEXT arguments by process name
+    :param done: coroutine function called with the engine, returning once all records went through the chain
+    :return: elapsed time in seconds, from START to the end of done
+    """
+    engine = GraphEngine()
+    await engine.init_from_dictionary(chain_spec(components, capacity))
+    for name, values in settings.items():
+        await engine.send_command(SET_CONTEXT, values, processes=[name])
+    start = time.perf_counter()
+    await engine.start()
+    await done(engine)
+    elapsed = time.perf_counter() - start
+    await engine.stop()
+    # Let the processes tasks end before the next case
+    processes = list(engine.processes.values()) + [engine._process_manager]
+    # Packet loops are only started by processes which got packets
+    tasks = [process._packet_task for process in processes if process._packet_task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return elapsed
+
+
+def counted(process_name, expected):
+    async def done(engine):
+        counter = engine._get_process(process_name)
+        counter.expected = expected
+        await counter.done.wait()
+    return done
+
+
+async def bench_file(source, path, records, capacity):
+    return await run_chain([source, COUNTER], {'p0': {'path': path}}, capacity, counted('p1', records))
+
+
+async def bench_socket_source(data, socket_path, records, capacity):
+    async def serve(reader, writer):
+        for start in range(0, len(data), WRITE_SIZE):
+            writer.write(data[start:start + WRITE_SIZE])
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_unix_server(serve, socket_path)
+    try:
+        return await run_chain(['hbflow.components.SocketSource', 'hbflow.components.FrameDecoder', COUNTER],
+                               {'p0': {'path': socket_path}}, capacity, counted('p2', records))
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+async def bench_socket_sink(path, socket_path, expected_bytes, connections, capacity):
+    received = [0]
+    finished = asyncio.get_event_loop().create_future()
+
+    async def serve(reader, writer):
+        while True:
+            data = await reader.read(WRITE_SIZE)
+            if not data:
+                break
+            received[0] += len(data)
+            if received[0] >= expected_bytes and not finished.done():
+                finished.set_result(None)
+
+    async def done(engine):
+        await finished
+
+    server = await asyncio.start_unix_server(serve, socket_path)
+    try:
+        return await run_chain([FILE_READER, 'hbflow.components.FrameEncoder', 'hbflow.components.SocketSink'],
+                               {'p0': {'path': path}, 'p2': {'path': socket_path, 'connections': connections}},
+                               capacity, done)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=1000000, help="records (lines) per case")
+    parser.add_argument('--size', type=int, default=100, help="record size in bytes")
+    parser.add_argument('--connections', type=int, default=4, help="connections of the socket sink")
+    parser.add_argument('--capacity', type=int, default=1024, help="capacity of each connection")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    record = b'x' * (args.size - 1)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'records')
+        with open(path, 'wb') as stream:
+            for start in range(0, args.records, 10000):
+                stream.write(b''.join(record + b'\n' for i in range(min(10000, args.records - start))))
+        socket_path = os.path.join(directory, 'socket')
+        frames = (FRAME_HEADER.pack(len(record)) + record) * args.records
+        cases = [
+            ('file-naive', lambda: bench_file(LINE_SOURCE, path, args.records, args.capacity)),
+            ('file', lambda: bench_file(FILE_READER, path, args.records, args.capacity)),
+            ('socket-source', lambda: bench_socket_source(frames, socket_path, args.records, args.capacity)),
+            ('socket-sink', lambda: bench_socket_sink(path, socket_path, len(frames), args.connections,
+                                                      args.capacity)),
+        ]
+        print("%-14s %10s %10s %12s %10s" % ("case", "records", "time (s)", "records/s", "MB/s"))
+        for name, case in cases:
+            elapsed = loop.run_until_complete(case())
+            print("%-14s %10d %10.3f %12.0f %10.1f" % (name, args.records, elapsed, args.records / elapsed,
+                                                       args.records * args.size / elapsed / 1e6))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Packet allocation micro-benchmark.
+
+Compares the former packet model (uuid4 per packet, instance __dict__) with the slotted one, and with pooled
+allocation. Reports allocation rate and memory held by one million in-flight packets. Run from the repository root
+with:
+
+    python -m benchmarks.bench_packet [--packets 1000000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from uuid import uuid4
+from hbflow.core.packet import DataPacket, PacketPool
+
+
+class LegacyPacket:
+    def __init__(self):
+        self.id = uuid4()
+
+
+class LegacyDataPacket(LegacyPacket):
+    def __init__(self, payload=None):
+        super().__init__()
+        self.payload = payload
+
+
+def allocation_rate(factory, count):
+    start = time.perf_counter()
+    for i in range(count):
+        factory(i)
+    return count / (time.perf_counter() - start)
+
+
+def pooled_rate(count):
+    pool = PacketPool()
+    acquire = pool.acquire
+    release = pool.release
+    start = time.perf_counter()
+    for i in range(count):
+        release(acquire(i))
+    return count / (time.perf_counter() - start)
+
+
+def in_flight_memory(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    packets = [factory(None) for i in range(count)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del packets
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=1000000, help="number of packets to allocate")
+    args = parser.parse_args()
+    print("%-16s %14s %22s" % ("model", "packets/s", "MB per 1M in flight"))
+    for label, factory in (("legacy", LegacyDataPacket), ("slotted", DataPacket)):
+        rate = allocation_rate(factory, args.packets)
+        memory = in_flight_memory(factory, args.packets) * 1000000 / args.packets
+        print("%-16s %14.0f %22.1f" % (label, rate, memory / 2 ** 20))
+    print("%-16s %14.0f %22s" % ("slotted+pool", pooled_rate(args.packets), "-"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Priority scheduling benchmark: latency of an urgent flow while bulk flows saturate the engine.
+
+`chains` bulk sources send packets to CPU bound workers as fast as they can, while a ticker sends a packet every
+`interval` seconds to an urgent sink. The urgent latency (from the ticker timer to the sink) is measured with the
+urgent processes at the same priority as the bulk ones, then at a higher priority (see hbflow.core.scheduler). Run
+from the repository root with:
+
+    python -m benchmarks.bench_priority [--packets 20000] [--chains 4] [--work 0.00005]
+"""
+import argparse
+import asyncio
+import time
+from hbflow.core.engine import GraphEngine
+from hbflow.core.commands import START
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.packet import DataPacket
+
+URGENT_PRIORITY = 10
+
+
+class Worker(Component):
+    """
+    Spin `work` seconds per packet
+    """
+    _in = IN()
+    _out = OUT()
+
+    work = 0.00005
+
+    async def on_packet(self, from_port, packet):
+        deadline = time.perf_counter() + self.work
+        while time.perf_counter() < deadline:
+            pass
+        await self._out.send_packet(packet)
+
+
+class Ticker(Component):
+    """
+    Send a packet stamped with its emission time every `interval` seconds once the START command is received
+    """
+    _out = OUT()
+
+    interval = 0.001
+
+    def _handle_command_start(self, packet):
+        self._producer = asyncio.ensure_future(self._produce(), loop=self._loop)
+
+    async def _produce(self):
+        clock = time.perf_counter
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._out.send_packet(DataPacket(clock()))
+
+
+def priority_spec(chains, packets, urgent_priority):
+    processes = {
+        'ticker': {'component': 'benchmarks.bench_priority.Ticker', 'priority': urgent_priority},
+        'urgent': {'component': 'benchmarks.components.Sink', 'priority': urgent_priority},
+    }
+    connections = [{'source': {'process': 'ticker', 'port': '_out'}, 'target': {'process': 'urgent', 'port': '_in'},
+                    'capacity': 16}]
+    for chain in range(chains):
+        for role, component in (('source', 'Source'), ('sink', 'Sink')):
+            processes['%s_%d' % (role, chain)] = {'component': 'benchmarks.components.%s' % component}
+        processes['worker_%d' % chain] = {'component': 'benchmarks.bench_priority.Worker'}
+        connections.append({'source': {'process': 'source_%d' % chain, 'port': '_out'},
+                            'target': {'process': 'worker_%d' % chain, 'port': '_in'}, 'capacity': 1024})
+        connections.append({'source': {'process': 'worker_%d' % chain, 'port': '_out'},
+                            'target': {'process': 'sink_%d' % chain, 'port': '_in'}, 'capacity': 1024})
+    return {'processes': processes, 'connections': connections}
+
+
+async def run_case(loop, chains, packets, work, urgent_priority):
+    engine = GraphEngine(loop=loop, fusion=False)
+    await engine.init_from_dictionary(priority_spec(chains, packets, urgent_priority))
+    sinks = []
+    for chain in range(chains):
+        engine._get_process('source_%d' % chain).count = packets
+        engine._get_process('worker_%d' % chain).work = work
+        sink = engine._get_process('sink_%d' % chain)
+        sink.expected = packets
+        sinks.append(sink)
+    urgent = engine._get_process('urgent')
+    sources = ['ticker'] + ['source_%d' % chain for chain in range(chains)]
+    start = time.perf_counter()
+    await engine.send_command(START, processes=sources)
+    await asyncio.gather(*(sink.done.wait() for sink in sinks))
+    elapsed = time.perf_counter() - start
+    held = engine.scheduler.held if engine.scheduler is not None else 0
+    await engine.stop()
+    # Let the processes tasks end before the next case
+    tasks = [engine._get_process(name)._producer for name in sources]
+    processes = list(engine.processes.values()) + [engine._process_manager]
+    # Packet loops are only started by processes which got packets
+    tasks.extend(process._packet_task for process in processes if process._packet_task is not None)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return chains * packets / elapsed, urgent.latency, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=20000, help="packets sent by each bulk source")
+    parser.add_argument('--chains', type=int, default=4, help="number of bulk source -> worker -> sink chains")
+    parser.add_argument('--work', type=float, default=0.00005, help="CPU time spent by workers per packet")
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    print("%10s %12s %10s %10s %10s %10s %8s" % ("priority", "bulk pkt/s", "urgent", "p50 (ms)", "p99 (ms)",
+                                                  "max (ms)", "held"))
+    for urgent_priority in (0, URGENT_PRIORITY):
+        rate, latency, held = loop.run_until_complete(run_case(loop, args.chains, args.packets, args.work,
+                                                               urgent_priority))
+        print("%10d %12.0f %10d %10.3f %10.3f %10.3f %8d" % (urgent_priority, rate, latency.count,
+                                                             latency.percentile(50) * 1000,
+                                                             latency.percentile(99) * 1000, latency.max * 1000, held))
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Synthetic components used by graph benchmarks.
+
+Sources stamp each packet payload with its emission time (time.perf_counter), passthroughs forward packets as is and
+sinks record end-to-end latencies, so they must all run in the same OS process.
+"""
+import asyncio
+import time
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.packet import DataPacket
+from hbflow.core.metrics import LatencyHistogram
+
+
+class Source(Component):
+    """
+    Send `count` packets on _out once the START command is received
+    """
+    _out = OUT()
+
+    count = 1000
+
+    def _handle_command_start(self, packet):
+        self._producer = asyncio.ensure_future(self._produce(), loop=self._loop)
+
+    async def _produce(self):
+        send_packet = self._out.send_packet
+        clock = time.perf_counter
+        for i in range(self.count):
+            await send_packet(DataPacket(clock()))
+
+
+class Passthrough(Component):
+    _in = IN()
+    _out = OUT()
+
+    fusable = True
+
+    async def on_packet(self, from_port, packet):
+        await self._out.send_packet(packet)
+
+
+class Sink(Component):
+    """
+    Count packets and record their latency. `done` is set once `expected` packets have been received.
+    """
+    _in = IN()
+
+    expected = 0
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, loop)
+        self.received = 0
+        self.latency = LatencyHistogram()
+        self.done = asyncio.Event()
+
+    async def on_packet(self, from_port, packet):
+        self.latency.add(time.perf_counter() - packet.payload)
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+
+class Counter(Component):
+    """
+    Count packets and payload bytes, read in batches. `done` is set once `expected` packets have been received.
+    """
+    _in = IN()
+
+    expected = 0
+    batch_size = 256
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, loop)
+        self.received = 0
+        self.bytes = 0
+        self.done = asyncio.Event()
+
+    async def on_batch(self, from_port, packets):
+        self.received += len(packets)
+        self.bytes += sum(len(packet.payload) for packet in packets)
+        if self.received >= self.expected:
+            self.done.set()
@@ -0,0 +1,4 @@
+from .base import StreamComponent, StreamSource
+from .files import FileReader, MODE_LINES, MODE_CHUNKS
+from .sockets import ConnectionPool, SocketSource, SocketSink, open_stream
+from .codec import FrameEncoder, FrameDecoder, FRAME_HEADER
@@ -0,0 +1,80 @@
+import asyncio
+from hbflow.core.component import Component, OUT
+from hbflow.core.packet import DataPacket
+
+
+class StreamComponent(Component):
+    """
+    Base class of the I/O components. Their settings are class attributes listed in `settings`, which can be changed
+    for a process with the SET_CONTEXT command, whose arguments are a dict of settings values.
+    """
+    settings = ()
+
+    def _handle_command_set_context(self, packet):
+        for key, value in (packet.args or {}).items():
+            if key in self.settings:
+                setattr(self, key, value)
+            else:
+                self.logger.warning("Process '%s': unknown setting '%s' ignored" % (self.name, key))
+
+
+class StreamSource(StreamComponent):
+    """
+    Source sending on `_out` packets read from some input. Reading starts on START and stops on STOP or at the end of
+    the input, when `finished` is set. Packets are sent in batches of up to `max_batch` packets with send_batch, which
+    waits for room in the downstream connections: a source doesn't read faster than the graph handles its packets.
+    """
+    _out = OUT()
+
+    settings = ('max_batch',)
+    # Maximum number of packets sent at once
+    max_batch = 1024
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, loop)
+        self.finished = asyncio.Event()
+        # Packets and payload bytes sent
+        self.packets = 0
+        self.bytes = 0
+        self._reader = None
+
+    def _handle_command_start(self, packet):
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read(), loop=self._loop)
+
+    def _handle_command_stop(self, packet):
+        if self._reader is not None:
+            self._reader.cancel()
+
+    async def _read(self):
+        try:
+            await self.read()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.logger.exception("Process '%s': read failed" % self.name)
+        finally:
+            self.finished.set()
+
+    async def read(self):
+        """
+        Read the input until its end, sending payloads with send()
+        """
+        raise NotImplementedError
+
+    async def send(self, payloads):
+        """
+        Send bytes payloads, in batches of up to max_batch packets
+        :param payloads: list of payloads
+        """
+        max_batch = self.max_batch
+        for start in range(0, len(payloads), max_batch):
+            batch = payloads[start:start + max_batch]
+            await self._out.send_batch([DataPacket(payload) for payload in batch])
+            self.packets += len(batch)
+            self.bytes += sum(map(len, batch))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        super().close()
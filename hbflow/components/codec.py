@@ -0,0 +1,87 @@
+import struct
+from hbflow.core.component import IN, OUT, ComponentException
+from hbflow.core.packet import DataPacket
+from .base import StreamComponent
+
+# Header of framed records: length of the record which follows
+FRAME_HEADER = struct.Struct('!I')
+# Largest record accepted by decoders by default
+MAX_FRAME = 64 * 1024 * 1024
+
+
+class FrameEncoder(StreamComponent):
+    """
+    Encode bytes payloads as length prefixed records. The records of a batch are coalesced into a single packet (one
+    packet per record if `coalesce` is false), so that a socket sink writes them at once.
+    """
+    _in = IN()
+    _out = OUT()
+
+    settings = ('coalesce',)
+    coalesce = True
+    batch_size = 256
+
+    async def on_packet(self, from_port, packet):
+        await self.on_batch(from_port, [packet])
+
+    async def on_batch(self, from_port, packets):
+        pack = FRAME_HEADER.pack
+        if self.coalesce:
+            parts = []
+            for packet in packets:
+                parts.append(pack(len(packet.payload)))
+                parts.append(packet.payload)
+            await self._out.send_packet(DataPacket(b''.join(parts)))
+        else:
+            await self._out.send_batch([DataPacket(pack(len(packet.payload)) + packet.payload) for packet in packets])
+
+
+class FrameDecoder(StreamComponent):
+    """
+    Decode records encoded by FrameEncoder from a byte stream: payloads of successive packets, as sent by
+    SocketSource, records may span several packets. Records decoded from a batch of packets are sent as a batch.
+    The stream must come from a single connection.
+    """
+    _in = IN()
+    _out = OUT()
+
+    settings = ('max_frame',)
+    max_frame = MAX_FRAME
+    batch_size = 16
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, loop)
+        self._buffer = bytearray()
+
+    async def on_packet(self, from_port, packet):
+        await self.on_batch(from_port, [packet])
+
+    async def on_batch(self, from_port, packets):
+        buffer = self._buffer
+        for packet in packets:
+            buffer += packet.payload
+        header = FRAME_HEADER.size
+        size = len(buffer)
+        records = []
+        invalid = None
+        offset = 0
+        with memoryview(buffer) as view:
+            while size - offset >= header:
+                length = FRAME_HEADER.unpack_from(view, offset)[0]
+                if length > self.max_frame:
+                    invalid = length
+                    break
+                end = offset + header + length
+                if end > size:
+                    break
+                records.append(DataPacket(bytes(view[offset + header:end])))
+                offset = end
+        if invalid is None:
+            del buffer[:offset]
+        else:
+            # The stream can't be synchronized again
+            buffer.clear()
+        if records:
+            await self._out.send_batch(records)
+        if invalid is not None:
+            raise ComponentException("Process '%s': invalid frame of %d bytes" % (self.name, invalid))
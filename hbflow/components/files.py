@@ -0,0 +1,56 @@
+import mmap
+import os
+from hbflow.core.component import ComponentException
+from .base import StreamSource
+
+# FileReader modes: one packet per line, or per chunk of `chunk_size` bytes
+MODE_LINES = 'lines'
+MODE_CHUNKS = 'chunks'
+# Bytes of a file split into lines at once
+READ_SIZE = 1024 * 1024
+
+
+class FileReader(StreamSource):
+    """
+    Send the content of the file at `path` as bytes payloads: one packet per line, without its end of line
+    (MODE_LINES), or per chunk of `chunk_size` bytes (MODE_CHUNKS).
+    The file is memory mapped: lines are split by blocks of READ_SIZE bytes, without a read call nor a Python loop
+    iteration per line.
+    """
+    settings = StreamSource.settings + ('path', 'mode', 'chunk_size')
+    path = None
+    mode = MODE_LINES
+    chunk_size = 64 * 1024
+
+    async def read(self):
+        if self.mode not in (MODE_LINES, MODE_CHUNKS):
+            raise ComponentException("Invalid file reader mode '%s'" % self.mode)
+        with open(self.path, 'rb') as stream:
+            size = os.fstat(stream.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if self.mode == MODE_LINES:
+                    await self._read_lines(data, size)
+                else:
+                    await self._read_chunks(data, size)
+
+    async def _read_lines(self, data, size):
+        start = 0
+        while start < size:
+            # Blocks end after the last end of line they hold, or after the end of a line longer than READ_SIZE
+            end = data.rfind(b'\n', start, start + READ_SIZE) + 1
+            if end <= start:
+                end = data.find(b'\n', start + READ_SIZE) + 1 or size
+            lines = data[start:end].split(b'\n')
+            if not lines[-1]:
+                lines.pop()
+            await self.send(lines)
+            start = end
+
+    async def _read_chunks(self, data, size):
+        chunk_size = self.chunk_size
+        step = chunk_size * self.max_batch
+        for start in range(0, size, step):
+            end = min(start + step, size)
+            await self.send([data[offset:min(offset + chunk_size, end)] for offset in range(start, end, chunk_size)])
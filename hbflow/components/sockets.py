@@ -0,0 +1,173 @@
+import asyncio
+from collections import deque
+from hbflow.core.component import IN
+from .base import StreamComponent, StreamSource
+
+# Bytes read from a socket at once
+READ_SIZE = 256 * 1024
+# Bytes buffered by a socket writer before writers wait for the socket to drain
+WRITE_BUFFER = 1024 * 1024
+
+
+async def open_stream(host=None, port=None, path=None):
+    """
+    Open a stream connection to a Unix socket (path) or TCP (host, port) server
+    :return: (StreamReader, StreamWriter)
+    """
+    if path:
+        return await asyncio.open_unix_connection(path, limit=READ_SIZE)
+    return await asyncio.open_connection(host, port, limit=READ_SIZE)
+
+
+class ConnectionPool:
+    """
+    Pool of stream connections to a TCP or Unix socket server. Connections are opened on demand, up to `size`, and
+    given back to the pool after use. A connection given back as broken is closed, and replaced on demand.
+    """
+    def __init__(self, host=None, port=None, path=None, size=1, write_buffer=WRITE_BUFFER, loop=None):
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.path = path
+        self.size = size
+        self.write_buffer = write_buffer
+        self._opened = 0
+        self._idle = deque()
+        self._waiters = deque()
+        self._writers = set()
+
+    async def acquire(self):
+        """
+        Get an idle connection, opening it if the pool is not full, waiting for one otherwise
+        :return: (StreamReader, StreamWriter)
+        """
+        while True:
+            if self._idle:
+                return self._idle.popleft()
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    reader, writer = await open_stream(self.host, self.port, self.path)
+                except BaseException:
+                    self._opened -= 1
+                    raise
+                writer.transport.set_write_buffer_limits(self.write_buffer)
+                self._writers.add(writer)
+                return reader, writer
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def release(self, connection, broken=False):
+        """
+        Give a connection back to the pool
+        :param connection: (StreamReader, StreamWriter) returned by acquire()
+        :param broken: close the connection instead of keeping it
+        """
+        if broken:
+            writer = connection[1]
+            self._writers.discard(writer)
+            writer.close()
+            self._opened -= 1
+        else:
+            self._idle.append(connection)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def close(self):
+        for writer in self._writers:
+            writer.close()
+        self._writers.clear()
+        self._idle.clear()
+        self._opened = 0
+
+
+class SocketSource(StreamSource):
+    """
+    Connect to a Unix socket (path) or TCP (host, port) server and send the bytes it streams, in packets of up to
+    `read_size` bytes, until the server closes the connection. Records framed in the stream are decoded by a
+    FrameDecoder downstream.
+    """
+    settings = StreamSource.settings + ('host', 'port', 'path', 'read_size')
+    host = 'localhost'
+    port = None
+    path = None
+    read_size = READ_SIZE
+
+    async def read(self):
+        reader, writer = await open_stream(self.host, self.port, self.path)
+        try:
+            while True:
+                data = await reader.read(self.read_size)
+                if not data:
+                    break
+                await self.send([data])
+        finally:
+            writer.close()
+
+
+class SocketSink(StreamComponent):
+    """
+    Write bytes payloads to a Unix socket (path) or TCP (host, port) server. The payloads of a batch are coalesced
+    into a single write, which waits for the socket to drain once `WRITE_BUFFER` bytes are buffered: input packets are
+    read no faster than the server takes them.
+    Batches are written on a pool of `connections` connections (`concurrency` connections by default): with a
+    concurrency above 1, batches are written in parallel on different connections, in no particular order.
+    """
+    _in = IN(ordered=False)
+
+    settings = ('host', 'port', 'path', 'connections')
+    host = 'localhost'
+    port = None
+    path = None
+    connections = None
+    batch_size = 256
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, loop)
+        # Packets and bytes written
+        self.packets = 0
+        self.bytes = 0
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ConnectionPool(self.host, self.port, self.path, self.connections or self.concurrency,
+                                        loop=self._loop)
+        return self._pool
+
+    async def on_packet(self, from_port, packet):
+        await self.on_batch(from_port, [packet])
+
+    async def on_batch(self, from_port, packets):
+        data = b''.join(packet.payload for packet in packets)
+        pool = self.pool
+        connection = await pool.acquire()
+        # A failed or cancelled write may leave a partial frame in the socket: the connection is closed, not reused
+        broken = True
+        try:
+            connection[1].write(data)
+            await connection[1].drain()
+            broken = False
+        finally:
+            pool.release(connection, broken=broken)
+        self.packets += len(packets)
+        self.bytes += len(data)
+
+    def _handle_command_stop(self, packet):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        super().close()
@@ -0,0 +1,616 @@
+import asyncio
+import heapq
+import itertools
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from collections import deque
+from .packet import DataPacket, DEFAULT_PRIORITY
+
+DEFAULT_CAPACITY = 1
+DEFAULT_POLICY = 'blocking'
+# Size of the files spill buffers write overflowing packets to
+SPILL_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class BufferException(Exception):
+    pass
+
+
+class PacketBuffer:
+    """
+    Bounded FIFO packet buffer used by connections ('blocking' policy): putting a packet waits while the buffer is full.
+    Capacity is counted in packets, whatever the way they are put (one by one or in batches). A capacity of 0 or None
+    means an unbounded buffer. `delivered` counts packets taken out of the buffer, it is used to measure the consumer
+    throughput (see hbflow.core.flow).
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, loop=None):
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.capacity = capacity
+        self.dropped = 0
+        self.delivered = 0
+        self._packets = deque()
+        self._putters = deque()
+        self._getters = deque()
+
+    def __len__(self):
+        return len(self._packets)
+
+    def __iter__(self):
+        return iter(self._packets)
+
+    def qsize(self):
+        return len(self._packets)
+
+    def empty(self):
+        return not self._packets
+
+    def full(self):
+        return bool(self.capacity) and len(self._packets) >= self.capacity
+
+    def free(self):
+        """
+        :return: number of packets which can be put without waiting (None if unbounded)
+        """
+        if not self.capacity:
+            return None
+        return max(self.capacity - len(self._packets), 0)
+
+    def set_capacity(self, capacity):
+        """
+        Change the buffer capacity. When reduced below the number of packets held, packets are kept and putters wait
+        until enough of them are taken out.
+        :param capacity: new capacity in packets (0 or None for an unbounded buffer)
+        """
+        self.capacity = capacity
+        free = self.free()
+        self._wakeup(self._putters, len(self._putters) if free is None else free)
+
+    @staticmethod
+    def _wakeup(waiters, count=1):
+        while waiters and count > 0:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                count -= 1
+
+    async def _wait(self, waiters):
+        waiter = self._loop.create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            waiter.cancel()
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not waiter.cancelled():
+                # Woken up but cancelled: let another waiter take the opportunity
+                self._wakeup(waiters)
+            raise
+
+    async def wait_free(self):
+        """
+        Wait until at least one packet can be put in the buffer
+        """
+        while self.full():
+            await self._wait(self._putters)
+
+    async def wait_empty(self):
+        """
+        Wait until all the packets held have been taken out. The wait is woken up by the getter side, like putters
+        are: each wakeup is passed on to the next putter so that putters don't miss it.
+        """
+        while len(self):
+            await self._wait(self._putters)
+            self._wakeup(self._putters)
+
+    def put_nowait(self, packet):
+        if self.full():
+            raise asyncio.QueueFull()
+        self._packets.append(packet)
+        self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        """
+        Put as many packets as possible from packets[start:] without waiting.
+        :return: number of packets put
+        """
+        free = self.free()
+        end = len(packets) if free is None else min(len(packets), start + free)
+        if end <= start:
+            return 0
+        self._packets.extend(packets[start:end])
+        self._wakeup(self._getters, end - start)
+        return end - start
+
+    async def put(self, packet):
+        while self.full():
+            await self._wait(self._putters)
+        self.put_nowait(packet)
+
+    def get_nowait(self):
+        if not self._packets:
+            raise asyncio.QueueEmpty()
+        packet = self._packets.popleft()
+        self.delivered += 1
+        self._wakeup(self._putters)
+        return packet
+
+    def load(self, packets):
+        """
+        Append packets whatever the buffer capacity (see Connection.load_packets)
+        """
+        self._packets.extend(packets)
+        self._wakeup(self._getters)
+
+    def close(self):
+        """
+        Release resources held by the buffer
+        """
+        pass
+
+    def get_many_nowait(self, max_items):
+        """
+        Get up to max_items packets without waiting.
+        :return: list of packets (possibly empty)
+        """
+        packets = self._packets
+        count = min(max_items, len(packets))
+        if count == len(packets):
+            batch = list(packets)
+            packets.clear()
+        else:
+            popleft = packets.popleft
+            batch = [popleft() for i in range(count)]
+        self.delivered += count
+        self._wakeup(self._putters, count)
+        return batch
+
+    async def get(self):
+        while not self._packets:
+            await self._wait(self._getters)
+        return self.get_nowait()
+
+
+class UnboundedBuffer(PacketBuffer):
+    """
+    FIFO buffer without capacity limit ('unbounded' policy): putting a packet never waits
+    """
+    def __init__(self, capacity=None, loop=None):
+        super().__init__(None, loop)
+
+    def set_capacity(self, capacity):
+        raise BufferException("Unbounded buffers have no capacity")
+
+
+class DropOldestBuffer(PacketBuffer):
+    """
+    Ring buffer ('drop_oldest' policy): when full, the oldest packet is discarded to make room for the new one
+    """
+    def full(self):
+        return False
+
+    def free(self):
+        return None
+
+    def set_capacity(self, capacity):
+        if not capacity:
+            raise BufferException("Buffer policy 'drop_oldest' requires a capacity")
+        self.capacity = capacity
+        while len(self._packets) > capacity:
+            self._packets.popleft()
+            self.dropped += 1
+
+    def put_nowait(self, packet):
+        if len(self._packets) >= self.capacity:
+            self._packets.popleft()
+            self.dropped += 1
+        self._packets.append(packet)
+        self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        count = len(packets) - start
+        if count <= 0:
+            return 0
+        overflow = len(self._packets) + count - self.capacity
+        if overflow > 0:
+            self.dropped += overflow
+            if overflow >= len(self._packets):
+                # The new packets alone fill the ring
+                self._packets.clear()
+                start = len(packets) - self.capacity
+            else:
+                for i in range(overflow):
+                    self._packets.popleft()
+        self._packets.extend(packets[start:])
+        self._wakeup(self._getters, count)
+        return count
+
+
+class DropNewestBuffer(PacketBuffer):
+    """
+    Bounded buffer ('drop_newest' policy): when full, incoming packets are discarded
+    """
+    def full(self):
+        return False
+
+    def free(self):
+        return None
+
+    def set_capacity(self, capacity):
+        if not capacity:
+            raise BufferException("Buffer policy 'drop_newest' requires a capacity")
+        self.capacity = capacity
+
+    def put_nowait(self, packet):
+        if len(self._packets) >= self.capacity:
+            self.dropped += 1
+            return
+        self._packets.append(packet)
+        self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        count = len(packets) - start
+        if count <= 0:
+            return 0
+        accepted = min(count, max(self.capacity - len(self._packets), 0))
+        self.dropped += count - accepted
+        if accepted:
+            self._packets.extend(packets[start:start + accepted])
+            self._wakeup(self._getters, accepted)
+        return count
+
+
+class LatestValueBuffer(PacketBuffer):
+    """
+    Coalescing buffer ('latest' policy): holds only the most recent packet, which replaces any packet not read yet
+    """
+    def __init__(self, capacity=1, loop=None):
+        super().__init__(1, loop)
+
+    def set_capacity(self, capacity):
+        raise BufferException("Buffer policy 'latest' holds a single packet")
+
+    def full(self):
+        return False
+
+    def free(self):
+        return None
+
+    def put_nowait(self, packet):
+        if self._packets:
+            self._packets[0] = packet
+            self.dropped += 1
+        else:
+            self._packets.append(packet)
+            self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        count = len(packets) - start
+        if count <= 0:
+            return 0
+        self.put_nowait(packets[-1])
+        self.dropped += count - 1
+        return count
+
+
+class PriorityBuffer(PacketBuffer):
+    """
+    Bounded buffer delivering packets by priority ('priority' policy): packets with the highest priority (see
+    Packet.priority) are taken first, packets of the same priority in the order they were put. Packets are held in a
+    binary heap, so putting or taking a packet is O(log n). Like the 'blocking' policy, putting a packet waits while
+    the buffer is full.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, loop=None):
+        super().__init__(capacity, loop)
+        # Heap of (-priority, put order, packet)
+        self._packets = []
+        self._order = itertools.count()
+
+    def __iter__(self):
+        return (entry[2] for entry in sorted(self._packets))
+
+    def _push(self, packets):
+        heap = self._packets
+        order = self._order
+        for packet in packets:
+            heapq.heappush(heap, (-packet.priority, next(order), packet))
+
+    def put_nowait(self, packet):
+        if self.full():
+            raise asyncio.QueueFull()
+        heapq.heappush(self._packets, (-packet.priority, next(self._order), packet))
+        self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        free = self.free()
+        end = len(packets) if free is None else min(len(packets), start + free)
+        if end <= start:
+            return 0
+        self._push(packets[start:end])
+        self._wakeup(self._getters, end - start)
+        return end - start
+
+    def load(self, packets):
+        self._push(packets)
+        self._wakeup(self._getters)
+
+    def get_nowait(self):
+        if not self._packets:
+            raise asyncio.QueueEmpty()
+        packet = heapq.heappop(self._packets)[2]
+        self.delivered += 1
+        self._wakeup(self._putters)
+        return packet
+
+    def get_many_nowait(self, max_items):
+        heap = self._packets
+        count = min(max_items, len(heap))
+        batch = [heapq.heappop(heap)[2] for i in range(count)]
+        self.delivered += count
+        self._wakeup(self._putters, count)
+        return batch
+
+
+# Spilled packet frame header: body length, body kind and packet sequence number
+_FRAME = struct.Struct('!IBQ')
+# Frame bodies: pickled DataPacket payload, raw bytes DataPacket payload, or any other pickled packet (including data
+# packets with a priority or a deadline)
+_FRAME_DATA = 0
+_FRAME_BYTES = 1
+_FRAME_PACKET = 2
+
+
+def _encode_frame(packet):
+    """
+    :return: (kind, sequence number, body) of the frame holding a packet
+    """
+    if type(packet) is DataPacket and packet.priority == DEFAULT_PRIORITY and packet.deadline is None:
+        if type(packet.payload) is bytes:
+            return _FRAME_BYTES, packet.seq, packet.payload
+        return _FRAME_DATA, packet.seq, pickle.dumps(packet.payload, pickle.HIGHEST_PROTOCOL)
+    return _FRAME_PACKET, 0, pickle.dumps(packet, pickle.HIGHEST_PROTOCOL)
+
+
+def _decode_frame(kind, seq, body):
+    if kind == _FRAME_PACKET:
+        return pickle.loads(body)
+    packet = DataPacket(body if kind == _FRAME_BYTES else pickle.loads(body))
+    packet.seq = seq
+    return packet
+
+
+class _Segment:
+    """
+    Memory mapped spill file. Packets frames are appended up to `end`. The file is removed as soon as it is mapped, so
+    the disk space is released when the segment is closed, whatever the way the process ends.
+    """
+    __slots__ = ('map', 'size', 'end')
+
+    def __init__(self, size, directory=None):
+        fd, path = tempfile.mkstemp(prefix='hbflow-spill-', dir=directory)
+        try:
+            os.unlink(path)
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.end = 0
+
+    def release(self):
+        """
+        Unmap the segment pages from the process memory, the segment content is kept in the file
+        """
+        self.map.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        self.map.close()
+
+
+class SpillBuffer(PacketBuffer):
+    """
+    Buffer spilling to disk ('spill' policy): up to `capacity` packets are held in memory, overflowing packets are
+    appended to memory mapped segment files and read back, in order, as the in-memory head is consumed. Putting a
+    packet never waits, unless `max_spill` bytes are already spilled.
+    While packets are spilled, new packets are spilled too, so that order is kept: the head always holds the oldest
+    packets. Fully read segments are recycled (one of them is kept for reuse) or closed. Spilled packets are lost when
+    the process ends, spill files don't outlive the buffer.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, loop=None, directory=None, segment_size=SPILL_SEGMENT_SIZE,
+                 max_spill=None):
+        """
+        :param capacity: number of packets held in memory
+        :param directory: directory of the spill files (default temporary directory if None)
+        :param segment_size: spill files size in bytes
+        :param max_spill: maximum number of bytes spilled (no limit if None)
+        """
+        super().__init__(capacity, loop)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_spill = max_spill
+        self.spilled = 0
+        self.spilled_bytes = 0
+        self._segments = deque()
+        self._read_offset = 0
+        self._spare = None
+
+    def __len__(self):
+        return len(self._packets) + self.spilled
+
+    def __iter__(self):
+        yield from self._packets
+        offset = self._read_offset
+        for segment in list(self._segments):
+            while offset < segment.end:
+                length, kind, seq = _FRAME.unpack_from(segment.map, offset)
+                start = offset + _FRAME.size
+                yield _decode_frame(kind, seq, segment.map[start:start + length])
+                offset = start + length
+            offset = 0
+
+    def qsize(self):
+        return len(self)
+
+    def full(self):
+        return self.max_spill is not None and self.spilled_bytes >= self.max_spill
+
+    def free(self):
+        return 0 if self.full() else None
+
+    def set_capacity(self, capacity):
+        if not capacity:
+            raise BufferException("Buffer policy 'spill' requires a capacity")
+        self.capacity = capacity
+        self._unspill()
+
+    def _spill(self, packet):
+        kind, seq, body = _encode_frame(packet)
+        size = _FRAME.size + len(body)
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.end + size > segment.size:
+            if segment is not None and len(self._segments) > 1:
+                # Full segment, read later: its pages are left to the page cache
+                segment.release()
+            segment = self._new_segment(size)
+            self._segments.append(segment)
+        _FRAME.pack_into(segment.map, segment.end, len(body), kind, seq)
+        segment.map[segment.end + _FRAME.size:segment.end + size] = body
+        segment.end += size
+        self.spilled += 1
+        self.spilled_bytes += size
+
+    def _new_segment(self, size):
+        spare = self._spare
+        if spare is not None and size <= spare.size:
+            self._spare = None
+            return spare
+        return _Segment(max(self.segment_size, size), self.directory)
+
+    def _unspill(self):
+        """
+        Move spilled packets to the in-memory head while it has room
+        """
+        packets = self._packets
+        while self.spilled and len(packets) < self.capacity:
+            segment = self._segments[0]
+            offset = self._read_offset
+            length, kind, seq = _FRAME.unpack_from(segment.map, offset)
+            start = offset + _FRAME.size
+            packets.append(_decode_frame(kind, seq, segment.map[start:start + length]))
+            self._read_offset = start + length
+            self.spilled -= 1
+            self.spilled_bytes -= _FRAME.size + length
+            if self._read_offset == segment.end:
+                self._read_offset = 0
+                if len(self._segments) > 1:
+                    self._recycle(self._segments.popleft())
+                else:
+                    # Last segment read: written again from its start
+                    segment.end = 0
+
+    def _recycle(self, segment):
+        if self._spare is None and segment.size == self.segment_size:
+            segment.release()
+            segment.end = 0
+            self._spare = segment
+        else:
+            segment.close()
+
+    def put_nowait(self, packet):
+        if self.spilled or len(self._packets) >= self.capacity:
+            if self.full():
+                raise asyncio.QueueFull()
+            self._spill(packet)
+        else:
+            self._packets.append(packet)
+        self._wakeup(self._getters)
+
+    def load(self, packets):
+        for packet in packets:
+            if self.spilled or len(self._packets) >= self.capacity:
+                self._spill(packet)
+            else:
+                self._packets.append(packet)
+        self._wakeup(self._getters)
+
+    def put_many_nowait(self, packets, start=0):
+        count = 0
+        for index in range(start, len(packets)):
+            if self.full():
+                break
+            self.put_nowait(packets[index])
+            count += 1
+        return count
+
+    def get_nowait(self):
+        packet = super().get_nowait()
+        if self.spilled:
+            self._unspill()
+        return packet
+
+    def get_many_nowait(self, max_items):
+        batch = super().get_many_nowait(max_items)
+        while self.spilled and len(batch) < max_items:
+            self._unspill()
+            batch.extend(super().get_many_nowait(max_items - len(batch)))
+        if self.spilled:
+            self._unspill()
+        return batch
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments.clear()
+        if self._spare is not None:
+            self._spare.close()
+            self._spare = None
+        self._packets.clear()
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+
+BUFFER_POLICIES = {
+    'blocking': PacketBuffer,
+    'unbounded': UnboundedBuffer,
+    'drop_oldest': DropOldestBuffer,
+    'drop_newest': DropNewestBuffer,
+    'latest': LatestValueBuffer,
+    'spill': SpillBuffer,
+    'priority': PriorityBuffer,
+}
+# Options accepted by buffer policies, by policy name (see new_buffer)
+BUFFER_OPTIONS = {
+    'spill': ('directory', 'segment_size', 'max_spill'),
+}
+
+
+def new_buffer(policy=None, capacity=DEFAULT_CAPACITY, loop=None, options=None):
+    """
+    Create a packet buffer
+    :param policy: buffer policy name (see BUFFER_POLICIES), defaults to DEFAULT_POLICY
+    :param capacity: buffer capacity in packets
+    :param loop: event loop used by the buffer
+    :param options: dict of policy options (see BUFFER_OPTIONS)
+    :return: the buffer instance
+    """
+    try:
+        buffer_class = BUFFER_POLICIES[policy or DEFAULT_POLICY]
+    except KeyError:
+        raise BufferException("Unknown buffer policy '%s'" % policy)
+    if buffer_class in (DropOldestBuffer, DropNewestBuffer, SpillBuffer) and not capacity:
+        raise BufferException("Buffer policy '%s' requires a capacity" % policy)
+    if options:
+        unknown = set(options).difference(BUFFER_OPTIONS.get(policy or DEFAULT_POLICY, ()))
+        if unknown:
+            raise BufferException("Buffer policy '%s' has no option %s" %
+                                  (policy or DEFAULT_POLICY, ', '.join("'%s'" % name for name in sorted(unknown))))
+        return buffer_class(capacity, loop, **options)
+    return buffer_class(capacity, loop)
@@ -0,0 +1,516 @@
+import asyncio
+import os
+import pickle
+import struct
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+from .component import Connection
+from .packet import DataPacket, DEFAULT_PRIORITY
+
+# Frame header: payload length, compatible with multiprocessing.Connection.send_bytes()
+_HEADER = struct.Struct('!i')
+_READ_SIZE = 65536
+# Amount of encoded data a writer may hold before put_packet waits for the pipe to drain
+_WRITE_HIGH_WATER = 65536
+
+
+def encode_packet(packet):
+    data = pickle.dumps(packet, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+
+def decode_packets(data):
+    """
+    Decode all complete frames from a buffer.
+    :param data: bytearray holding received data. Decoded frames are removed from it.
+    :return: list of packets decoded
+    """
+    packets = []
+    offset = 0
+    size = len(data)
+    while size - offset >= _HEADER.size:
+        length, = _HEADER.unpack_from(data, offset)
+        end = offset + _HEADER.size + length
+        if end > size:
+            break
+        packets.append(pickle.loads(data[offset + _HEADER.size:end]))
+        offset = end
+    if offset:
+        del data[:offset]
+    return packets
+
+
+def wait_fd(loop, fd, add, remove):
+    """
+    Wait for a file descriptor to be ready.
+    :param add: loop method registering the descriptor (add_reader or add_writer)
+    :param remove: loop method unregistering the descriptor (remove_reader or remove_writer)
+    :return: future done when the descriptor is ready
+    """
+    waiter = loop.create_future()
+
+    def ready():
+        remove(fd)
+        if not waiter.done():
+            waiter.set_result(None)
+    add(fd, ready)
+    waiter.add_done_callback(lambda f: remove(fd) if f.cancelled() else None)
+    return waiter
+
+
+class PipeWriterConnection(Connection):
+    """
+    Sending end of a connection crossing a process boundary.
+    Packets are pickled and written to a pipe. Data the pipe can't take immediately is kept in an outgoing buffer which
+    is written in background as soon as the pipe is writable. Backpressure comes from the pipe itself and, on the other
+    side, from the receiving connection capacity. The depth of the connection is the number of packets still in the
+    outgoing buffer: packets written to the pipe are not seen anymore.
+    """
+    def __init__(self, fd, name=None, capacity=1, loop=None):
+        super().__init__(name, capacity, loop=loop)
+        self._fd = fd
+        os.set_blocking(fd, False)
+        self._outgoing = bytearray()
+        # Sizes of the frames in the outgoing buffer, and bytes of the first one already written
+        self._frames = deque()
+        self._sent = 0
+        self._writing = False
+        self._drain_waiters = []
+
+    def _queue(self, packet):
+        frame = encode_packet(packet)
+        self._outgoing += frame
+        self._frames.append(len(frame))
+
+    def _write(self):
+        try:
+            while self._outgoing:
+                written = os.write(self._fd, self._outgoing)
+                del self._outgoing[:written]
+                self._sent += written
+        except BlockingIOError:
+            pass
+        frames = self._frames
+        while frames and frames[0] <= self._sent:
+            self._sent -= frames.popleft()
+        if self._outgoing and not self._writing:
+            self._loop.add_writer(self._fd, self._on_writable)
+            self._writing = True
+
+    def _on_writable(self):
+        self._write()
+        if not self._outgoing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _drain(self, high_water):
+        self._write()
+        while len(self._outgoing) > high_water:
+            waiter = self._loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    async def put_packet(self, packet):
+        self._queue(packet)
+        await self._drain(_WRITE_HIGH_WATER)
+
+    async def put_batch(self, packets):
+        for packet in packets:
+            self._queue(packet)
+        await self._drain(_WRITE_HIGH_WATER)
+
+    def put_packet_nowait(self, packet):
+        if len(self._outgoing) > _WRITE_HIGH_WATER:
+            return False
+        self._queue(packet)
+        self._write()
+        return True
+
+    def depth(self):
+        return len(self._frames)
+
+    def put_batch_nowait(self, packets):
+        count = 0
+        for packet in packets:
+            if not self.put_packet_nowait(packet):
+                break
+            count += 1
+        return count
+
+    async def flush(self):
+        await self._drain(0)
+
+    def close(self):
+        if self._writing:
+            self._loop.remove_writer(self._fd)
+        os.close(self._fd)
+
+
+class PipeReaderConnection(Connection):
+    """
+    Receiving end of a connection crossing a process boundary.
+    A pump task reads frames from the pipe and puts decoded packets in the connection buffer, waiting for free room
+    before reading more.
+    """
+    def __init__(self, fd, name=None, capacity=1, buffer=None, loop=None, buffer_options=None):
+        super().__init__(name, capacity, loop=loop, buffer=buffer, buffer_options=buffer_options)
+        self._fd = fd
+        os.set_blocking(fd, False)
+        self._pump_task = asyncio.ensure_future(self._pump(), loop=self._loop)
+
+    async def _pump(self):
+        data = bytearray()
+        while True:
+            try:
+                chunk = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                await wait_fd(self._loop, self._fd, self._loop.add_reader, self._loop.remove_reader)
+                continue
+            if not chunk:
+                self.logger.debug("Connection '%s': remote end closed" % self.name)
+                break
+            data += chunk
+            packets = decode_packets(data)
+            if packets:
+                await self.put_batch(packets)
+
+    def close(self):
+        self._pump_task.cancel()
+        os.close(self._fd)
+
+
+class PipeChannel:
+    """
+    Transport of a connection between two processes of a graph running in different OS processes.
+    The channel is created by the engine before worker processes are started and passed to them. Each side then opens
+    its end of the channel as a Connection.
+    """
+    def __init__(self, context, capacity=None):
+        self._reader, self._writer = context.Pipe(duplex=False)
+
+    def open_writer(self, name, capacity, buffer=None, loop=None):
+        return PipeWriterConnection(os.dup(self._writer.fileno()), name, capacity, loop)
+
+    def open_reader(self, name, capacity, buffer=None, loop=None, buffer_options=None):
+        return PipeReaderConnection(os.dup(self._reader.fileno()), name, capacity, buffer, loop, buffer_options)
+
+    def close(self):
+        """
+        Release the channel ends held by this process. Ends already opened are kept open.
+        """
+        self._reader.close()
+        self._writer.close()
+
+
+class ChannelException(Exception):
+    pass
+
+
+# Shared memory slot header: payload length and kind
+_SLOT_HEADER = struct.Struct('!IB')
+# Slot holds raw payload bytes, delivered as a memoryview
+_SLOT_RAW = 0
+# Slot holds a pickled packet
+_SLOT_PICKLED = 1
+DEFAULT_SLOT_SIZE = 65536
+# Buffer policies a shared memory reader can use: slots are given back in the order they are read, so the buffer must
+# deliver every packet in FIFO order
+SHM_BUFFER_POLICIES = ('blocking', 'unbounded')
+
+
+def _send_credits(fd, count):
+    os.write(fd, b'\x00' * count)
+
+
+def _attach_shm(name, owner):
+    """
+    Map a shared memory segment. Only the owner process registers it for unlinking by the resource tracker.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    if not owner:
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+    return shm
+
+
+class ShmWriterConnection(Connection):
+    """
+    Sending end of a shared memory channel.
+    Each packet is written once in the next slot of a ring of `capacity` slots, then announced to the reader with a
+    one byte doorbell. Buffer payloads (bytes, bytearray, memoryview, numpy arrays...) are copied as raw bytes; other
+    packets are pickled. A slot can't be reused before the reader gives it back as a credit. The depth of the
+    connection is the number of slots not given back yet.
+    """
+    def __init__(self, shm, slot_size, doorbell_fd, credit_fd, name=None, capacity=1, loop=None):
+        super().__init__(name, capacity, loop=loop)
+        self._shm = shm
+        self._slot_size = slot_size
+        self._doorbell_fd = doorbell_fd
+        self._credit_fd = credit_fd
+        os.set_blocking(credit_fd, False)
+        self._credits = capacity
+        self._index = 0
+        self._credit_waiters = []
+        self._loop.add_reader(credit_fd, self._on_credits)
+
+    def _on_credits(self):
+        try:
+            data = os.read(self._credit_fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self._loop.remove_reader(self._credit_fd)
+            return
+        self._credits += len(data)
+        waiters, self._credit_waiters = self._credit_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def depth(self):
+        return self.capacity - self._credits
+
+    async def _wait_credit(self):
+        while not self._credits:
+            waiter = self._loop.create_future()
+            self._credit_waiters.append(waiter)
+            await waiter
+
+    def _write_slot(self, packet):
+        data = None
+        if (type(packet) is DataPacket and packet.payload is not None and packet.priority == DEFAULT_PRIORITY and
+                packet.deadline is None):
+            try:
+                data = memoryview(packet.payload).cast('B')
+                kind = _SLOT_RAW
+            except TypeError:
+                pass
+        if data is None:
+            data = pickle.dumps(packet, pickle.HIGHEST_PROTOCOL)
+            kind = _SLOT_PICKLED
+        size = len(data)
+        if size + _SLOT_HEADER.size > self._slot_size:
+            raise ChannelException("Connection '%s': packet of %d bytes doesn't fit in a %d bytes slot" %
+                                   (self.name, size, self._slot_size))
+        offset = (self._index % self.capacity) * self._slot_size
+        buf = self._shm.buf
+        _SLOT_HEADER.pack_into(buf, offset, size, kind)
+        start = offset + _SLOT_HEADER.size
+        buf[start:start + size] = data
+        self._index += 1
+        self._credits -= 1
+
+    async def put_packet(self, packet):
+        await self._wait_credit()
+        self._write_slot(packet)
+        _send_credits(self._doorbell_fd, 1)
+
+    async def put_batch(self, packets):
+        count = 0
+        for packet in packets:
+            if not self._credits:
+                _send_credits(self._doorbell_fd, count)
+                count = 0
+                await self._wait_credit()
+            self._write_slot(packet)
+            count += 1
+        if count:
+            _send_credits(self._doorbell_fd, count)
+
+    def put_packet_nowait(self, packet):
+        if not self._credits:
+            return False
+        self._write_slot(packet)
+        _send_credits(self._doorbell_fd, 1)
+        return True
+
+    def put_batch_nowait(self, packets):
+        count = min(self._credits, len(packets))
+        for packet in packets[:count]:
+            self._write_slot(packet)
+        if count:
+            _send_credits(self._doorbell_fd, count)
+        return count
+
+    def close(self):
+        self._loop.remove_reader(self._credit_fd)
+        os.close(self._credit_fd)
+        os.close(self._doorbell_fd)
+        self._shm.close()
+
+
+def _release_view(view):
+    try:
+        view.release()
+    except BufferError:
+        # Still exported by a consumer (numpy array...): released with its last export
+        pass
+
+
+class ShmReaderConnection(Connection):
+    """
+    Receiving end of a shared memory channel.
+    Raw payloads are delivered as memoryview objects pointing into the shared memory ring, without copy. A view stays
+    valid until the next read on the input port it has been read from, after which its slot is given back to the
+    writer: consumers which need to keep a payload longer, or which dispatch packets from an unordered port
+    concurrently, must copy it (bytes(view)). Views are released when their slot is given back.
+    The buffer policy must deliver packets in FIFO order (see SHM_BUFFER_POLICIES).
+    """
+    holds_packets = True
+
+    def __init__(self, shm, slot_size, doorbell_fd, credit_fd, name=None, capacity=1, buffer=None, loop=None,
+                 buffer_options=None):
+        super().__init__(name, capacity, loop=loop, buffer=buffer, buffer_options=buffer_options)
+        self._shm = shm
+        self._slot_size = slot_size
+        self._doorbell_fd = doorbell_fd
+        self._credit_fd = credit_fd
+        os.set_blocking(doorbell_fd, False)
+        self._index = 0
+        self._delivered = 0
+        # Views handed out for the slots read and not given back yet, in ring order (None for pickled slots)
+        self._views = deque()
+        self._loop.add_reader(doorbell_fd, self._on_doorbell)
+
+    def _read_slot(self):
+        offset = (self._index % self.capacity) * self._slot_size
+        buf = self._shm.buf
+        size, kind = _SLOT_HEADER.unpack_from(buf, offset)
+        start = offset + _SLOT_HEADER.size
+        self._index += 1
+        view = buf[start:start + size]
+        if kind == _SLOT_RAW:
+            self._views.append(view)
+            return DataPacket(view)
+        self._views.append(None)
+        with view:
+            return pickle.loads(view)
+
+    def _on_doorbell(self):
+        try:
+            data = os.read(self._doorbell_fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            self.logger.debug("Connection '%s': remote end closed" % self.name)
+            self._loop.remove_reader(self._doorbell_fd)
+            return
+        self.put_batch_nowait([self._read_slot() for i in range(len(data))])
+
+    def release(self):
+        if self._delivered:
+            views = self._views
+            for i in range(self._delivered):
+                view = views.popleft()
+                if view is not None:
+                    _release_view(view)
+            _send_credits(self._credit_fd, self._delivered)
+            self._delivered = 0
+
+    def get_packet_nowait(self):
+        packet = super().get_packet_nowait()
+        self._delivered += 1
+        return packet
+
+    def get_batch_nowait(self, max_items):
+        packets = super().get_batch_nowait(max_items)
+        self._delivered += len(packets)
+        return packets
+
+    async def get_packet(self):
+        self.release()
+        packet = await super().get_packet()
+        self._delivered += 1
+        return packet
+
+    def close(self):
+        self._loop.remove_reader(self._doorbell_fd)
+        os.close(self._doorbell_fd)
+        os.close(self._credit_fd)
+        for view in self._views:
+            if view is not None:
+                _release_view(view)
+        self._views.clear()
+        try:
+            self._shm.close()
+        except BufferError:
+            self.logger.warning("Connection '%s': payloads still exported, shared memory left mapped" % self.name)
+
+
+class ShmChannel:
+    """
+    Shared memory transport of a connection between two OS processes: a ring of `capacity` slots of `slot_size` bytes
+    each, plus two pipes carrying doorbells (writer to reader) and credits (reader to writer).
+    The shared memory segment is unlinked when the creating process closes the channel, once both ends are attached.
+    """
+    def __init__(self, context, capacity, slot_size=DEFAULT_SLOT_SIZE):
+        if not capacity:
+            raise ChannelException("Shared memory channels require a capacity")
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=capacity * slot_size)
+        self._owner_pid = os.getpid()
+        self._doorbell_reader, self._doorbell_writer = context.Pipe(duplex=False)
+        self._credit_reader, self._credit_writer = context.Pipe(duplex=False)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The segment is owned by the creating process: don't let this one's resource tracker unlink it
+        try:
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        except Exception:
+            pass
+
+    def _attach(self):
+        return _attach_shm(self._shm.name, os.getpid() == self._owner_pid)
+
+    def open_writer(self, name, capacity, buffer=None, loop=None):
+        return ShmWriterConnection(self._attach(), self.slot_size, os.dup(self._doorbell_writer.fileno()),
+                                   os.dup(self._credit_reader.fileno()), name, self.capacity, loop)
+
+    def open_reader(self, name, capacity, buffer=None, loop=None, buffer_options=None):
+        return ShmReaderConnection(self._attach(), self.slot_size, os.dup(self._doorbell_reader.fileno()),
+                                   os.dup(self._credit_writer.fileno()), name, self.capacity, buffer, loop,
+                                   buffer_options)
+
+    def close(self):
+        """
+        Release the channel ends held by this process. Ends already opened are kept open: each one maps the shared
+        memory segment on its own.
+        """
+        for end in (self._doorbell_reader, self._doorbell_writer, self._credit_reader, self._credit_writer):
+            end.close()
+        self._shm.close()
+        if os.getpid() == self._owner_pid:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+TRANSPORTS = {
+    'pipe': PipeChannel,
+    'shm': ShmChannel,
+}
+
+
+def new_channel(transport, context, capacity, slot_size=None):
+    """
+    Create a channel for a connection crossing OS processes
+    :param transport: transport name (see TRANSPORTS), defaults to 'pipe'
+    :param context: multiprocessing context
+    :param capacity: connection capacity
+    :param slot_size: shared memory slot size ('shm' transport only)
+    :return: the channel
+    """
+    if transport == 'shm':
+        return ShmChannel(context, capacity, slot_size or DEFAULT_SLOT_SIZE)
+    if transport in (None, 'pipe'):
+        return PipeChannel(context)
+    raise ChannelException("Unknown transport '%s'" % transport)
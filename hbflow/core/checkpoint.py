@@ -0,0 +1,87 @@
+import logging
+import os
+import pickle
+from collections import namedtuple
+from .packet import DataPacket, DEFAULT_PRIORITY
+
+# Format version of checkpoint files, checked when they are loaded
+CHECKPOINT_VERSION = 1
+
+# State of an engine saved by GraphEngine.checkpoint: packets queued in connections by connection key, packets queued
+# in ordered merges and their routing logs by merge key, and component states by process name
+Checkpoint = namedtuple('Checkpoint', ['checkpoint_id', 'connections', 'merges', 'processes'])
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointException(Exception):
+    pass
+
+
+def _pack_packets(packets):
+    """
+    Data packets are saved as (seq, payload) tuples: pickling them is several times faster, and the file smaller,
+    than with the default pickling of slotted objects. Other packets, and data packets with a priority or a deadline,
+    are saved as is.
+    """
+    return [(packet.seq, packet.payload)
+            if type(packet) is DataPacket and packet.priority == DEFAULT_PRIORITY and packet.deadline is None
+            else packet for packet in packets]
+
+
+def _unpack_packets(items):
+    packets = []
+    for item in items:
+        if type(item) is tuple:
+            packet = DataPacket(item[1])
+            packet.seq = item[0]
+            item = packet
+        packets.append(item)
+    return packets
+
+
+def save_checkpoint(checkpoint, path):
+    """
+    Write a checkpoint to a file. The file is replaced atomically so that a crash while writing keeps the previous
+    checkpoint.
+    :param checkpoint: Checkpoint instance
+    :param path: file path
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as stream:
+            pickle.dump((CHECKPOINT_VERSION, checkpoint.checkpoint_id,
+                         dict((key, _pack_packets(packets)) for key, packets in checkpoint.connections.items()),
+                         dict((key, (_pack_packets(packets), routing))
+                              for key, (packets, routing) in checkpoint.merges.items()),
+                         checkpoint.processes), stream, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except (OSError, pickle.PicklingError, AttributeError, TypeError) as e:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise CheckpointException("Can't write checkpoint to '%s'" % path) from e
+    logger.debug("Checkpoint %d written to '%s'" % (checkpoint.checkpoint_id, path))
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint file written by save_checkpoint
+    :param path: file path
+    :return: Checkpoint instance
+    """
+    try:
+        with open(path, 'rb') as stream:
+            version, checkpoint_id, connections, merges, processes = pickle.load(stream)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        raise CheckpointException("Can't read checkpoint '%s'" % path) from e
+    if version != CHECKPOINT_VERSION:
+        raise CheckpointException("Checkpoint '%s' has version %s, version %d expected" %
+                                  (path, version, CHECKPOINT_VERSION))
+    return Checkpoint(checkpoint_id, dict((key, _unpack_packets(items)) for key, items in connections.items()),
+                      dict((key, (_unpack_packets(items), routing)) for key, (items, routing) in merges.items()),
+                      processes)
@@ -1,2 +1,6 @@
 SET_CONTEXT = 'set_context'
 START = 'start'
+STOP = 'stop'
+METRICS = 'metrics'
+BARRIER = 'barrier'
+RESUME = 'resume'
@@ -0,0 +1,363 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+from .component import get_component_class, ComponentException, Component, IN, EXECUTION_MODES
+from .graph import Graph, GraphException, GraphValidationException, Partition, PARTITION_SPLIT, PARTITION_MERGE
+from .partition import PARTITION_MODES, PARTITION_ROUND_ROBIN, MERGE_ORDERED, replica_name
+from .buffer import BUFFER_POLICIES, BUFFER_OPTIONS, DEFAULT_CAPACITY, DEFAULT_POLICY
+from .channel import TRANSPORTS, SHM_BUFFER_POLICIES
+
+logger = logging.getLogger(__name__)
+
+# Incremented when the GraphPlan layout changes, so that plans cached by older versions are compiled again
+PLAN_VERSION = 5
+PLAN_SUFFIX = '.plan'
+
+
+class GraphPlan:
+    """
+    Validated and resolved graph, ready to be bound by a GraphEngine.
+    A plan holds the graph description, the component class name of each process, a port index (ports of each
+    component class, with their direction) and the connection table. Component classes are only imported when
+    component_class() is called, so that an engine running a group of processes only imports the modules it needs.
+    Plans are picklable: they are cached on disk (see load_plan) and given to worker processes.
+    """
+    def __init__(self, graph, spec_hash=None):
+        self.version = PLAN_VERSION
+        self.graph = graph
+        self.spec_hash = spec_hash
+        # process name -> ProcessDesc
+        self.processes = dict()
+        # process name -> group
+        self.groups = dict()
+        # component class name -> {port name: 'in' or 'out'}, with one entry per element of array ports
+        self.ports = dict()
+        # ConnectionDesc list, in graph order
+        self.connections = list(graph.connections_desc)
+        # module name -> (file path, modification time) of component modules
+        self.modules = dict()
+        self._classes = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_classes'] = dict()
+        return state
+
+    def component_class(self, process_name):
+        """
+        Get (and import if needed) the component class of a process
+        :param process_name: process name
+        :return: the component class
+        """
+        class_name = self.processes[process_name].class_name
+        component_class = self._classes.get(class_name)
+        if component_class is None:
+            component_class = get_component_class(class_name)
+            self._classes[class_name] = component_class
+        return component_class
+
+    def is_stale(self):
+        """
+        :return: True if the plan was made by another plan version or if a component module changed since
+        """
+        if getattr(self, 'version', None) != PLAN_VERSION:
+            return True
+        for path, mtime in self.modules.values():
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+def graph_from_dictionary(dict_spec: dict):
+    """
+    Build a graph from a dictionary specification (as loaded from a YAML file for example)
+    :param dict_spec: graph specification, optionally under a 'graph' root key
+    :return: the Graph instance
+    """
+    # Allow 'graph' as optional root
+    if 'graph' in dict_spec:
+        graph_config = dict_spec.get('graph')
+    else:
+        graph_config = dict_spec
+
+    name = graph_config.get('name', None)
+    description = graph_config.get('description', None)
+    author = graph_config.get('author', None)
+    date = graph_config.get('date', None)
+    graph = Graph(name, description, author, date)
+
+    processes = graph_config.get('processes', dict())
+    for process in processes:
+        component_name = processes[process].get('component', None)
+        if not component_name:
+            raise GraphException("No component class given for process '%s'" % process)
+        group = processes[process].get('group', None)
+        concurrency = processes[process].get('concurrency', None)
+        execution = processes[process].get('execution', None)
+        pool_size = processes[process].get('pool_size', None)
+        replicas = processes[process].get('replicas', None)
+        partition = processes[process].get('partition', None)
+        partition_key = processes[process].get('partition_key', None)
+        merge = processes[process].get('merge', None)
+        priority = processes[process].get('priority', None)
+        graph.add_process(process, component_name, group, concurrency, execution, pool_size, replicas, partition,
+                          partition_key, merge, priority)
+
+    connections = graph_config.get('connections') or []
+    for cnx in connections:
+        cnx_name = cnx.get('name', None)
+        try:
+            source_component = cnx['source']['process']
+            source_port = cnx['source']['port']
+            target_component = cnx['target']['process']
+            target_port = cnx['target']['port']
+        except KeyError as ke:
+            raise GraphException("Invalid parameters for connection '%s' definition" % cnx_name) from ke
+        graph.add_connection(cnx_name, source_component, source_port, target_component, target_port,
+                             cnx.get('capacity', DEFAULT_CAPACITY), cnx.get('buffer', None),
+                             cnx.get('transport', None), cnx.get('slot_size', None), cnx.get('buffer_options', None))
+    return graph
+
+
+def compile_graph(graph, spec_hash=None):
+    """
+    Validate a graph in a single pass and resolve it into a plan: component classes must be importable, connections
+    must link an existing output port to an existing input port with a known buffer policy and transport. All the
+    errors found are reported at once. Replicated processes are expanded first (see expand_replicas), the plan holds
+    the expanded graph.
+    :param graph: Graph instance
+    :param spec_hash: hash of the specification the graph comes from, if any
+    :return: the GraphPlan
+    """
+    errors = []
+    graph = expand_replicas(graph, errors)
+    plan = GraphPlan(graph, spec_hash)
+    classes = dict()
+    for proc_desc in graph.processes_desc:
+        plan.processes[proc_desc.process_name] = proc_desc
+        plan.groups[proc_desc.process_name] = proc_desc.group
+        if proc_desc.class_name not in classes:
+            try:
+                component_class = get_component_class(proc_desc.class_name)
+                if not (isinstance(component_class, type) and issubclass(component_class, Component)):
+                    raise ComponentException("'%s' is not a component class" % proc_desc.class_name)
+                classes[proc_desc.class_name] = component_class
+                plan.ports[proc_desc.class_name] = dict(
+                    (name, 'in' if isinstance(declaration, IN) else 'out')
+                    for name, declaration in component_class.port_index().items())
+                _add_module(plan, component_class)
+            except ComponentException as ce:
+                errors.append("Process '%s': %s" % (proc_desc.process_name, ce))
+                classes[proc_desc.class_name] = None
+        elif classes[proc_desc.class_name] is None:
+            errors.append("Process '%s': component '%s' is not available" %
+                          (proc_desc.process_name, proc_desc.class_name))
+        if proc_desc.execution and proc_desc.execution not in EXECUTION_MODES:
+            errors.append("Process '%s': invalid execution mode '%s'" % (proc_desc.process_name, proc_desc.execution))
+        if proc_desc.priority is not None and type(proc_desc.priority) is not int:
+            errors.append("Process '%s': invalid priority '%s'" % (proc_desc.process_name, proc_desc.priority))
+
+    for cnx_desc in graph.connections_desc:
+        if cnx_desc.buffer and cnx_desc.buffer not in BUFFER_POLICIES:
+            errors.append("Connection '%s': invalid buffer policy '%s'" % (cnx_desc.connection_name, cnx_desc.buffer))
+        if cnx_desc.transport and cnx_desc.transport not in TRANSPORTS:
+            errors.append("Connection '%s': invalid transport '%s'" % (cnx_desc.connection_name, cnx_desc.transport))
+        if cnx_desc.buffer_options is not None:
+            if not isinstance(cnx_desc.buffer_options, dict):
+                errors.append("Connection '%s': invalid buffer options '%s'" %
+                              (cnx_desc.connection_name, cnx_desc.buffer_options))
+            else:
+                policy = cnx_desc.buffer or DEFAULT_POLICY
+                for option in sorted(set(cnx_desc.buffer_options).difference(BUFFER_OPTIONS.get(policy, ()))):
+                    errors.append("Connection '%s': buffer policy '%s' has no option '%s'" %
+                                  (cnx_desc.connection_name, policy, option))
+        if cnx_desc.transport == 'shm' and cnx_desc.buffer and cnx_desc.buffer not in SHM_BUFFER_POLICIES:
+            errors.append("Connection '%s': buffer policy '%s' can't be used with transport 'shm'" %
+                          (cnx_desc.connection_name, cnx_desc.buffer))
+        for end, process_name, port_name, direction in (
+                ('source', cnx_desc.source_process_name, cnx_desc.source_port_name, 'out'),
+                ('target', cnx_desc.target_process_name, cnx_desc.target_port_name, 'in')):
+            proc_desc = plan.processes.get(process_name)
+            if proc_desc is None:
+                errors.append("Connection '%s': unknown %s process '%s'" %
+                              (cnx_desc.connection_name, end, process_name))
+                continue
+            ports = plan.ports.get(proc_desc.class_name)
+            if ports is None:
+                continue
+            if ports.get(port_name) != direction:
+                errors.append("Connection '%s': %s process '%s' has no %s port named '%s'" %
+                              (cnx_desc.connection_name, end, process_name,
+                               'output' if direction == 'out' else 'input', port_name))
+    if errors:
+        raise GraphValidationException(errors)
+    return plan
+
+
+def expand_replicas(graph, errors):
+    """
+    Expand the replicated processes of a graph: a process with N replicas becomes N processes named 'name[index]'.
+    A connection to a replicated process becomes one connection per replica, tagged as a 'split' partition so that the
+    engine partitions packets between replicas. A connection from a replicated process becomes one connection per
+    replica, tagged as a 'merge' partition when the process merge mode is MERGE_ORDERED. Named connections get the
+    replica indexes appended to their name.
+    :param graph: Graph instance
+    :param errors: list errors are appended to
+    :return: the expanded graph (the graph itself if it has no replicated process)
+    """
+    replicated = dict()
+    groups = dict()
+    for proc_desc in graph.processes_desc:
+        name = proc_desc.process_name
+        replicas = proc_desc.replicas or 1
+        if not isinstance(replicas, int) or replicas < 1:
+            errors.append("Process '%s': invalid replicas count '%s'" % (name, proc_desc.replicas))
+            replicas = 1
+        if proc_desc.partition and proc_desc.partition not in PARTITION_MODES:
+            errors.append("Process '%s': invalid partition mode '%s'" % (name, proc_desc.partition))
+        if proc_desc.merge and proc_desc.merge != MERGE_ORDERED:
+            errors.append("Process '%s': invalid merge mode '%s'" % (name, proc_desc.merge))
+        group = proc_desc.group
+        if isinstance(group, (list, tuple)):
+            if replicas < 2:
+                errors.append("Process '%s': a list of groups requires replicas" % name)
+            groups[name] = [group[index % len(group)] for index in range(replicas)] if group else [None]
+        else:
+            groups[name] = [group] * replicas
+        if replicas > 1:
+            replicated[name] = proc_desc
+    if not replicated:
+        return graph
+
+    expanded = graph.copy()
+    expanded.processes.clear()
+    expanded.connections.clear()
+    for proc_desc in graph.processes_desc:
+        name = proc_desc.process_name
+        if name not in replicated:
+            _expand(expanded.add_process_desc, proc_desc, errors)
+            continue
+        for index in range(proc_desc.replicas):
+            _expand(expanded.add_process_desc, proc_desc._replace(process_name=replica_name(name, index),
+                                                                  group=groups[name][index], replicas=None,
+                                                                  partition=None, partition_key=None, merge=None),
+                    errors)
+
+    for proc_desc in replicated.values():
+        if proc_desc.merge != MERGE_ORDERED:
+            continue
+        # The routing log of an ordered merge is shared in memory by the partitioner and the merge
+        name = proc_desc.process_name
+        inputs = [c for c in graph.connections_desc if c.target_process_name == name]
+        outputs = [c for c in graph.connections_desc if c.source_process_name == name]
+        if len(inputs) != 1:
+            errors.append("Process '%s': ordered merge requires a single input connection" % name)
+        neighbours = [c.source_process_name for c in inputs] + [c.target_process_name for c in outputs]
+        if len(set(groups[name] + [group for other in neighbours for group in groups.get(other, [None])])) > 1:
+            errors.append("Process '%s': ordered merge requires the replicas and their neighbours in the same group"
+                          % name)
+        for cnx_desc in outputs:
+            if cnx_desc.target_process_name in replicated:
+                errors.append("Process '%s': ordered merge into replicated process '%s'" %
+                              (name, cnx_desc.target_process_name))
+
+    for cnx_desc in graph.connections_desc:
+        source = replicated.get(cnx_desc.source_process_name)
+        target = replicated.get(cnx_desc.target_process_name)
+        source_count = source.replicas if source else 1
+        target_count = target.replicas if target else 1
+        ordered = source is not None and source.merge == MERGE_ORDERED
+        for source_index in range(source_count):
+            for target_index in range(target_count):
+                partition = None
+                if target is not None:
+                    partition = Partition(PARTITION_SPLIT, target.process_name, target_index, target_count,
+                                          target.partition or PARTITION_ROUND_ROBIN, target.partition_key)
+                elif ordered:
+                    partition = Partition(PARTITION_MERGE, source.process_name, source_index, source_count, None, None)
+                connection_name = cnx_desc.connection_name
+                source_name = cnx_desc.source_process_name
+                target_name = cnx_desc.target_process_name
+                if source is not None:
+                    source_name = replica_name(source_name, source_index)
+                    connection_name = connection_name and "%s[%d]" % (connection_name, source_index)
+                if target is not None:
+                    target_name = replica_name(target_name, target_index)
+                    connection_name = connection_name and "%s[%d]" % (connection_name, target_index)
+                _expand(expanded.add_connection_desc, cnx_desc._replace(connection_name=connection_name,
+                                                                         source_process_name=source_name,
+                                                                         target_process_name=target_name,
+                                                                         partition=partition), errors)
+    return expanded
+
+
+def _expand(add, desc, errors):
+    """
+    Add a description to an expanded graph, reporting names clashing with replica names as errors
+    """
+    try:
+        add(desc)
+    except GraphException as ge:
+        errors.append(str(ge))
+
+
+def _add_module(plan, component_class):
+    module = sys.modules.get(component_class.__module__)
+    path = getattr(module, '__file__', None)
+    if path:
+        plan.modules[component_class.__module__] = (path, os.path.getmtime(path))
+
+
+def spec_hash(dict_spec: dict):
+    """
+    :return: hash of a dictionary graph specification
+    """
+    canonical = json.dumps(dict_spec, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def load_plan(dict_spec: dict, cache_dir=None):
+    """
+    Get the plan of a dictionary graph specification. When a cache directory is given, plans are cached there, keyed
+    by specification hash, and compiled again when a component module changed.
+    :param dict_spec: graph specification
+    :param cache_dir: plans cache directory (no caching if None)
+    :return: the GraphPlan
+    """
+    key = spec_hash(dict_spec)
+    if cache_dir is None:
+        return compile_graph(graph_from_dictionary(dict_spec), key)
+    path = os.path.join(cache_dir, key + PLAN_SUFFIX)
+    try:
+        with open(path, 'rb') as stream:
+            plan = pickle.load(stream)
+        if not plan.is_stale():
+            logger.debug("Graph plan loaded from '%s'" % path)
+            return plan
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass
+    plan = compile_graph(graph_from_dictionary(dict_spec), key)
+    save_plan(plan, path)
+    return plan
+
+
+def save_plan(plan, path):
+    """
+    Write a plan to a file. The file is replaced atomically so that concurrent readers never see a partial plan.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as stream:
+            pickle.dump(plan, stream, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Can't write graph plan to '%s': %s" % (path, e))
@@ -1,9 +1,14 @@
 import logging
 import asyncio
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from uuid import uuid4
-from transitions import Machine
-from hbflow.utils import IdentifiableObject
-from hbflow.core.packet import Packet, CommandPacket
+from hbflow.utils import IdentifiableObject, InstanceCounterMeta, StateTable
+from hbflow.core.packet import Packet, CommandPacket, deadline_clock
+from hbflow.core.buffer import new_buffer, DEFAULT_CAPACITY
+from hbflow.core.flow import TokenBucket
 from hbflow.core.commands import *
 import importlib
 
@@ -13,6 +18,8 @@ class ComponentException(Exception):
 
 
 class Port(IdentifiableObject):
+    __slots__ = ('_loop', 'name', 'component', 'description', 'display_name', 'connections', '_connected_event')
+
     def __init__(self, name, component, description=None, display_name=None, loop=None):
         super().__init__()
         if loop:
@@ -27,43 +34,362 @@ class Port(IdentifiableObject):
         self.description = description
         self.display_name = display_name
         self.connections = []
-        self.connected_event = asyncio.Event()
+        self._connected_event = None
+
+    @property
+    def connected_event(self):
+        """
+        Event set while the port has connections. Created on first use.
+        """
+        if self._connected_event is None:
+            self._connected_event = asyncio.Event()
+            if self.connections:
+                self._connected_event.set()
+        return self._connected_event
 
     def add_connection(self, connection):
         self.connections.append(connection)
-        if not self.connected_event.is_set():
-            self.connected_event.set()
+        if self._connected_event is not None:
+            self._connected_event.set()
 
     def remove_connection(self, connection):
         self.connections.remove(connection)
-        if not self.connections:
-            self.connected_event.clear()
+        if not self.connections and self._connected_event is not None:
+            self._connected_event.clear()
 
 
 class InputPort(Port):
-    def __init__(self, *args, **kwargs):
+    """
+    Input port fed by one or more connections.
+    Connections holding packets register themselves in a ready ring (see notify_ready) which is served in round-robin
+    order, each connection delivering up to `weight` packets before yielding to the next one. Reading a packet is O(1)
+    whatever the number of connections and never leaves a pending read on any connection.
+    Ports of a scheduled component tell the engine scheduler when they start and stop holding packets (see
+    hbflow.core.scheduler). Time spent waiting for packets is added to the get_wait of metered connections.
+    Ports of a component whose packet loop is not started yet start it when they first get packets.
+    """
+    __slots__ = ('ordered', '_ready', '_served', '_waiters', '_holding', '_scheduler', '_priority', '_metered',
+                 '_idle')
+
+    def __init__(self, *args, ordered=True, **kwargs):
         super().__init__(*args, **kwargs)
+        self.ordered = ordered
+        self._ready = deque()
+        self._served = 0
+        self._waiters = deque()
+        self._holding = []
+        self._scheduler = None
+        self._priority = 0
+        self._metered = []
+        # True until the packet loop of the component is started (see Component._start_packet_loop)
+        self._idle = False
+
+    def add_connection(self, connection):
+        super().add_connection(connection)
+        if connection.metered:
+            self._metered.append(connection)
+
+    def remove_connection(self, connection):
+        super().remove_connection(connection)
+        if connection.metered:
+            self._metered.remove(connection)
+        if connection.ready:
+            self._ready.remove(connection)
+            connection.ready = False
+            self._served = 0
+            if not self._ready and self._scheduler is not None:
+                self._scheduler.port_drained(self._priority)
+
+    def notify_ready(self, connection):
+        """
+        Called by a connection when packets are available on it.
+        :param connection: connection which holds packets
+        """
+        if not connection.ready:
+            connection.ready = True
+            if not self._ready and self._scheduler is not None:
+                self._scheduler.port_ready(self._priority)
+            self._ready.append(connection)
+            if self._idle:
+                self.component._start_packet_loop()
+            self._wakeup_next()
+
+    def _wakeup_next(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _pop_ready(self):
+        cnx = self._ready.popleft()
+        cnx.ready = False
+        self._served = 0
+        if not self._ready and self._scheduler is not None:
+            self._scheduler.port_drained(self._priority)
+
+    def _release(self):
+        """
+        Tell connections holding resources for the packets returned by the previous read that they can release them
+        """
+        for cnx in self._holding:
+            cnx.release()
+        self._holding = []
+
+    def get_packet_nowait(self):
+        """
+        Get the next packet available on this port without waiting.
+        Raises asyncio.QueueEmpty if no connection holds any packet.
+        :return: the packet read
+        """
+        if self._holding:
+            self._release()
+        ready = self._ready
+        while ready:
+            cnx = ready[0]
+            try:
+                packet = cnx.get_packet_nowait()
+            except asyncio.QueueEmpty:
+                # Stale entry: the connection has been drained by some other reader
+                self._pop_ready()
+                continue
+            if cnx.holds_packets:
+                self._holding.append(cnx)
+            if cnx.packet_queue.empty():
+                self._pop_ready()
+            else:
+                self._served += 1
+                if self._served >= cnx.weight:
+                    ready.rotate(-1)
+                    self._served = 0
+            return packet
+        raise asyncio.QueueEmpty()
+
+    def get_batch_nowait(self, max_items):
+        """
+        Get up to max_items packets available on this port without waiting, following the same round-robin order
+        than get_packet_nowait.
+        :param max_items: maximum number of packets to get
+        :return: list of packets (possibly empty)
+        """
+        if self._holding:
+            self._release()
+        return self._get_batch_nowait(max_items)
+
+    def _get_batch_nowait(self, max_items):
+        ready = self._ready
+        batch = []
+        while ready and len(batch) < max_items:
+            cnx = ready[0]
+            if len(ready) == 1:
+                # No other connection to yield to: weights don't apply
+                count = max_items - len(batch)
+            else:
+                count = min(max_items - len(batch), cnx.weight - self._served)
+            packets = cnx.get_batch_nowait(count)
+            batch.extend(packets)
+            if cnx.holds_packets:
+                self._holding.append(cnx)
+            if cnx.packet_queue.empty():
+                self._pop_ready()
+            else:
+                self._served += len(packets)
+                if self._served >= cnx.weight:
+                    ready.rotate(-1)
+                    self._served = 0
+        return batch
+
+    async def _wait_ready(self, timeout=None):
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        timer = None
+        if timeout is not None:
+            timer = self._loop.call_later(timeout, _release_waiter, waiter)
+        metered = self._metered
+        if metered:
+            start = self._loop.time()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+            if self._ready and not waiter.cancelled():
+                self._wakeup_next()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if metered:
+                # No connection of the port held packets while waiting
+                elapsed = self._loop.time() - start
+                for cnx in metered:
+                    cnx.get_wait += elapsed
 
     async def read_packet(self):
-        await self.connected_event.wait()
-        futures = []
-        for cnx in self.connections:
-            futures.append(cnx.get_packet())
-        if futures:
-            done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
-            packet = done.pop().result()
-            return self, packet
-        else:
-            return self, None
+        while True:
+            try:
+                packet = self.get_packet_nowait()
+                if self._ready:
+                    self._wakeup_next()
+                return self, packet
+            except asyncio.QueueEmpty:
+                pass
+            await self._wait_ready()
+
+    async def read_batch(self, max_items, max_wait=0):
+        """
+        Read a batch of packets. Waits for at least one packet, then for up to max_wait seconds more while the batch is
+        not complete.
+        :param max_items: maximum number of packets to read
+        :param max_wait: maximum time to wait for additional packets once the first one has been read
+        :return: (port, list of packets)
+        """
+        if self._holding:
+            self._release()
+        batch = []
+        deadline = None
+        while True:
+            batch.extend(self._get_batch_nowait(max_items - len(batch)))
+            if len(batch) >= max_items:
+                break
+            timeout = None
+            if batch:
+                if deadline is None:
+                    deadline = self._loop.time() + max_wait
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+            await self._wait_ready(timeout)
+        if self._ready:
+            self._wakeup_next()
+        return self, batch
+
+
+def _release_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+# Output port fan-out modes
+FANOUT_ALL = 'all'
+FANOUT_ANY = 'any'
+FANOUT_NOWAIT = 'nowait'
 
 
 class OutputPort(Port):
-    def __init__(self, *args, **kwargs):
+    """
+    Output port feeding one or more connections.
+    A packet sent is offered to all connections at once. Connections with free room get it immediately, then the port
+    fan-out mode tells what to do with full ones:
+      - FANOUT_ALL: wait until every connection has accepted the packet
+      - FANOUT_ANY: wait until at least one connection has accepted the packet, full ones get it in background. Each
+        connection has at most one background put in progress: packets sent meanwhile are dropped for it (counted in
+        `dropped`), so that packets keep their order and a stuck connection doesn't hold an unbounded backlog. When
+        all connections are busy with background puts, sending waits for one of them to complete.
+      - FANOUT_NOWAIT: never wait, the packet is dropped for full connections (counted in `dropped`)
+    The same packet instance is shared by all connections, unless `copy_on_send` is set in which case each connection
+    gets its own copy (see Packet.copy()).
+    When the port has a `limiter` (see hbflow.core.flow.TokenBucket), sending waits for the limiter before packets
+    are offered to connections.
+    """
+    __slots__ = ('fanout', 'copy_on_send', 'dropped', 'limiter', '_background')
+
+    def __init__(self, *args, fanout=FANOUT_ALL, copy_on_send=False, limiter=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fanout = fanout
+        self.copy_on_send = copy_on_send
+        self.dropped = 0
+        self.limiter = limiter
+        # connection id -> task putting packets in the connection in background (FANOUT_ANY)
+        self._background = dict()
 
     async def send_packet(self, packet):
-        for cnx in self.connections:
-            await cnx.put_packet(packet)
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        connections = self.connections
+        if len(connections) == 1 and self.fanout == FANOUT_ALL and not self.copy_on_send:
+            await connections[0].put_packet(packet)
+            return
+        if self.fanout == FANOUT_ANY:
+            await self._send_any([packet])
+            return
+        pending = []
+        for cnx in connections:
+            cnx_packet = packet.copy() if self.copy_on_send else packet
+            if not cnx.put_packet_nowait(cnx_packet):
+                if self.fanout == FANOUT_NOWAIT:
+                    self.dropped += 1
+                else:
+                    pending.append(cnx.put_packet(cnx_packet))
+        if pending:
+            await self._wait_pending(pending)
+
+    async def send_batch(self, packets):
+        if self.limiter is not None:
+            await self.limiter.acquire(len(packets))
+        if self.fanout == FANOUT_ANY:
+            await self._send_any(packets)
+            return
+        connections = self.connections
+        pending = []
+        for cnx in connections:
+            cnx_packets = [packet.copy() for packet in packets] if self.copy_on_send else packets
+            if self.fanout == FANOUT_NOWAIT:
+                self.dropped += len(cnx_packets) - cnx.put_batch_nowait(cnx_packets)
+            else:
+                pending.append(cnx.put_batch(cnx_packets))
+        if pending:
+            await self._wait_pending(pending)
+
+    @staticmethod
+    async def _wait_pending(pending):
+        """
+        Wait for the puts in full connections (FANOUT_ALL mode)
+        :param pending: coroutines putting packets in full connections
+        """
+        if len(pending) == 1:
+            await pending[0]
+        else:
+            await asyncio.gather(*pending)
+
+    async def _send_any(self, packets):
+        """
+        Send packets in FANOUT_ANY mode
+        """
+        background = self._background
+        while True:
+            accepted = False
+            busy = 0
+            started = []
+            for cnx in self.connections:
+                if cnx.id in background:
+                    busy += 1
+                    continue
+                cnx_packets = [packet.copy() for packet in packets] if self.copy_on_send else packets
+                count = cnx.put_batch_nowait(cnx_packets)
+                if count == len(cnx_packets):
+                    accepted = True
+                    continue
+                task = asyncio.ensure_future(cnx.put_batch(cnx_packets[count:]), loop=self._loop)
+                background[cnx.id] = task
+                task.add_done_callback(partial(_background_done, background, cnx.id))
+                started.append(task)
+            if accepted or started:
+                self.dropped += busy * len(packets)
+                if not accepted:
+                    await asyncio.wait(started, return_when=asyncio.FIRST_COMPLETED)
+                return
+            if not background:
+                # No connection
+                return
+            await asyncio.wait(list(background.values()), return_when=asyncio.FIRST_COMPLETED)
+
+
+def _background_done(background, key, task):
+    background.pop(key, None)
 
 
 def get_component_class(component_name):
@@ -86,63 +412,379 @@ def get_component_class(component_name):
     return component_class
 
 
+def split_port_name(port_name):
+    """
+    Split the name of an array port element ('name[index]') into the array name and the element index
+    :return: (name, index), index being None for a plain port name
+    """
+    if port_name.endswith(']'):
+        name, sep, index = port_name[:-1].partition('[')
+        if sep and index.isdigit():
+            return name, int(index)
+    return port_name, None
+
+
+def _port_path(port):
+    if port is None:
+        return "<remote>"
+    return "%s:%s" % (port.component.name, port.name)
+
+
 class Connection(IdentifiableObject):
+    __slots__ = ('_loop', '_id', 'state', 'name', 'capacity', 'weight', 'packet_queue', 'source', 'target', 'ready')
     states = ['new', 'linked', 'unlinked']
+    logger = logging.getLogger(__name__)
+    # True for connections whose packets hold resources (shared memory slots...) until release() is called. Input
+    # ports call release() on the next read.
+    holds_packets = False
+    # True for connections with a get_wait attribute, which their target port increments with the time it spends
+    # waiting for packets
+    metered = False
 
-    def __init__(self, name=None, capacity=1):
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY, weight=1, loop=None, buffer=None, buffer_options=None):
         super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self.id = uuid4()
-        self.state = Machine(states=Connection.states, initial='new')
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self._id = None
+        self.state = 'new'
         if name:
             self.name = name
         else:
             self.name = self._instance_name
         self.capacity = capacity
-        self.packet_queue = asyncio.Queue(self.capacity)
+        self.weight = weight
+        self.packet_queue = new_buffer(buffer, self.capacity, self._loop, buffer_options)
         self.source = None
         self.target = None
+        self.ready = False
+
+    @property
+    def id(self):
+        """
+        Connection unique id, generated on first use
+        """
+        if self._id is None:
+            self._id = uuid4()
+        return self._id
 
     def __eq__(self, other):
         return self.id == other.id
 
     def link(self, source: OutputPort, target: InputPort):
+        """
+        Link the connection from a source port to a target port. One of them may be None when the other end of the
+        connection lives in another OS process.
+        """
         self.source = source
         self.target = target
-        source.add_connection(self)
-        target.add_connection(self)
-        self.logger.debug("Linked created: %s:%s -> %s:%s" % (source.component.name, source.name, target.component.name, target.name))
-        self.state.to_linked()
+        if source is not None:
+            source.add_connection(self)
+        if target is not None:
+            target.add_connection(self)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Linked created: %s -> %s" % (_port_path(source), _port_path(target)))
+        self.to_linked()
+        if target is not None and not self.packet_queue.empty():
+            target.notify_ready(self)
 
     def unlink(self):
-        self.logger.debug("Linked removed: %s:%s -> %s:%s" % (self.source.component.name, self.source.name, self.target.component.name, self.target.name))
+        """
+        Remove the connection from its ports. Packets still queued in the connection are not delivered anymore.
+        """
+        self.logger.debug("Linked removed: %s -> %s" % (_port_path(self.source), _port_path(self.target)))
+        if self.source is not None:
+            self.source.remove_connection(self)
+        if self.target is not None:
+            self.target.remove_connection(self)
         self.source = None
         self.target = None
-        # Todo: remove connection from source and target
-        self.state.to_unlinked()
+        self.to_unlinked()
+
+    def redirect(self, source: OutputPort=None, target: InputPort=None):
+        """
+        Move one or both ends of a linked connection to other ports. Packets queued in the connection are kept and
+        delivered to the new target.
+        :param source: new source port (None to keep the current one)
+        :param target: new target port (None to keep the current one)
+        """
+        if source is not None and source is not self.source:
+            if self.source is not None:
+                self.source.remove_connection(self)
+            self.source = source
+            source.add_connection(self)
+        if target is not None and target is not self.target:
+            if self.target is not None:
+                self.target.remove_connection(self)
+            self.target = target
+            target.add_connection(self)
+            if not self.packet_queue.empty():
+                target.notify_ready(self)
+        self.logger.debug("Linked redirected: %s -> %s" % (_port_path(self.source), _port_path(self.target)))
 
     async def put_packet(self, packet):
         await self.packet_queue.put(packet)
+        if self.target is not None:
+            self.target.notify_ready(self)
+
+    def put_packet_nowait(self, packet):
+        """
+        Put a packet if the connection has free room.
+        :return: True if the packet has been accepted, False if the connection is full
+        """
+        if self.packet_queue.full():
+            return False
+        self.packet_queue.put_nowait(packet)
+        if self.target is not None:
+            self.target.notify_ready(self)
+        return True
+
+    def put_batch_nowait(self, packets):
+        """
+        Put as many packets as the connection accepts without waiting.
+        :return: number of packets accepted
+        """
+        count = self.packet_queue.put_many_nowait(packets)
+        if count and self.target is not None:
+            self.target.notify_ready(self)
+        return count
+
+    async def put_batch(self, packets):
+        """
+        Put a list of packets, waiting for free room as needed. Packets are made available to the target as soon as
+        they fit in the buffer.
+        :param packets: list of packets to put
+        """
+        count = len(packets)
+        done = 0
+        while True:
+            done += self.packet_queue.put_many_nowait(packets, done)
+            if done and self.target is not None:
+                self.target.notify_ready(self)
+            if done >= count:
+                break
+            await self.packet_queue.wait_free()
+
+    def depth(self):
+        """
+        :return: number of packets put in the connection and not taken out by its target yet
+        """
+        return len(self.packet_queue)
+
+    def set_capacity(self, capacity):
+        """
+        Change the connection buffer capacity (see PacketBuffer.set_capacity)
+        """
+        self.packet_queue.set_capacity(capacity)
+        self.capacity = capacity
+
+    def load_packets(self, packets):
+        """
+        Queue packets restored from a checkpoint, whatever the connection capacity
+        """
+        self.packet_queue.load(packets)
+        if packets and self.target is not None:
+            self.target.notify_ready(self)
+
+    def get_packet_nowait(self):
+        return self.packet_queue.get_nowait()
+
+    def get_batch_nowait(self, max_items):
+        return self.packet_queue.get_many_nowait(max_items)
 
     async def get_packet(self):
         packet = await self.packet_queue.get()
         return packet
 
-class IN:
-    def __init__(self, description=None, display_name=None, array_size=1):
+    def release(self):
+        pass
+
+    def close(self):
+        """
+        Release system resources held by the connection
+        """
+        self.packet_queue.close()
+
+
+StateTable(Connection.states).install(Connection)
+
+
+class FusedConnection(Connection):
+    """
+    Connection without buffer: a packet put is handed directly to the target component on_packet, in the task of the
+    sender, which waits until the packet is processed. The engine uses fused connections between fusable components
+    (see Component.fusable) so that a chain of such components runs as a single unit, without queueing nor task switch
+    between them. Fused connections keep their name and count packets going through them.
+    """
+    __slots__ = ('packets', '_deliver')
+
+    def __init__(self, name=None, loop=None):
+        super().__init__(name, capacity=None, loop=loop, buffer='unbounded')
+        self.packets = 0
+        self._deliver = None
+
+    def link(self, source: OutputPort, target: InputPort):
+        super().link(source, target)
+        self._bind_target()
+
+    def redirect(self, source: OutputPort=None, target: InputPort=None):
+        super().redirect(source, target)
+        self._bind_target()
+
+    def _bind_target(self):
+        component = self.target.component
+        # Call on_packet directly, unless dispatch has been instrumented (see hbflow.core.metrics)
+        self._deliver = component.__dict__.get('_dispatch', component.on_packet)
+
+    async def put_packet(self, packet):
+        self.packets += 1
+        if packet.__class__ is CommandPacket:
+            await self.target.component._handle_command(packet)
+            return
+        if packet.deadline is not None and packet.deadline < deadline_clock():
+            await self.target.component._expire([packet])
+            return
+        try:
+            await self._deliver(self.target, packet)
+        except Exception:
+            component = self.target.component
+            component.logger.exception("Process '%s' failed to handle packet from port '%s'" %
+                                       (component.name, self.target.name))
+
+    def put_packet_nowait(self, packet):
+        return False
+
+    def put_batch_nowait(self, packets):
+        return 0
+
+    async def put_batch(self, packets):
+        for packet in packets:
+            await self.put_packet(packet)
+
+    def snapshot(self):
+        return {
+            'packets_in': self.packets,
+            'packets_out': self.packets,
+            'depth': 0,
+            'high_water': 0,
+            'dropped': 0,
+            'put_wait': 0.0,
+            'get_wait': 0.0,
+            'fused': True,
+        }
+
+class PortDeclaration:
+    """
+    Base of port declarations. A component gets its port the first time the declaration is read from the component
+    instance, so that ports which are never used (system ports of most processes...) are not created.
+    """
+    # Name of the component class attribute holding the declaration, set by ComponentMeta
+    attr_name = None
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance._create_port(self.attr_name, self)
+
+
+class IN(PortDeclaration):
+    """
+    Input port declaration.
+    Packets read from an `ordered` port are handed to on_packet one at a time, in arrival order. Packets from an
+    unordered port may be processed concurrently, up to the component concurrency level. In thread and process
+    execution modes, on_packet calls for an ordered port overlap too, but the packets they emit are sent in arrival
+    order.
+    With an `array_size` greater than 1, the component gets a tuple of `array_size` ports, named 'name[index]' in
+    graph connections. This applies to OUT declarations too.
+    """
+    def __init__(self, description=None, display_name=None, array_size=1, ordered=True):
         self.description = description
         self.display_name = display_name
         self.array_size = array_size
+        self.ordered = ordered
 
 
-class OUT:
-    def __init__(self, description=None, display_name=None, array_size=1):
+class OUT(PortDeclaration):
+    """
+    Output port declaration. See OutputPort for fan-out modes. When `rate` is given, packets are sent at most at `rate`
+    packets per second, with bursts of up to `burst` packets (see hbflow.core.flow.TokenBucket).
+    """
+    def __init__(self, description=None, display_name=None, array_size=1, fanout=FANOUT_ALL, copy_on_send=False,
+                 rate=None, burst=None):
         self.description = description
         self.display_name = display_name
         self.array_size = array_size
+        self.fanout = fanout
+        self.copy_on_send = copy_on_send
+        self.rate = rate
+        self.burst = burst
+
+
+# Component execution modes
+EXECUTION_LOOP = 'loop'
+EXECUTION_THREAD = 'thread'
+EXECUTION_PROCESS = 'process'
+EXECUTION_MODES = (EXECUTION_LOOP, EXECUTION_THREAD, EXECUTION_PROCESS)
+
+# Packets emitted by on_packet running in an executor
+_executor_context = threading.local()
+# Component instance used by on_packet calls in a process pool worker
+_detached_component = None
+# Instance attributes which belong to the event loop side of a component and are not given to process pool workers
+_RUNTIME_ATTRIBUTES = ('_loop', '_packet_task', '_input_ports', '_dispatch_slots', '_dispatch_tasks', '_executor',
+                       '_ordered_dispatch', 'metrics', '_command_bus', '_barrier', '_busy', '_idle_event', '_scheduler')
+
+
+class DetachedPort:
+    """
+    Stand-in for a component port in a process pool worker. Packets can be emitted to it with Component.emit()
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+def _init_detached_component(component_class, state):
+    global _detached_component
+    component = object.__new__(component_class)
+    for attr_name, attr in component_class._declared_ports():
+        if attr.array_size > 1:
+            setattr(component, attr_name, tuple(DetachedPort("%s[%d]" % (attr_name, index))
+                                                for index in range(attr.array_size)))
+        else:
+            setattr(component, attr_name, DetachedPort(attr_name))
+    component.__dict__.update(state)
+    _detached_component = component
+
+
+def _execute_detached(port_name, packets):
+    return _detached_component._execute(port_name, packets)
+
+
+class ComponentMeta(InstanceCounterMeta):
+    """
+    Metaclass computing the port schema of a component class once, when the class is created
+    """
+    def __init__(cls, name, bases, attrs):
+        super().__init__(name, bases, attrs)
+        table = dict()
+        index = dict()
+        for attr_name in dir(cls):
+            attr = getattr(cls, attr_name)
+            if isinstance(attr, PortDeclaration):
+                attr.attr_name = attr_name
+                table[attr_name] = attr
+                if attr.array_size > 1:
+                    for element in range(attr.array_size):
+                        index["%s[%d]" % (attr_name, element)] = attr
+                else:
+                    index[attr_name] = attr
+        cls._port_table = table
+        cls._port_index = index
 
 
-class Component(IdentifiableObject):
+class Component(IdentifiableObject, metaclass=ComponentMeta):
+    logger = logging.getLogger(__name__)
     states = ['new', 'starting', 'waiting', 'running', 'idle', 'stopping', 'stopped', 'shutdown']
     transitions = [
         {'trigger': 'start', 'source': 'new', 'dest': 'starting'},
@@ -153,75 +795,472 @@ class Component(IdentifiableObject):
         {'trigger': 'idle', 'source': 'running', 'dest': 'idle'},
         {'trigger': 'stop', 'source': ['running', 'waiting'], 'dest': 'stopping'},
         {'trigger': 'stop', 'source': 'stopping', 'dest': 'stopped'},
-        {'trigger': 'shutdown', 'source': 'stopped', 'dest': 'sshutdown'},
+        {'trigger': 'shutdown', 'source': 'stopped', 'dest': 'shutdown'},
     ]
 
     _log_out = IN()
     _command_in = IN()
     _status_out = OUT()
+    # Packets read past their deadline (see Packet.deadline) are sent to this port instead of being handled, or
+    # dropped when it isn't connected. `expired` counts them.
+    _expired_out = OUT()
+    expired = 0
+
+    # Maximum number of concurrent on_packet invocations
+    concurrency = 1
+    # Stateless components with a single input and a single output may declare themselves fusable: the engine then
+    # calls their on_packet directly from the upstream component instead of going through a connection buffer (see
+    # FusedConnection). on_packet of a fusable component may be invoked concurrently.
+    fusable = False
+    # Where on_packet runs: on the event loop (EXECUTION_LOOP), or as a regular blocking function in a pool of
+    # `pool_size` threads (EXECUTION_THREAD) or OS processes (EXECUTION_PROCESS). In the latter modes, on_packet sends
+    # packets with emit() and the component may run up to `pool_size` on_packet calls concurrently, packets emitted for
+    # an ordered port being sent in arrival order. In process mode
+    # on_packet works on a copy of the component taken when the process starts: attributes changes are not seen by
+    # the engine.
+    execution = EXECUTION_LOOP
+    pool_size = 1
+    # Maximum number of packets handed to on_batch at once and time to wait for a batch to fill up. With a batch size
+    # of 1, packets are handed one by one to on_packet
+    batch_size = 1
+    batch_wait = 0
+    # ComponentMetrics instance, set by the engine when metrics are enabled (see hbflow.core.metrics)
+    metrics = None
+    # CommandBus the component receives commands from, instead of its command port, and version of the last command
+    # received from it (see hbflow.core.control)
+    _command_bus = None
+    command_version = 0
+    # Event set on RESUME while a BARRIER command holds the component from reading packets, number of packets read and
+    # not handled yet, and event set when this number drops to 0 (see GraphEngine.checkpoint)
+    _barrier = None
+    _busy = 0
+    _idle_event = None
+    # Scheduling priority: when the engine schedules processes (see hbflow.core.scheduler), a process doesn't handle
+    # packets while processes of higher priority have packets waiting
+    priority = 0
+    _scheduler = None
+    # Event loop, set by __init__ (ports used before fall back to the current event loop)
+    _loop = None
+
+    @classmethod
+    def _declared_ports(cls):
+        """
+        :return: list of (attribute name, IN or OUT declaration) of the component class ports
+        """
+        return list(cls._port_table.items())
+
+    @classmethod
+    def port_table(cls):
+        """
+        Get the ports declared by the component class (computed once per class, see ComponentMeta)
+        :return: dict of IN or OUT declarations by port name
+        """
+        return cls._port_table
+
+    @classmethod
+    def port_index(cls):
+        """
+        Get the ports of the component class which can be connected: plain ports and array port elements
+        ('name[index]')
+        :return: dict of IN or OUT declarations by port name
+        """
+        return cls._port_index
 
     def __new__(cls, name=None, loop=None):
         instance = super().__new__(cls)
-        for attr_name in dir(cls):
-            attr = getattr(cls, attr_name)
-            if isinstance(attr, IN):
-                setattr(instance, attr_name, InputPort(attr_name, instance, attr.description, attr.display_name, loop))
-            elif isinstance(attr, OUT):
-                setattr(instance, attr_name, OutputPort(attr_name, instance, attr.description, attr.display_name, loop))
+        # Ports are created on first use (see PortDeclaration), input ports are listed here
+        instance._input_ports = []
         return instance
 
+    def _create_port(self, attr_name, attr):
+        if attr.array_size > 1:
+            port = tuple(self._new_port("%s[%d]" % (attr_name, index), attr) for index in range(attr.array_size))
+        else:
+            port = self._new_port(attr_name, attr)
+        # The instance attribute hides the declaration from now on
+        self.__dict__[attr_name] = port
+        return port
+
+    def _new_port(self, port_name, attr):
+        if isinstance(attr, IN):
+            port = InputPort(port_name, self, attr.description, attr.display_name, self._loop, ordered=attr.ordered)
+            port._idle = True
+            if self._scheduler is not None and port_name != '_command_in':
+                port._scheduler = self._scheduler
+                port._priority = self.priority
+            self._input_ports.append(port)
+            return port
+        limiter = TokenBucket(attr.rate, attr.burst, self._loop) if attr.rate else None
+        return OutputPort(port_name, self, attr.description, attr.display_name, self._loop, fanout=attr.fanout,
+                          copy_on_send=attr.copy_on_send, limiter=limiter)
+
     def __init__(self, name=None, loop=None):
         super().__init__()
-        self.logger = logging.getLogger(__name__)
         if loop:
             self._loop = loop
         else:
             self._loop = asyncio.get_event_loop()
-        self.machine = Machine(model=self, states=Component.states, transitions=Component.transitions, initial='new')
-        self.id = uuid4()
+        self.state = 'new'
+        self._id = None
         if name:
             self.name = name
         else:
             self.name = self._instance_name
-        asyncio.ensure_future(self._packet_loop(), loop=self._loop)
+        self._dispatch_slots = None
+        self._serial_dispatch = True
+        self._dispatch_tasks = set()
+        # Last dispatch task of each ordered port, when executor calls for the port overlap (see _schedule)
+        self._ordered_dispatch = dict()
+        self._executor = None
+        self._packet_task = None
+
+    @property
+    def id(self):
+        """
+        Component unique id, generated on first use
+        """
+        if self._id is None:
+            self._id = uuid4()
+        return self._id
+
+    def set_execution(self, execution, pool_size=None):
+        """
+        Change the component execution mode. Must be called before the component starts handling packets.
+        :param execution: one of EXECUTION_MODES
+        :param pool_size: number of threads or processes running on_packet
+        """
+        if execution not in EXECUTION_MODES:
+            raise ComponentException("Invalid execution mode '%s'" % execution)
+        if execution != EXECUTION_LOOP and asyncio.iscoroutinefunction(self.on_packet):
+            raise ComponentException("Component '%s' can't run in '%s' execution mode: on_packet is a coroutine" %
+                                     (self.__class__.__name__, execution))
+        self.execution = execution
+        if pool_size:
+            self.pool_size = pool_size
+
+    def get_port(self, port_name):
+        """
+        Get a port by name. Elements of array ports are named 'name[index]'.
+        :return: the port, or None if the component has no such port
+        """
+        name, index = split_port_name(port_name)
+        if index is None:
+            return getattr(self, name, None)
+        ports = getattr(self, name, None)
+        if isinstance(ports, tuple) and index < len(ports):
+            return ports[index]
+        return None
 
     def input_port(self, port_name):
-        return getattr(self, port_name, None)
+        return self.get_port(port_name)
 
     def output_port(self, port_name):
-        return getattr(self, port_name, None)
+        return self.get_port(port_name)
+
+    def _start_packet_loop(self):
+        """
+        Start one worker per input port. Workers read packets independently and share `concurrency` dispatch slots, so
+        a slow packet on one port doesn't prevent other ports (and commands) to be processed.
+        Called when packets first reach one of the input ports, so that components which never get packets (sources,
+        processes fed by a command bus...) don't run any task. Workers are started right away: they read the packets
+        on their first run.
+        """
+        if self._packet_task is not None:
+            return
+        # Every input port gets a worker: create the ones not used yet
+        for attr_name, attr in self._port_table.items():
+            if isinstance(attr, IN):
+                getattr(self, attr_name)
+        for port in self._input_ports:
+            port._idle = False
+        concurrency = self.concurrency
+        if self.execution != EXECUTION_LOOP and asyncio.iscoroutinefunction(self.on_packet):
+            self.logger.error("Process '%s': on_packet is a coroutine, it can't run in '%s' execution mode" %
+                              (self.name, self.execution))
+        elif self.execution != EXECUTION_LOOP:
+            self._executor = self._new_executor()
+            concurrency = max(concurrency, self.pool_size)
+        self._dispatch_slots = asyncio.Semaphore(concurrency)
+        self._serial_dispatch = concurrency == 1
+        workers = [asyncio.ensure_future(self._port_worker(port), loop=self._loop) for port in self._input_ports]
+        self._packet_task = asyncio.ensure_future(self._packet_loop(workers), loop=self._loop)
+
+    async def _packet_loop(self, workers):
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
 
-    async def _packet_loop(self):
+    async def _port_worker(self, port):
+        if port is self._command_in and self._command_bus is not None:
+            # Commands come from the bus, the command port is not read
+            return
+        if self.batch_size > 1 and port is not self._command_in:
+            await self._port_batch_worker(port)
+            return
         while True:
-            self._futures = []
-            self._futures.append(self._command_in.read_packet())
-            if self._futures:
-                done, pending = await asyncio.wait(self._futures, return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
-            if done:
-                task = done.pop()
-                input_port, packet = task.result()
-                if packet:
-                    if isinstance(packet, CommandPacket):
-                        await self._handle_command(packet)
-                    else:
-                        await self.on_packet(input_port, packet)
+            if self._barrier is not None:
+                await self._barrier.wait()
+            input_port, packet = await port.read_packet()
+            if packet is None:
+                self.logger.warning("Empty packet received")
+            elif isinstance(packet, CommandPacket):
+                await self._handle_command(packet)
+            elif packet.deadline is not None and packet.deadline < deadline_clock():
+                await self._expire([packet])
+            else:
+                await self._schedule(port, self._dispatch, input_port, packet)
+
+    async def _port_batch_worker(self, port):
+        while True:
+            if self._barrier is not None:
+                await self._barrier.wait()
+            input_port, packets = await port.read_batch(self.batch_size, self.batch_wait)
+            batch = []
+            expired = []
+            for packet in packets:
+                if isinstance(packet, CommandPacket):
+                    await self._handle_command(packet)
+                elif packet is None:
+                    continue
+                elif packet.deadline is not None and packet.deadline < deadline_clock():
+                    expired.append(packet)
                 else:
-                    self.logger.warning("Empty packet received")
+                    batch.append(packet)
+            if expired:
+                await self._expire(expired)
+            if batch:
+                await self._schedule(port, self._dispatch_batch, input_port, batch)
+
+    async def _schedule(self, port, dispatch, input_port, packets):
+        """
+        Run `dispatch(input_port, packets)` in a dispatch slot, once admitted by the scheduler. Dispatches for an ordered
+        port run one at a time, except in executor modes where they overlap and send the packets they emit after the
+        previous dispatch sent its own. The packets are counted as busy until the dispatch ends.
+        """
+        self._busy += 1
+        try:
+            scheduler = self._scheduler
+            if scheduler is not None and scheduler.preempts(self.priority):
+                await scheduler.admit(self.priority)
+            await self._dispatch_slots.acquire()
+        except asyncio.CancelledError:
+            self._release_busy()
+            raise
+        if self._serial_dispatch or (port.ordered and self._executor is None):
+            try:
+                await dispatch(input_port, packets)
+            finally:
+                self._dispatch_slots.release()
+                self._release_busy()
+            return
+        if port.ordered:
+            previous = self._ordered_dispatch.get(port.name)
+            task = asyncio.ensure_future(dispatch(input_port, packets, previous), loop=self._loop)
+            self._ordered_dispatch[port.name] = task
+        else:
+            task = asyncio.ensure_future(dispatch(input_port, packets), loop=self._loop)
+        self._dispatch_tasks.add(task)
+        task.add_done_callback(self._dispatch_done)
+
+    async def _expire(self, packets):
+        """
+        Send packets past their deadline to the expired port, or drop them if it isn't connected. Packets sent have their
+        deadline cleared, so that the processes they are diverted to handle them.
+        """
+        self.expired += len(packets)
+        if not self._expired_out.connections:
+            return
+        for packet in packets:
+            packet.deadline = None
+        self._busy += 1
+        try:
+            await self._expired_out.send_batch(packets)
+        finally:
+            self._release_busy()
+
+    def _dispatch_done(self, task):
+        self._dispatch_tasks.discard(task)
+        self._dispatch_slots.release()
+        self._release_busy()
+
+    def _release_busy(self):
+        self._busy -= 1
+        if not self._busy and self._idle_event is not None:
+            self._idle_event.set()
+
+    async def _wait_idle(self):
+        """
+        Wait until the component has handled all the packets it has read
+        """
+        while self._busy:
+            if self._idle_event is None:
+                self._idle_event = asyncio.Event()
+            self._idle_event.clear()
+            await self._idle_event.wait()
+
+    async def _dispatch(self, input_port, packet, previous=None):
+        try:
+            if self._executor is None:
+                await self.on_packet(input_port, packet)
+            else:
+                await self._dispatch_executor(input_port, [packet], previous)
+        except Exception:
+            self.logger.exception("Process '%s' failed to handle packet from port '%s'" % (self.name, input_port.name))
+
+    async def _dispatch_batch(self, input_port, packets, previous=None):
+        try:
+            if self._executor is None:
+                await self.on_batch(input_port, packets)
+            else:
+                await self._dispatch_executor(input_port, packets, previous)
+        except Exception:
+            self.logger.exception("Process '%s' failed to handle batch from port '%s'" % (self.name, input_port.name))
+
+    def _new_executor(self):
+        if self.execution == EXECUTION_THREAD:
+            return ThreadPoolExecutor(self.pool_size)
+        return ProcessPoolExecutor(self.pool_size, initializer=_init_detached_component,
+                                   initargs=(self.__class__, self._detached_state()))
+
+    def _detached_state(self):
+        """
+        :return: instance attributes given to the component copy used by process pool workers
+        """
+        state = dict()
+        for key, value in self.__dict__.items():
+            if key in _RUNTIME_ATTRIBUTES or isinstance(value, Port) or callable(value):
+                continue
+            state[key] = value
+        return state
+
+    async def _dispatch_executor(self, input_port, packets, previous=None):
+        """
+        Run on_packet in the component executor, then send the packets it emitted. The dispatch slot is held until
+        all emitted packets are accepted by output ports, so backpressure is kept.
+        :param previous: dispatch task which must have sent its packets first (ordered ports)
+        """
+        if self.execution == EXECUTION_THREAD:
+            outbox = await self._loop.run_in_executor(self._executor, self._execute, input_port.name, packets)
+        else:
+            outbox = await self._loop.run_in_executor(self._executor, _execute_detached, input_port.name, packets)
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        for port_name, packet in outbox:
+            await self.get_port(port_name).send_packet(packet)
+
+    def _execute(self, port_name, packets):
+        outbox = []
+        _executor_context.outbox = outbox
+        try:
+            from_port = self.get_port(port_name)
+            for packet in packets:
+                self.on_packet(from_port, packet)
+        finally:
+            _executor_context.outbox = None
+        return outbox
+
+    def emit(self, port, packet):
+        """
+        Send a packet from on_packet running in thread or process execution mode. Packets are sent on the event loop,
+        in order, once on_packet returns.
+        :param port: output port (or port name)
+        :param packet: packet to send
+        """
+        outbox = getattr(_executor_context, 'outbox', None)
+        if outbox is None:
+            raise ComponentException("emit() can only be called from on_packet in thread or process execution mode")
+        outbox.append((port if isinstance(port, str) else port.name, packet))
+
+    def close(self):
+        """
+        Stop handling packets and release resources held by the component
+        """
+        for port in self._input_ports:
+            port._idle = False
+        if self._packet_task is not None:
+            self._packet_task.cancel()
+        for task in list(self._dispatch_tasks):
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def report_metrics(self):
+        """
+        Send the component metrics as a METRICS command packet on the status port
+        """
+        if self.metrics is None or not self._status_out.connections:
+            return
+        await self._status_out.send_packet(CommandPacket(METRICS, {'process': self.name,
+                                                                   'metrics': self.metrics.snapshot()}))
 
     async def _handle_command(self, packet: CommandPacket):
+        try:
+            self._apply_command(packet)
+        except Exception:
+            self.logger.exception("Process '%s': command '%s' failed" % (self.name, packet.command))
+
+    def _receive_command(self, version, packet):
+        """
+        Apply a command published on the command bus
+        """
+        try:
+            self._apply_command(packet)
+        except Exception:
+            self.logger.exception("Process '%s': command '%s' failed" % (self.name, packet.command))
+        self.command_version = version
+
+    def _handle_command_barrier(self, packet):
+        if self._barrier is None:
+            self._barrier = asyncio.Event()
+
+    def _handle_command_resume(self, packet):
+        barrier = self._barrier
+        if barrier is not None:
+            self._barrier = None
+            barrier.set()
+
+    def snapshot_state(self):
+        """
+        Get the component state saved by engine checkpoints (see GraphEngine.checkpoint). It is called while the
+        component doesn't handle any packet. Stateful components override it, the default implementation saves nothing.
+        :return: picklable state, or None if there is nothing to save
+        """
+        return None
+
+    def restore_state(self, state):
+        """
+        Restore the state returned by snapshot_state when the engine restores a checkpoint
+        :param state: saved state
+        """
+        pass
+
+    def _apply_command(self, packet):
         if not packet.command:
             self.logger.warning("Invalid command packet received")
             return
-        func_name = '_handle_command_' + packet.command
-        try:
-            func = getattr(self, func_name)
-            func(packet)
-        except AttributeError:
+        func = getattr(self, '_handle_command_' + packet.command, None)
+        if func is None:
             self.logger.warning("Command '%s' ignored (no handler)" % packet.command)
+            return
+        func(packet)
 
     async def on_packet(self, from_port: InputPort, packet: Packet):
         pass
 
+    async def on_batch(self, from_port: InputPort, packets: list):
+        """
+        Handle a batch of packets read from a port (see batch_size). Default implementation hands packets one by one to
+        on_packet.
+        """
+        for packet in packets:
+            await self.on_packet(from_port, packet)
+
+
+StateTable(Component.states, Component.transitions).install(Component)
+
 
 def new_component_instance(component, name) -> Component:
     """
@@ -232,17 +1271,7 @@ def new_component_instance(component, name) -> Component:
     :param name: optional name to give to the process
     :return: the component instance (the process)
     """
-    try:
-        module_name, class_name = component.rsplit(".", 1)
-        component_class = getattr(importlib.import_module(module_name), class_name)
-    except ValueError:
-        raise ComponentException("Invalid component format name '%s'" % component)
-    except AttributeError:
-        raise ComponentException("Component '%s' not found in module '%s'" % (class_name, module_name))
-    except ImportError:
-        raise ComponentException("Module '%s' can't be imported" % module_name)
-
-    return new_process(name, component_class)
+    return new_process(name, get_component_class(component))
 
 
 def new_process(name, component_class):
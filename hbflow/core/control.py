@@ -0,0 +1,137 @@
+import asyncio
+import logging
+from collections import namedtuple, deque
+from .packet import CommandPacket
+
+# Number of commands kept in the bus log
+LOG_SIZE = 256
+
+CommandEntry = namedtuple('CommandEntry', ['version', 'packet', 'processes', 'groups'])
+
+
+class CommandBus:
+    """
+    Control plane of an engine: commands are published once on the bus, which hands them to every targeted process.
+    Commands are numbered by a version, incremented on each publication, and the last LOG_SIZE ones are kept in `log`.
+    Processes of the engine subscribe to the bus (see Component.command_version for the last version applied by a
+    process). Command handlers are synchronous: a local process acknowledges a command as soon as its handler
+    returned. Commands targeting other groups are handed to the group forwarder (see add_group), which acknowledges
+    them on behalf of the group processes once they have been applied in the group worker.
+    """
+    def __init__(self, process_groups, group=None, loop=None):
+        """
+        :param process_groups: group of each process of the graph, by process name
+        :param group: group of the processes subscribing to this bus
+        """
+        self.logger = logging.getLogger(__name__)
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.group = group
+        self.version = 0
+        self.log = deque(maxlen=LOG_SIZE)
+        self._process_groups = process_groups
+        self._subscribers = dict()
+        self._forwarders = dict()
+        # version -> (names of processes which didn't acknowledge the command yet, future set once they all did)
+        self._pending = dict()
+
+    def subscribe(self, component):
+        self._subscribers[component.name] = component
+        component._command_bus = self
+
+    def unsubscribe(self, process_name):
+        component = self._subscribers.pop(process_name, None)
+        if component is not None:
+            component._command_bus = None
+        for version in list(self._pending):
+            self.acknowledge(version, (process_name,))
+
+    def add_group(self, group, forward):
+        """
+        Forward commands targeting processes of another group
+        :param group: group name
+        :param forward: callable forwarding a CommandEntry to the group
+        """
+        self._forwarders[group] = forward
+
+    def remove_group(self, group):
+        self._forwarders.pop(group, None)
+        for version in list(self._pending):
+            self.acknowledge(version, [name for name, process_group in self._process_groups.items()
+                                       if process_group == group])
+
+    def targets(self, processes=None, groups=None):
+        """
+        :return: names of the subscribed or forwarded processes targeted by processes and groups
+        """
+        if processes is None:
+            candidates = self._process_groups.items()
+        else:
+            candidates = ((name, self._process_groups.get(name)) for name in processes)
+        if groups is not None:
+            candidates = [(name, group) for name, group in candidates if group in groups]
+        return [name for name, group in candidates
+                if name in self._subscribers or (group != self.group and group in self._forwarders)]
+
+    def publish(self, command, args=None, processes=None, groups=None):
+        """
+        Send a command to processes. Without processes nor groups, all the processes of the graph are targeted.
+        :param command: command name
+        :param args: command arguments
+        :param processes: names of the targeted processes
+        :param groups: groups of the targeted processes
+        :return: command version, to wait for acknowledgements with wait_acknowledged()
+        """
+        self.version += 1
+        entry = CommandEntry(self.version, CommandPacket(command, args), processes, groups)
+        self.log.append(entry)
+        targets = self.targets(processes, groups)
+        if not targets:
+            return entry.version
+        self._pending[entry.version] = (set(targets), self._loop.create_future())
+        acknowledged = []
+        remote_groups = set()
+        for name in targets:
+            component = self._subscribers.get(name)
+            if component is None:
+                remote_groups.add(self._process_groups.get(name))
+            else:
+                component._receive_command(entry.version, entry.packet)
+                acknowledged.append(name)
+        for group in remote_groups:
+            self._forwarders[group](entry)
+        self.acknowledge(entry.version, acknowledged)
+        return entry.version
+
+    def acknowledge(self, version, process_names):
+        """
+        Record that processes applied a command
+        """
+        pending = self._pending.get(version)
+        if pending is None:
+            return
+        waiting, future = pending
+        waiting.difference_update(process_names)
+        if not waiting:
+            del self._pending[version]
+            if not future.done():
+                future.set_result(None)
+
+    async def wait_acknowledged(self, version, timeout=None):
+        """
+        Wait until all the processes targeted by a command acknowledged it
+        :param version: command version, as returned by publish()
+        :param timeout: maximum time to wait, in seconds
+        :return: set of the names of processes which didn't acknowledge the command (empty when all did)
+        """
+        pending = self._pending.get(version)
+        if pending is None:
+            return set()
+        waiting, future = pending
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return set(waiting)
+        return set()
@@ -1,26 +1,47 @@
+import gc
 import logging
 import asyncio
+import multiprocessing
 from transitions import Machine
-from .component import new_component_instance, ComponentException, Component, OUT, IN
-from .graph import Graph, Connection, GraphException
-from .packet import CommandPacket
+from .component import new_process, get_component_class, ComponentException, Component, OUT, IN, \
+    FusedConnection, EXECUTION_LOOP
+from .graph import Connection, GraphException, ProcessDesc, ConnectionDesc, connection_key
+from .buffer import BufferException, PacketBuffer, PriorityBuffer, DEFAULT_CAPACITY
 from .commands import *
+from .channel import new_channel, ChannelException
+from .compiler import GraphPlan, compile_graph, load_plan
+from .worker import GroupWorker
+from .metrics import InstrumentedConnection, instrument_component
+from .flow import FlowController, TokenBucket, FlowException
+from .control import CommandBus
+from .partition import Partitioner, MergeConnection
+from .checkpoint import Checkpoint, save_checkpoint, load_checkpoint
+from .profiling import Profiler, ProfiledConnection, ProfilingException
+from .scheduler import Scheduler, TIME_SLICE
+from .graph import PARTITION_SPLIT
 
 
 class EngineException(Exception):
     pass
 
 
+# Time given to connections removed from a running graph to deliver their queued packets
+DRAIN_TIMEOUT = 5
+# Maximum number of consecutive fused connections. Fused chains run as nested calls, this bounds the stack depth.
+MAX_FUSED_CHAIN = 64
+
+
 class ProcessManager(Component):
 
-    command_out = OUT()
     status_in = IN()
 
     def __init__(self, name=None):
         super().__init__(name)
+        # Last metrics reported by each process, by process name
+        self.metrics_reports = dict()
 
-    async def send_command(self, command):
-        await  self.command_out.send_packet(CommandPacket(command))
+    def _handle_command_metrics(self, packet):
+        self.metrics_reports[packet.args['process']] = packet.args['metrics']
 
 
 class GraphEngine:
@@ -36,139 +57,794 @@ class GraphEngine:
         {'trigger': 'shutdown', 'source': 'stopped', 'dest': 'shutdown'},
     ]
 
-    def __init__(self, graph=None, loop=None):
+    def __init__(self, graph=None, loop=None, group=None, channels=None, mp_context=None, metrics=False,
+                 metrics_interval=None, fusion=True, latency_target=None, buffer_budget=None, profile=None,
+                 profile_processes=None, time_slice=TIME_SLICE):
+        """
+        :param graph: graph to bind the engine to
+        :param loop: event loop running the processes
+        :param group: group of processes run by this engine. The root engine (group None) runs processes without group
+        and starts one worker process per other group of the graph.
+        :param channels: channels carrying connections crossing groups, given by the root engine to worker engines
+        :param mp_context: multiprocessing start method used for worker processes (see multiprocessing.get_context)
+        :param metrics: instrument connections and processes (see metrics_snapshot). Instrumentation is chosen when
+        the engine binds the graph, so an engine without metrics runs uninstrumented code.
+        :param metrics_interval: when metrics are enabled, interval in seconds between METRICS status packets sent by
+        processes to the process manager
+        :param fusion: fuse chains of fusable components (see Component.fusable)
+        :param latency_target: end-to-end latency target in seconds. Connection capacities are then adapted to their
+        throughput to hold the target (see hbflow.core.flow.FlowController)
+        :param buffer_budget: maximum number of packets held by the engine connections, enforced by adapting their
+        capacities
+        :param profile: profiling mode, one of hbflow.core.profiling.PROFILE_MODES (see profile_report). Like metrics,
+        profiling is chosen when the engine binds the graph.
+        :param profile_processes: names of the processes profiled with cProfile or sampled (all if None)
+        :param time_slice: longest time a process is held back by processes of higher priority before handling a
+        packet. Processes are scheduled by priority as soon as one of them has a priority (see
+        hbflow.core.scheduler.Scheduler).
+        """
         self.logger = logging.getLogger(__name__)
         self.state = Machine(states=GraphEngine.states, transitions=GraphEngine.transitions, initial='new')
         if loop:
             self._loop = loop
         else:
             self._loop = asyncio.get_event_loop()
+        # Local processes by name, and connections by key (see connection_key). They are not keyed by id, so that
+        # binding a graph doesn't generate ids
         self.processes = dict()
         self.connections = dict()
+        # process name -> connections with the process manager
+        self._control_connections = dict()
+        # CommandBus carrying commands to processes, created when the engine binds a graph
+        self.commands = None
+        # Partitioners and ordered merges of replicated processes, and routing logs shared by them, by replicated
+        # process name
+        self._partitioners = dict()
+        self._merges = dict()
+        self._routings = dict()
         self._graph = None
+        self._plan = None
         self._process_manager = None
+        self.group = group
+        self.workers = dict()
+        self._channels = channels
+        self._process_groups = dict()
+        self._mp_context = mp_context
+        self.metrics = metrics
+        self.metrics_interval = metrics_interval
+        self._metrics_task = None
+        self.fusion = fusion
+        self.latency_target = latency_target
+        self.buffer_budget = buffer_budget
+        # FlowController, when a latency target or a buffer budget is given
+        self.flow = None
+        # Identifier of the last checkpoint taken or restored
+        self._checkpoint_id = 0
+        # Profiler, when a profiling mode is given
+        self.profiler = None
+        if profile:
+            try:
+                self.profiler = Profiler(profile, profile_processes)
+            except ProfilingException as pe:
+                raise EngineException("Invalid profiling mode '%s'" % profile) from pe
+        # Scheduler, when a process has a priority
+        self.scheduler = None
+        self.time_slice = time_slice
         if graph:
             self.bind(graph)
 
     async def bind(self, g):
         """
-        Bind the engine to a graph description and instantiates processes
-        :param g:
-        :return:
+        Bind the engine to a graph and instantiates processes
+        :param g: Graph instance, or GraphPlan compiled from a graph (see hbflow.core.compiler)
         """
         if not (self.state.is_new() or self.state.is_shutdown()):
             raise EngineException("Engine is already bounded to a graph instance")
-        self._graph = g
-        await self._init_graph()
-
-    async def init_from_dictionary(self, dict_spec: dict):
-        # Allow 'graph' as optional root
-        if 'graph' in dict_spec:
-            graph_config = dict_spec.get('graph')
-        else:
-            graph_config = dict_spec
-
-        name = graph_config.get('name', None)
-        description = graph_config.get('description', None)
-        author = graph_config.get('author', None)
-        date = graph_config.get('date', None)
-        graph = Graph(name, description, author, date)
-
-        processes = graph_config.get('processes', dict())
-        for process in processes:
-            component_name = processes[process].get('component', None)
-            if not component_name:
-                raise GraphException("No component class given for process '%s'", process)
-            graph.add_process(process, component_name)
-
-        connections = graph_config.get('connections')
-        for cnx in connections:
-            try:
-                source_component = cnx['source']['process']
-                source_port = cnx['source']['port']
-                target_component = cnx['target']['process']
-                target_port = cnx['target']['port']
-                cnx_capacity = cnx.get('capacity', 1) # TODO: don't hard-code, use default
-                cnx_name = cnx.get('name', None)
-            except KeyError as ke:
-                raise GraphException("Invalid parameters for connection '%s' definition" % cnx_name) from ke
-            graph.add_connection(cnx_name, source_component, source_port, target_component, target_port, cnx_capacity)
+        # Binding creates a few long lived objects per process and connection: garbage collections triggered while
+        # they are allocated would only scan them again and again
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if isinstance(g, GraphPlan):
+                self._plan = g
+            else:
+                self._plan = compile_graph(g)
+            # The engine graph follows live changes (see reconfigure), it must not change the graph given
+            self._graph = self._plan.graph.copy()
+            await self._init_graph()
+        finally:
+            if gc_enabled:
+                gc.enable()
 
-        await self.bind(graph)
+    async def init_from_dictionary(self, dict_spec: dict, cache_dir=None):
+        """
+        Bind the engine to a graph given as a dictionary specification
+        :param dict_spec: graph specification
+        :param cache_dir: directory where compiled plans are cached (see hbflow.core.compiler.load_plan)
+        """
+        await self.bind(load_plan(dict_spec, cache_dir))
 
-    def _get_process(self, process_name, silent=True):
+    def _get_process(self, process_name):
         """
-        Get a process by its name. Raises a GraphException if no process is found
-        :param self:
-        :param process_name:
-        :return:
+        Get a local process by its name
+        :param process_name: process name
+        :return: the process, or None if this engine doesn't run a process with this name
         """
-        return [p for p in self.processes.values() if p.name == process_name]
+        return self.processes.get(process_name)
 
     async def _init_processes(self):
+        debug = self.logger.isEnabledFor(logging.DEBUG)
         for proc_desc in self._graph.processes_desc:
+            if proc_desc.group != self.group:
+                continue
             try:
-                process = new_component_instance(proc_desc.class_name, proc_desc.process_name)
-                self.processes[process.id] = process
-                self.logger.debug("Process '%s' created (Id=%s)" % (process.name, process.id))
+                process = self._new_process(proc_desc, self._plan.component_class(proc_desc.process_name))
+                if debug:
+                    self.logger.debug("Process '%s' created" % process.name)
             except ComponentException as ce:
-                raise GraphException("Process '%s' instanciation failed" % process.name) from ce
+                raise GraphException("Process '%s' instanciation failed" % proc_desc.process_name) from ce
 
-    async def _init_connections(self):
-        for cnx_desc in self._graph.connections_desc:
+    def _new_process(self, proc_desc, component_class):
+        process = new_process(proc_desc.process_name, component_class)
+        if proc_desc.concurrency:
+            process.concurrency = proc_desc.concurrency
+        if proc_desc.execution or proc_desc.pool_size:
+            process.set_execution(proc_desc.execution or process.execution, proc_desc.pool_size)
+        if self.metrics:
+            instrument_component(process)
+        if proc_desc.priority is not None:
+            process.priority = proc_desc.priority
+        if self.profiler is not None:
+            self.profiler.instrument(process)
+        self.processes[process.name] = process
+        self._schedule_process(process)
+        return process
 
-            # find source : source process output port
-            source_port = None
-            try:
-                process_list = self._get_process(cnx_desc.source_process_name)
-                if len(process_list) > 1:
-                    raise GraphException("Can't create connection '%s': ambiguous process name '%s'" % (cnx_desc.connection_name, cnx_desc.source_process_name))
+    def _schedule_process(self, process):
+        """
+        Attach a process to the engine scheduler, created with the first process having a priority
+        """
+        if self.scheduler is None:
+            if not process.priority:
+                return
+            self.scheduler = Scheduler(self.time_slice, self._loop)
+            for other in self.processes.values():
+                self.scheduler.attach(other)
+        else:
+            self.scheduler.attach(process)
+
+    def _is_fusable(self, cnx_desc, port_connections):
+        """
+        Tell if a connection can be fused: it links two local processes with a single connection on both ports, has
+        the default buffer at capacity 1, and its target is a fusable component running on the event loop
+        """
+        source = self.processes.get(cnx_desc.source_process_name)
+        target = self.processes.get(cnx_desc.target_process_name)
+        return (cnx_desc.partition is None and source is not None and target is not None and target.fusable and
+                target.execution == EXECUTION_LOOP and target.batch_size == 1 and
+                cnx_desc.capacity == 1 and cnx_desc.buffer in (None, 'blocking') and
+                port_connections[(cnx_desc.source_process_name, cnx_desc.source_port_name)] == 1 and
+                port_connections[(cnx_desc.target_process_name, cnx_desc.target_port_name)] == 1)
+
+    def _fused_connections(self):
+        """
+        Find the connections to fuse. Chains of fusable connections are walked from their head and cut every
+        MAX_FUSED_CHAIN connections. Cycles made only of fusable connections are not fused.
+        :return: set of indexes of the connections to fuse
+        """
+        connections_desc = self._graph.connections_desc
+        port_connections = dict()
+        for cnx_desc in connections_desc:
+            for key in ((cnx_desc.source_process_name, cnx_desc.source_port_name),
+                        (cnx_desc.target_process_name, cnx_desc.target_port_name)):
+                port_connections[key] = port_connections.get(key, 0) + 1
+        # source process -> candidate connections leaving it, target process -> candidate connection entering it
+        outgoing = dict()
+        incoming = dict()
+        for index, cnx_desc in enumerate(connections_desc):
+            if self._is_fusable(cnx_desc, port_connections):
+                outgoing.setdefault(cnx_desc.source_process_name, []).append(index)
+                incoming[cnx_desc.target_process_name] = index
+        fused = set()
+        visited = set()
+        for source, indexes in outgoing.items():
+            if source in incoming:
+                # Not a chain head
+                continue
+            pending = [(index, 1) for index in indexes]
+            while pending:
+                index, depth = pending.pop()
+                if index in visited:
+                    continue
+                visited.add(index)
+                if depth > MAX_FUSED_CHAIN:
+                    depth = 0
                 else:
-                    source_process = process_list[0]
-                source_port = source_process.output_port(cnx_desc.source_port_name)
-            except GraphException as ge:
-                raise GraphException("Can't create connection '%s'" % cnx_desc.connection_name) from ge
-            if not source_port:
-                raise GraphException("Can't create connection '%s' : Source process '%s' has no output port named '%s'" %
-                                     (cnx_desc.connection_name, source_process.name, cnx_desc.source_port_name))
-
-            # find target : target process input port
-            target_port = None
+                    fused.add(index)
+                target = connections_desc[index].target_process_name
+                pending.extend((next_index, depth + 1) for next_index in outgoing.get(target, ()))
+        return fused
+
+    async def _init_connections(self):
+        connection_class = self._connection_class()
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        processes = self.processes
+        fused = self._fused_connections() if self.fusion else ()
+        for index, cnx_desc in enumerate(self._graph.connections_desc):
+            # Processes of other groups are not in the index
+            source_process = processes.get(cnx_desc.source_process_name)
+            target_process = processes.get(cnx_desc.target_process_name)
+            if source_process is None and target_process is None:
+                continue
+            source_port = source_process.get_port(cnx_desc.source_port_name) if source_process else None
+            target_port = target_process.get_port(cnx_desc.target_port_name) if target_process else None
+            source_local = source_process is not None
+            target_local = target_process is not None
+
             try:
-                process_list = self._get_process(cnx_desc.target_process_name)
-                if len(process_list) > 1:
-                    raise GraphException("Can't create connection '%s': ambiguous process name '%s'" % (cnx_desc.connection_name, cnx_desc.target_process_name))
+                if index in fused:
+                    cnx = FusedConnection(cnx_desc.connection_name, loop=self._loop)
+                elif source_local and target_local:
+                    cnx = connection_class(cnx_desc.connection_name, cnx_desc.capacity, buffer=cnx_desc.buffer, loop=self._loop,
+                                           buffer_options=cnx_desc.buffer_options)
+                elif source_local:
+                    cnx = self._channels[index].open_writer(cnx_desc.connection_name, cnx_desc.capacity, cnx_desc.buffer, self._loop)
                 else:
-                    target_process = process_list[0]
-                target_port = target_process.input_port(cnx_desc.target_port_name)
-            except GraphException as ge:
-                raise GraphException("Can't create connection '%s'" % cnx_desc.connection_name) from ge
-            if not target_port:
-                raise GraphException("Can't create connection '%s' : Target process '%s' has no input port named '%s'" %
-                                     (cnx_desc.connection_name, target_process.name, cnx_desc.target_port_name))
-
-            cnx = Connection(cnx_desc.connection_name)
+                    cnx = self._channels[index].open_reader(cnx_desc.connection_name, cnx_desc.capacity, cnx_desc.buffer, self._loop,
+                                                            buffer_options=cnx_desc.buffer_options)
+            except BufferException as be:
+                raise GraphException("Can't create connection '%s'" % cnx_desc.connection_name) from be
+            if cnx_desc.partition is None:
+                cnx.link(source_port, target_port)
+            else:
+                self._link_partition(cnx, cnx_desc, source_port, target_port)
+            self._register_connection(cnx, cnx_desc)
+            if debug:
+                self.logger.debug("Connection '%s' created" % cnx_desc.connection_name)
+
+    def _connection_class(self):
+        if self.profiler is not None:
+            return ProfiledConnection
+        return InstrumentedConnection if self.metrics else Connection
+
+    def _link_partition(self, cnx, cnx_desc, source_port, target_port):
+        """
+        Link a connection to or from a replica of a replicated process. Connections to the replicas get their packets
+        from a partitioner shared by the replicas, connections from them go through an ordered merge.
+        """
+        partition = cnx_desc.partition
+        routings = self._routings.setdefault(partition.process_name, [])
+        if partition.role == PARTITION_SPLIT:
+            if source_port is not None:
+                key = (cnx_desc.source_process_name, cnx_desc.source_port_name, partition.process_name)
+                partitioner = self._partitioners.get(key)
+                if partitioner is None:
+                    partitioner = Partitioner(source_port, partition.mode, partition.key, routings)
+                    source_port.add_connection(partitioner)
+                    self._partitioners[key] = partitioner
+                source_port = partitioner
             cnx.link(source_port, target_port)
-            self.connections[cnx.id] = cnx
-            self.logger.debug("Connection '%s' created" % cnx_desc.connection_name)
+            return
+        key = (partition.process_name, cnx_desc.target_process_name, cnx_desc.target_port_name)
+        merge = self._merges.get(key)
+        if merge is None:
+            merge = MergeConnection("%s>%s" % (partition.process_name, cnx_desc.target_process_name),
+                                    cnx_desc.capacity, loop=self._loop)
+            routings.append(merge.routing)
+            merge.link(None, target_port)
+            self._merges[key] = merge
+        cnx.link(source_port, merge)
+
+    def _register_connection(self, cnx, cnx_desc):
+        self.connections[connection_key(cnx_desc)] = cnx
+
+    def _init_channels(self):
+        """
+        Create the channels carrying connections between processes which belong to different groups
+        """
+        context = multiprocessing.get_context(self._mp_context)
+        self._channels = dict()
+        for index, cnx_desc in enumerate(self._graph.connections_desc):
+            source_group = self._process_groups.get(cnx_desc.source_process_name)
+            target_group = self._process_groups.get(cnx_desc.target_process_name)
+            if source_group != target_group:
+                try:
+                    self._channels[index] = new_channel(cnx_desc.transport, context, cnx_desc.capacity, cnx_desc.slot_size)
+                except ChannelException as ce:
+                    raise GraphException("Can't create connection '%s'" % cnx_desc.connection_name) from ce
+
+    async def _init_workers(self):
+        context = multiprocessing.get_context(self._mp_context)
+        groups = set(self._process_groups.values())
+        groups.discard(None)
+        connections_desc = self._graph.connections_desc
+        for group in sorted(groups):
+            channels = dict()
+            for index, channel in self._channels.items():
+                cnx_desc = connections_desc[index]
+                if group in (self._process_groups.get(cnx_desc.source_process_name),
+                             self._process_groups.get(cnx_desc.target_process_name)):
+                    channels[index] = channel
+            worker = GroupWorker(group, self._plan, channels, context, self._loop)
+            self.workers[group] = worker
+            await worker.start()
 
     async def _init_process_manager(self):
         self._process_manager = ProcessManager()
+        self.commands = CommandBus(self._process_groups, self.group, self._loop)
+        for worker in self.workers.values():
+            worker.attach(self.commands)
         for process in self.processes.values():
+            self._link_control(process)
+        if self.metrics and self.metrics_interval:
+            self._metrics_task = asyncio.ensure_future(self._report_metrics(), loop=self._loop)
+        if self.latency_target or self.buffer_budget:
+            self.flow = FlowController(self, self.latency_target, self.buffer_budget)
+            self.flow.start()
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def _link_control(self, process):
+        """
+        Subscribe a process to the command bus and, when metrics are enabled, connect its status port to the process
+        manager
+        """
+        self.commands.subscribe(process)
+        control = []
+        if self.metrics:
             cnx = Connection()
-            cnx.link(self._process_manager.command_out, process._command_in)
+            cnx.link(process._status_out, self._process_manager.status_in)
+            control.append(cnx)
+        self._control_connections[process.name] = control
 
     async def _init_graph(self):
         self.processes = dict()
         self.connections = dict()
+        self._control_connections = dict()
+        self._partitioners = dict()
+        self._merges = dict()
+        self._routings = dict()
+        self.scheduler = None
+        self._process_groups = dict(self._plan.groups)
         try:
+            if self.group is None:
+                self._init_channels()
+                await self._init_workers()
             await self._init_processes()
             await self._init_connections()
             await self._init_process_manager()
             self.state.resolve()
         except GraphException as ge:
             self.state.unresolve()
+            await self._stop_workers()
             raise ge
+        finally:
+            if self._channels:
+                for channel in self._channels.values():
+                    channel.close()
+
+    def _check_bound(self):
+        if self._process_manager is None:
+            raise EngineException("Engine is not bound to a graph")
+
+    def _local_process(self, process_name):
+        process = self.processes.get(process_name)
+        if process is None:
+            if process_name in self._process_groups:
+                raise EngineException("Process '%s' runs in group '%s', not in this engine" %
+                                      (process_name, self._process_groups[process_name]))
+            raise EngineException("Unknown process '%s'" % process_name)
+        return process
+
+    def _local_port(self, process_name, port_name, declaration):
+        process = self._local_process(process_name)
+        if not isinstance(process.port_index().get(port_name), declaration):
+            raise EngineException("Process '%s' has no %s port named '%s'" %
+                                  (process_name, 'output' if declaration is OUT else 'input', port_name))
+        return process.get_port(port_name)
+
+    @staticmethod
+    def _check_partition(cnx, key):
+        if isinstance(cnx.source, Partitioner) or isinstance(cnx.target, MergeConnection):
+            raise EngineException("Connection '%s' belongs to a replicated process, it can't be changed" % (key,))
+
+    def _get_connection(self, key):
+        cnx = self.connections.get(key)
+        if cnx is None:
+            raise EngineException("Unknown connection '%s'" % (key,))
+        if cnx.source is None or cnx.target is None:
+            raise EngineException("Connection '%s' crosses process groups, it can't be changed" % (key,))
+        self._check_partition(cnx, key)
+        return cnx
+
+    def set_rate_limit(self, process_name, port_name, rate, burst=None):
+        """
+        Limit the rate at which a process sends packets on an output port
+        :param process_name: process name
+        :param port_name: output port name
+        :param rate: maximum average rate in packets per second (None to remove the limit)
+        :param burst: maximum number of packets sent at once (see hbflow.core.flow.TokenBucket)
+        """
+        self._check_bound()
+        port = self._local_port(process_name, port_name, OUT)
+        try:
+            port.limiter = TokenBucket(rate, burst, self._loop) if rate is not None else None
+        except FlowException as fe:
+            raise EngineException("Can't limit rate of port '%s' of process '%s'" % (port_name, process_name)) from fe
+
+    async def add_process(self, process_name, component, concurrency=None, execution=None, pool_size=None,
+                          priority=None):
+        """
+        Add a process to the bound graph. The process runs in this engine.
+        :param process_name: process name, unique in the graph
+        :param component: component class name (module_name.class_name)
+        """
+        self._check_bound()
+        if process_name in self._process_groups:
+            raise EngineException("Process '%s' already exists" % process_name)
+        await self._add_process(ProcessDesc(process_name, component, self.group, concurrency, execution, pool_size,
+                                            priority=priority))
+
+    async def _add_process(self, proc_desc):
+        try:
+            process = self._new_process(proc_desc, get_component_class(proc_desc.class_name))
+        except ComponentException as ce:
+            raise EngineException("Can't add process '%s'" % proc_desc.process_name) from ce
+        self._link_control(process)
+        self._process_groups[proc_desc.process_name] = proc_desc.group
+        self._graph.add_process_desc(proc_desc)
+        self.logger.debug("Process '%s' added" % proc_desc.process_name)
+
+    async def remove_process(self, process_name, drain=True, timeout=DRAIN_TIMEOUT):
+        """
+        Remove a process and its connections from the bound graph.
+        :param process_name: process name
+        :param drain: let connections deliver their queued packets before they are removed (see remove_connection)
+        :param timeout: maximum time given to each connection to drain
+        """
+        self._check_bound()
+        process = self._local_process(process_name)
+        keys = [key for key, cnx_desc in self._graph.connections.items()
+                if process_name in (cnx_desc.source_process_name, cnx_desc.target_process_name) and
+                key in self.connections]
+        for key in keys:
+            self._check_partition(self.connections[key], key)
+        for key in keys:
+            await self._remove_connection(key, drain, timeout)
+        for cnx in self._control_connections.pop(process_name, ()):
+            cnx.unlink()
+        self.commands.unsubscribe(process_name)
+        if self.scheduler is not None:
+            self.scheduler.detach(process)
+        process.close()
+        del self.processes[process_name]
+        del self._process_groups[process_name]
+        self._graph.remove_process(process_name)
+        self.logger.debug("Process '%s' removed" % process_name)
 
-    async def start(self):
-        await self._process_manager.send_command(START)
+    async def add_connection(self, connection_name, source_process_name, source_port_name, target_process_name,
+                             target_port_name, capacity=DEFAULT_CAPACITY, buffer=None, buffer_options=None):
+        """
+        Add a connection between two processes of the bound graph
+        """
+        self._check_bound()
+        await self._add_connection(ConnectionDesc(connection_name, source_process_name, source_port_name,
+                                                  target_process_name, target_port_name, capacity, buffer, None, None,
+                                                  buffer_options=buffer_options))
+
+    async def _add_connection(self, cnx_desc):
+        key = connection_key(cnx_desc)
+        if key in self.connections:
+            raise EngineException("Connection '%s' already exists" % (key,))
+        if cnx_desc.partition is not None:
+            raise EngineException("Connection '%s' belongs to a replicated process, it can't be added" % (key,))
+        source_port = self._local_port(cnx_desc.source_process_name, cnx_desc.source_port_name, OUT)
+        target_port = self._local_port(cnx_desc.target_process_name, cnx_desc.target_port_name, IN)
+        connection_class = self._connection_class()
+        try:
+            cnx = connection_class(cnx_desc.connection_name, cnx_desc.capacity, buffer=cnx_desc.buffer,
+                                   loop=self._loop, buffer_options=cnx_desc.buffer_options)
+        except BufferException as be:
+            raise EngineException("Can't add connection '%s'" % (key,)) from be
+        cnx.link(source_port, target_port)
+        self._register_connection(cnx, cnx_desc)
+        self._graph.add_connection_desc(cnx_desc)
+        self.logger.debug("Connection '%s' added" % (key,))
+
+    async def remove_connection(self, key, drain=True, timeout=DRAIN_TIMEOUT):
+        """
+        Remove a connection from the bound graph. The connection is first detached from its source so that no packet
+        is sent to it anymore. When drain is set, packets queued in the connection are then delivered to the target
+        before the connection is removed, otherwise they are dropped.
+        :param key: connection name, or (source process, source port, target process, target port) for unnamed
+        connections
+        :param drain: deliver queued packets before removing the connection
+        :param timeout: maximum time to wait for queued packets to be delivered
+        """
+        self._check_bound()
+        self._get_connection(key)
+        await self._remove_connection(key, drain, timeout)
+
+    async def _remove_connection(self, key, drain, timeout):
+        cnx = self.connections.pop(key)
+        if cnx.source is not None:
+            cnx.source.remove_connection(cnx)
+            cnx.source = None
+        if drain and cnx.packet_queue:
+            try:
+                await asyncio.wait_for(cnx.packet_queue.wait_empty(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if cnx.packet_queue:
+            self.logger.warning("Connection '%s' removed with %d queued packets" % (key, len(cnx.packet_queue)))
+        cnx.unlink()
+        cnx.close()
+        self._graph.remove_connection(key)
+        self.logger.debug("Connection '%s' removed" % (key,))
+
+    async def redirect_connection(self, key, source_process_name=None, source_port_name=None,
+                                  target_process_name=None, target_port_name=None):
+        """
+        Move one or both ends of a connection of the bound graph. Packets queued in the connection are kept and
+        delivered to the new target.
+        """
+        self._check_bound()
+        self._get_connection(key)
+        cnx_desc = self._graph.connections[key]
+        await self._redirect_connection(key, cnx_desc._replace(
+            source_process_name=source_process_name or cnx_desc.source_process_name,
+            source_port_name=source_port_name or cnx_desc.source_port_name,
+            target_process_name=target_process_name or cnx_desc.target_process_name,
+            target_port_name=target_port_name or cnx_desc.target_port_name))
+
+    async def _redirect_connection(self, old_key, cnx_desc):
+        cnx = self.connections[old_key]
+        source_port = self._local_port(cnx_desc.source_process_name, cnx_desc.source_port_name, OUT)
+        target_port = self._local_port(cnx_desc.target_process_name, cnx_desc.target_port_name, IN)
+        cnx.redirect(source_port, target_port)
+        key = connection_key(cnx_desc)
+        if key != old_key:
+            # Unnamed connections are keyed by their ends
+            del self.connections[old_key]
+            self.connections[key] = cnx
+        self._graph.replace_connection(old_key, cnx_desc)
+        self.logger.debug("Connection '%s' redirected" % (key,))
+
+    async def apply_diff(self, diff, drain=True, timeout=DRAIN_TIMEOUT):
+        """
+        Apply changes to the bound graph (see Graph.diff). Only the processes and connections listed in the diff are
+        touched: removed connections are drained (see remove_connection), redirected connections keep their queued
+        packets.
+        :param diff: GraphDiff
+        """
+        self._check_bound()
+        for proc_desc in diff.added_processes:
+            if proc_desc.group != self.group:
+                raise EngineException("Process '%s' of group '%s' can't be added to a running graph" %
+                                      (proc_desc.process_name, proc_desc.group))
+        added = set(p.process_name for p in diff.added_processes)
+        for key in diff.removed_connections:
+            self._get_connection(key)
+            await self._remove_connection(key, drain, timeout)
+        # Replaced processes go before their new version is added, other removed processes go once connections
+        # have been redirected away from them
+        for process_name in diff.removed_processes:
+            if process_name in added:
+                await self.remove_process(process_name, drain, timeout)
+        for proc_desc in diff.added_processes:
+            await self._add_process(proc_desc)
+        for cnx_desc in diff.redirected_connections:
+            key = connection_key(cnx_desc)
+            self._get_connection(key)
+            await self._redirect_connection(key, cnx_desc)
+        for cnx_desc in diff.added_connections:
+            await self._add_connection(cnx_desc)
+        for process_name in diff.removed_processes:
+            if process_name not in added:
+                await self.remove_process(process_name, drain, timeout)
+
+    async def reconfigure(self, graph, drain=True, timeout=DRAIN_TIMEOUT):
+        """
+        Change the bound graph into another one, applying only the differences between them (see apply_diff)
+        :param graph: new graph, validated before any change is made
+        """
+        self._check_bound()
+        plan = compile_graph(graph)
+        await self.apply_diff(self._graph.diff(plan.graph), drain, timeout)
+        self._plan = plan
+        self._graph = plan.graph.copy()
+
+    async def _report_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            for process in list(self.processes.values()):
+                await process.report_metrics()
+
+    def metrics_snapshot(self):
+        """
+        Get the current metrics of the engine connections and processes.
+        :return: dict with 'connections' and 'processes' entries, giving metrics by connection and process name
+        """
+        if not self.metrics:
+            raise EngineException("Metrics are not enabled for this engine")
+        return {
+            'connections': dict((cnx.name, cnx.snapshot()) for cnx in self.connections.values()
+                                if isinstance(cnx, (InstrumentedConnection, FusedConnection))),
+            'processes': dict((process.name, process.metrics.snapshot()) for process in self.processes.values()),
+        }
+
+    def profile_report(self):
+        """
+        Get the profiling results of the engine processes and connections: wall and CPU time spent by processes
+        handling packets, residence time of packets in connections and the critical path of the graph, the path of
+        connections adding the most latency (see hbflow.core.profiling.Profiler)
+        :return: dict with 'processes', 'connections', 'critical_path' and 'samples' entries
+        """
+        if self.profiler is None:
+            raise EngineException("Profiling is not enabled for this engine")
+        return self.profiler.report(self.connections.values())
+
+    def export_profile(self, directory):
+        """
+        Write the profiling results to a directory: report, critical path, collapsed stacks for flame graphs and cProfile
+        statistics (see hbflow.core.profiling.Profiler.export)
+        :return: list of the written files paths
+        """
+        if self.profiler is None:
+            raise EngineException("Profiling is not enabled for this engine")
+        return self.profiler.export(directory, self.connections.values())
+
+    async def send_command(self, command, args=None, processes=None, groups=None):
+        """
+        Send a command to processes of the graph, including processes running in worker processes. The command is
+        published once on the engine command bus (see hbflow.core.control.CommandBus).
+        :param command: command name
+        :param args: command arguments
+        :param processes: names of the targeted processes (all processes if None)
+        :param groups: groups of the targeted processes (all groups if None)
+        :return: command version, to wait for acknowledgements with wait_acknowledged()
+        """
+        self._check_bound()
+        return self.commands.publish(command, args, processes, groups)
+
+    async def wait_acknowledged(self, version, timeout=None):
+        """
+        Wait until the processes targeted by a command have applied it
+        :param version: command version, as returned by send_command()
+        :param timeout: maximum time to wait, in seconds
+        :return: set of the names of processes which didn't acknowledge the command in time
+        """
+        self._check_bound()
+        return await self.commands.wait_acknowledged(version, timeout)
+
+    async def checkpoint(self, path=None, timeout=DRAIN_TIMEOUT):
+        """
+        Take a consistent snapshot of the packets queued in the engine connections and of the processes state (see
+        Component.snapshot_state).
+        The BARRIER command is published to all processes: each one stops reading packets once those it handles are
+        done. Meanwhile, bounded buffers are made unbounded so that processes waiting for room to send packets can
+        complete. As soon as no process handles any packet, queued packets and process states are captured (and
+        written to `path`), buffer capacities are restored and the RESUME command lets processes go on.
+        Packets in flight between groups can't be captured: only engines running all the graph processes take
+        checkpoints.
+        :param path: file the checkpoint is written to (see hbflow.core.checkpoint.save_checkpoint)
+        :param timeout: maximum time to wait for processes to complete the packets they handle
+        :return: Checkpoint instance, holding the queued packets themselves
+        """
+        self._check_bound()
+        if self.workers or self.group is not None:
+            raise EngineException("Checkpoints require all the graph processes to run in the engine")
+        self._checkpoint_id += 1
+        processes = list(self.processes.values())
+        queues = [cnx.packet_queue for cnx in self.connections.values()]
+        queues.extend(merge.packet_queue for merge in self._merges.values())
+        lifted = [(queue, queue.capacity) for queue in queues
+                  if type(queue) in (PacketBuffer, PriorityBuffer) and queue.capacity]
+        await self.send_command(BARRIER, {'checkpoint': self._checkpoint_id})
+        try:
+            for queue, capacity in lifted:
+                queue.set_capacity(None)
+            deadline = self._loop.time() + timeout
+            try:
+                # A process may get packets to handle again from the dispatch of another one
+                busy = [process for process in processes if process._busy]
+                while busy:
+                    await asyncio.wait_for(asyncio.gather(*(process._wait_idle() for process in busy)),
+                                           deadline - self._loop.time())
+                    busy = [process for process in processes if process._busy]
+            except asyncio.TimeoutError:
+                raise EngineException("Checkpoint %d failed: processes %s still handle packets" %
+                                      (self._checkpoint_id,
+                                       ', '.join(sorted(process.name for process in processes if process._busy))))
+            checkpoint = self._capture()
+            if path:
+                save_checkpoint(checkpoint, path)
+        finally:
+            for queue, capacity in lifted:
+                queue.set_capacity(capacity)
+            await self.send_command(RESUME)
+        self.logger.debug("Checkpoint %d taken" % self._checkpoint_id)
+        return checkpoint
+
+    def _capture(self):
+        connections = dict()
+        for key, cnx in self.connections.items():
+            queue = cnx.packet_queue
+            if len(queue):
+                connections[key] = list(queue)
+        merges = dict((key, (list(merge.packet_queue), list(merge.routing))) for key, merge in self._merges.items())
+        states = dict()
+        for process in self.processes.values():
+            state = process.snapshot_state()
+            if state is not None:
+                states[process.name] = state
+        return Checkpoint(self._checkpoint_id, connections, merges, states)
+
+    async def restore(self, checkpoint):
+        """
+        Restore a checkpoint taken by an engine running the same graph, before starting the engine: packets are
+        queued back in their connections, whatever their capacity, and processes state is restored (see
+        Component.restore_state). Packets of connections and processes the graph doesn't have anymore are dropped.
+        :param checkpoint: Checkpoint instance, or path of a checkpoint file (see checkpoint())
+        """
+        self._check_bound()
+        if isinstance(checkpoint, str):
+            checkpoint = load_checkpoint(checkpoint)
+        # Merge routings first: packets restored in replica connections are moved to the merges in routing order
+        for key, (packets, routing) in checkpoint.merges.items():
+            merge = self._merges.get(key)
+            if merge is None:
+                self.logger.warning("Checkpoint %d: unknown ordered merge %s, %d packets dropped" %
+                                    (checkpoint.checkpoint_id, key, len(packets)))
+                continue
+            merge.routing.extend(routing)
+            merge.load_packets(packets)
+        for key, packets in checkpoint.connections.items():
+            cnx = self.connections.get(key)
+            if cnx is None:
+                self.logger.warning("Checkpoint %d: unknown connection '%s', %d packets dropped" %
+                                    (checkpoint.checkpoint_id, key, len(packets)))
+                continue
+            cnx.load_packets(packets)
+        for process_name, state in checkpoint.processes.items():
+            process = self.processes.get(process_name)
+            if process is None:
+                self.logger.warning("Checkpoint %d: unknown process '%s', state dropped" %
+                                    (checkpoint.checkpoint_id, process_name))
+                continue
+            process.restore_state(state)
+        self._checkpoint_id = max(self._checkpoint_id, checkpoint.checkpoint_id)
+        self.logger.debug("Checkpoint %d restored" % checkpoint.checkpoint_id)
+
+    async def start(self, timeout=None):
+        """
+        Send the START command to all processes and wait until they all applied it
+        :param timeout: maximum time to wait for acknowledgements, in seconds
+        :return: set of the names of processes which didn't acknowledge the command in time
+        """
+        return await self.wait_acknowledged(await self.send_command(START), timeout)
+
+    async def _stop_workers(self):
+        for worker in self.workers.values():
+            if self.commands is not None:
+                self.commands.remove_group(worker.group)
+            await worker.stop()
+        self.workers = dict()
+
+    async def stop(self):
+        """
+        Stop worker processes and release connections resources
+        """
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self.flow is not None:
+            self.flow.stop()
+            self.flow = None
+        if self.profiler is not None:
+            self.profiler.stop()
+        await self._stop_workers()
+        for cnx in self.connections.values():
+            cnx.close()
+        for process in self.processes.values():
+            process.close()
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import math
+from .buffer import PacketBuffer
+
+# Interval in seconds between two capacity adjustments
+FLOW_INTERVAL = 0.1
+# Weight of the last throughput sample in the smoothed throughput of a connection
+SMOOTHING = 0.5
+# Bounds of the capacities set by the flow controller
+MIN_CAPACITY = 1
+MAX_CAPACITY = 65536
+# Tokens a rate limiter may accumulate by default, in seconds of rate
+BURST_WINDOW = 0.01
+
+
+class FlowException(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Rate limiter of an output port (see OutputPort.limiter): packets are sent at `rate` packets per second on average,
+    with bursts of up to `burst` packets. A batch larger than the burst is sent at once and the port then waits for
+    the tokens it borrowed.
+    """
+    __slots__ = ('rate', 'burst', '_tokens', '_stamp', '_loop')
+
+    def __init__(self, rate, burst=None, loop=None):
+        if not rate or rate <= 0:
+            raise FlowException("Invalid rate '%s'" % rate)
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.rate = rate
+        self.burst = burst or max(1, int(rate * BURST_WINDOW))
+        self._tokens = self.burst
+        self._stamp = self._loop.time()
+
+    async def acquire(self, count=1):
+        """
+        Take `count` tokens, waiting until the bucket has refilled if needed
+        """
+        now = self._loop.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate) - count
+        self._stamp = now
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def _path_length(connections):
+    """
+    :return: number of connections on the longest path going through the given connections (connections closing a
+    cycle are not counted)
+    """
+    outgoing = dict()
+    indegree = dict()
+    for cnx in connections:
+        source = cnx.source.component
+        target = cnx.target.component
+        outgoing.setdefault(source, []).append(target)
+        indegree.setdefault(source, 0)
+        indegree[target] = indegree.get(target, 0) + 1
+    level = dict((node, 0) for node, count in indegree.items() if count == 0)
+    ready = list(level)
+    while ready:
+        node = ready.pop()
+        for target in outgoing.get(node, ()):
+            level[target] = max(level.get(target, 0), level[node] + 1)
+            indegree[target] -= 1
+            if indegree[target] == 0:
+                ready.append(target)
+    return max(level.values(), default=0) or 1
+
+
+class FlowController:
+    """
+    Adaptive backpressure for the connections of an engine.
+    Bounded buffers already give credit based flow control between an output port and an input port: a packet is put
+    only when the buffer has free room, and each packet taken out by the target gives one credit back to the source.
+    The controller periodically measures the throughput of each connection (packets taken out of its buffer) and
+    sets its capacity, that is the number of credits of its source:
+      - with a latency target, the end-to-end latency is shared between the connections of the longest path of the
+        graph, and each connection gets the capacity it can deliver in its share (Little's law), so that a fast source
+        can't fill every buffer of a deep graph.
+      - with a buffer budget, the capacities are scaled down, proportionally, so that the engine connections don't
+        hold more than `buffer_budget` packets (each connection keeps at least `min_capacity`). Without latency
+        target, the budget is shared between connections according to their throughput.
+    Only connections with a bounded 'blocking' buffer linking two local processes are controlled.
+    """
+    def __init__(self, engine, latency_target=None, buffer_budget=None, interval=FLOW_INTERVAL,
+                 min_capacity=MIN_CAPACITY, max_capacity=MAX_CAPACITY):
+        """
+        :param engine: GraphEngine whose connections are controlled
+        :param latency_target: end-to-end latency target, in seconds
+        :param buffer_budget: maximum number of packets buffered by all the controlled connections
+        :param interval: interval in seconds between two adjustments
+        """
+        if not latency_target and not buffer_budget:
+            raise FlowException("Flow control requires a latency target or a buffer budget")
+        self.logger = logging.getLogger(__name__)
+        self._engine = engine
+        self.latency_target = latency_target
+        self.buffer_budget = buffer_budget
+        self.interval = interval
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        # connection id -> (delivered count at last adjustment, smoothed throughput)
+        self._stats = dict()
+        self._stamp = None
+        self._task = None
+
+    def start(self):
+        self._stamp = self._engine._loop.time()
+        self._task = asyncio.ensure_future(self._run(), loop=self._engine._loop)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = self._engine._loop.time()
+            self.adjust(now - self._stamp)
+            self._stamp = now
+
+    def controlled_connections(self):
+        """
+        :return: list of the engine connections whose capacity is controlled
+        """
+        return [cnx for cnx in self._engine.connections.values()
+                if cnx.source is not None and cnx.target is not None and cnx.capacity and
+                type(cnx.packet_queue) is PacketBuffer]
+
+    def adjust(self, elapsed):
+        """
+        Update connections throughput and capacity
+        :param elapsed: time in seconds since the last adjustment
+        """
+        connections = self.controlled_connections()
+        stats = dict()
+        rates = []
+        for cnx in connections:
+            delivered = cnx.packet_queue.delivered
+            previous = self._stats.get(cnx.id)
+            if previous is None or elapsed <= 0:
+                rate = previous[1] if previous else 0.0
+            else:
+                sample = (delivered - previous[0]) / elapsed
+                rate = previous[1] + SMOOTHING * (sample - previous[1])
+            stats[cnx.id] = (delivered, rate)
+            rates.append(rate)
+        self._stats = stats
+        if not connections:
+            return
+
+        if self.latency_target:
+            share = self.latency_target / _path_length(connections)
+            targets = [rate * share for rate in rates]
+        else:
+            total = sum(rates)
+            if total:
+                targets = [self.buffer_budget * rate / total for rate in rates]
+            else:
+                targets = [cnx.capacity for cnx in connections]
+        if self.buffer_budget:
+            total = sum(targets)
+            if total > self.buffer_budget:
+                scale = self.buffer_budget / total
+                targets = [target * scale for target in targets]
+
+        for cnx, target in zip(connections, targets):
+            capacity = min(self.max_capacity, max(self.min_capacity, int(math.ceil(target))))
+            if capacity != cnx.capacity:
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Connection '%s' capacity: %d -> %d" % (cnx.name, cnx.capacity, capacity))
+                cnx.set_capacity(capacity)
+
+    def snapshot(self):
+        """
+        :return: capacity and smoothed throughput (packets per second) of the controlled connections, by name
+        """
+        return dict((cnx.name, {'capacity': cnx.capacity, 'rate': self._stats.get(cnx.id, (0, 0.0))[1]})
+                    for cnx in self.controlled_connections())
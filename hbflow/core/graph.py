@@ -3,6 +3,7 @@ from datetime import datetime
 from hbflow.utils import IdentifiableObject
 from .component import get_component_class, OUT, IN, Connection, Component
 from collections import namedtuple
+import copy
 import logging
 
 
@@ -10,17 +11,54 @@ class GraphException(Exception):
     pass
 
 
-ProcessDesc = namedtuple('ProcessDesc', ['process_name', 'class_name', 'group'])
+class GraphValidationException(GraphException):
+    """
+    Raised when a graph description has errors. `errors` lists all the errors found.
+    """
+    def __init__(self, errors):
+        super().__init__("Invalid graph (%d error(s)):\n  %s" % (len(errors), "\n  ".join(errors)))
+        self.errors = errors
+
+
+# Replicated processes (replicas > 1) are expanded by the compiler into one process per replica (see
+# hbflow.core.compiler). Their group may then be a list, replicas being assigned to groups in turn.
+ProcessDesc = namedtuple('ProcessDesc', ['process_name', 'class_name', 'group', 'concurrency', 'execution', 'pool_size',
+                                         'replicas', 'partition', 'partition_key', 'merge', 'priority'],
+                         defaults=(None, None, None, None, None))
+# Connection buffer_options are given to the buffer policy (see hbflow.core.buffer.BUFFER_OPTIONS)
 ConnectionDesc = namedtuple('ConnectionDesc',
                             ['connection_name',
                              'source_process_name',
                              'source_port_name',
                              'target_process_name',
-                             'target_port_name', 'capacity'])
+                             'target_port_name', 'capacity', 'buffer', 'transport', 'slot_size', 'partition',
+                             'buffer_options'],
+                            defaults=(None, None))
+# Role of a connection expanded from a connection to or from a replicated process: 'split' connections go to replica
+# `index` of `process_name`, 'merge' connections come from it and are merged in order
+Partition = namedtuple('Partition', ['role', 'process_name', 'index', 'count', 'mode', 'key'])
+PARTITION_SPLIT = 'split'
+PARTITION_MERGE = 'merge'
+# Changes between two graphs (see Graph.diff): ProcessDesc lists, process names, ConnectionDesc lists and connection keys
+GraphDiff = namedtuple('GraphDiff', ['added_processes', 'removed_processes', 'added_connections',
+                                     'removed_connections', 'redirected_connections'])
 
 
-class Graph(IdentifiableObject):
+def connection_key(cnx_desc):
+    """
+    Key identifying a connection in a graph: its name, or its ends for unnamed connections
+    """
+    if cnx_desc.connection_name:
+        return cnx_desc.connection_name
+    return (cnx_desc.source_process_name, cnx_desc.source_port_name, cnx_desc.target_process_name,
+            cnx_desc.target_port_name)
+
 
+class Graph(IdentifiableObject):
+    """
+    Processes and connections of a graph. Descriptions are kept in dicts, in the order they were added: processes
+    by name and connections by key (see connection_key), so that graph changes cost the same whatever the graph size.
+    """
     def __init__(self, name=None, description=None, author=None, date=datetime.now()):
         super().__init__()
         self.logger = logging.getLogger(__name__)
@@ -30,11 +68,105 @@ class Graph(IdentifiableObject):
         self.author = author
         self.date = date
         self.id = uuid4()
-        self.processes_desc = []
-        self.connections_desc = []
+        # process name -> ProcessDesc
+        self.processes = dict()
+        # connection key -> ConnectionDesc
+        self.connections = dict()
+
+    @property
+    def processes_desc(self):
+        """
+        :return: list of the ProcessDesc of the graph
+        """
+        return list(self.processes.values())
+
+    @property
+    def connections_desc(self):
+        """
+        :return: list of the ConnectionDesc of the graph
+        """
+        return list(self.connections.values())
+
+    def add_process(self, process_name, component, group=None, concurrency=None, execution=None, pool_size=None,
+                    replicas=None, partition=None, partition_key=None, merge=None, priority=None):
+        self.add_process_desc(ProcessDesc(process_name, component, group, concurrency, execution, pool_size,
+                                          replicas, partition, partition_key, merge, priority))
+
+    def add_process_desc(self, proc_desc):
+        if proc_desc.process_name in self.processes:
+            raise GraphException("Duplicate process name '%s'" % proc_desc.process_name)
+        self.processes[proc_desc.process_name] = proc_desc
+
+    def add_connection(self, connection_name, source_process_name, source_port_name, target_process_name, target_port_name, capacity, buffer=None, transport=None, slot_size=None, buffer_options=None):
+        self.add_connection_desc(ConnectionDesc(connection_name, source_process_name, source_port_name, target_process_name, target_port_name, capacity, buffer, transport, slot_size, buffer_options=buffer_options))
+
+    def add_connection_desc(self, cnx_desc):
+        key = connection_key(cnx_desc)
+        if key in self.connections:
+            raise GraphException("Duplicate connection '%s'" % (key,))
+        self.connections[key] = cnx_desc
+
+    def copy(self):
+        """
+        :return: a copy of the graph, whose processes and connections can be changed independently
+        """
+        graph = copy.copy(self)
+        graph.processes = dict(self.processes)
+        graph.connections = dict(self.connections)
+        return graph
+
+    def remove_process(self, process_name):
+        self.processes.pop(process_name, None)
+
+    def remove_connection(self, key):
+        self.connections.pop(key, None)
+
+    def replace_connection(self, key, cnx_desc):
+        """
+        Replace the description of a connection. Its key changes with its ends when the connection is unnamed.
+        """
+        del self.connections[key]
+        self.connections[connection_key(cnx_desc)] = cnx_desc
 
-    def add_process(self, process_name, component, group=None):
-        self.processes_desc.append(ProcessDesc(process_name, component, group))
+    def diff(self, other):
+        """
+        Compute the changes turning this graph into another one.
+        Processes are matched by name: a process whose description changed is removed and added again (replaced), as
+        are its connections. Connections are matched by key (see connection_key): a connection whose ends changed is
+        redirected, a connection whose other parameters changed is removed and added again.
+        :param other: target graph
+        :return: GraphDiff
+        """
+        processes = self.processes
+        other_processes = other.processes
+        added_processes = [p for name, p in other_processes.items() if processes.get(name) != p]
+        removed_processes = [name for name, p in processes.items() if other_processes.get(name) != p]
+        # Processes removed and added again: their connections are created again too
+        replaced = set(removed_processes).intersection(p.process_name for p in added_processes)
 
-    def add_connection(self, connection_name, source_process_name, source_port_name, target_process_name, target_port_name, capacity):
-        self.connections_desc.append(ConnectionDesc(connection_name, source_process_name, source_port_name, target_process_name, target_port_name, capacity))
+        connections = self.connections
+        other_connections = other.connections
+        added_connections = []
+        removed_connections = []
+        redirected_connections = []
+        for key, cnx_desc in connections.items():
+            if key not in other_connections:
+                removed_connections.append(key)
+        for key, cnx_desc in other_connections.items():
+            current = connections.get(key)
+            if current == cnx_desc and not replaced.intersection((cnx_desc.source_process_name,
+                                                                  cnx_desc.target_process_name)):
+                continue
+            if current is None:
+                added_connections.append(cnx_desc)
+            elif (current._replace(source_process_name=None, source_port_name=None, target_process_name=None,
+                                   target_port_name=None) ==
+                  cnx_desc._replace(source_process_name=None, source_port_name=None, target_process_name=None,
+                                    target_port_name=None) and
+                  not replaced.intersection((current.source_process_name, current.target_process_name))):
+                redirected_connections.append(cnx_desc)
+            else:
+                removed_connections.append(key)
+                added_connections.append(cnx_desc)
+        return GraphDiff(added_processes, removed_processes, added_connections, removed_connections,
+                         redirected_connections)
@@ -0,0 +1,200 @@
+import time
+from .component import Connection
+
+_clock = time.perf_counter
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with power of 2 microseconds buckets: bucket i counts durations in [2^(i-1), 2^i) us.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration, count=1):
+        """
+        Record `count` durations of `duration` seconds
+        """
+        index = int(duration * 1000000).bit_length()
+        self.buckets[min(index, self.BUCKETS - 1)] += count
+        self.count += count
+        self.total += duration * count
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """
+        Add the durations recorded by another histogram to this one
+        """
+        for index, count in enumerate(other.buckets):
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """
+        :param q: percentile, between 0 and 100
+        :return: upper bound (in seconds) of the bucket holding the percentile
+        """
+        if not self.count:
+            return 0.0
+        threshold = self.count * q / 100
+        cumulated = 0
+        for index, count in enumerate(self.buckets):
+            cumulated += count
+            if cumulated >= threshold:
+                return min((1 << index) / 1000000, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class InstrumentedConnection(Connection):
+    """
+    Connection counting packets going through it, tracking buffer high-water mark, time spent waiting for room and
+    time its target port spent waiting for packets (see InputPort).
+    The engine creates instrumented connections instead of plain ones when metrics are enabled, so that plain
+    connections don't pay for instrumentation.
+    """
+    __slots__ = ('packets_in', 'packets_out', 'high_water', 'put_wait', 'get_wait')
+    metered = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.packets_in = 0
+        self.packets_out = 0
+        self.high_water = 0
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+
+    def _track_in(self, count):
+        self.packets_in += count
+        depth = len(self.packet_queue)
+        if depth > self.high_water:
+            self.high_water = depth
+
+    async def put_packet(self, packet):
+        if self.packet_queue.full():
+            start = _clock()
+            await super().put_packet(packet)
+            self.put_wait += _clock() - start
+        else:
+            await super().put_packet(packet)
+        self._track_in(1)
+
+    def put_packet_nowait(self, packet):
+        if super().put_packet_nowait(packet):
+            self._track_in(1)
+            return True
+        return False
+
+    async def put_batch(self, packets):
+        start = _clock()
+        await super().put_batch(packets)
+        self.put_wait += _clock() - start
+        self._track_in(len(packets))
+
+    def put_batch_nowait(self, packets):
+        count = super().put_batch_nowait(packets)
+        self._track_in(count)
+        return count
+
+    def get_packet_nowait(self):
+        packet = super().get_packet_nowait()
+        self.packets_out += 1
+        return packet
+
+    def get_batch_nowait(self, max_items):
+        packets = super().get_batch_nowait(max_items)
+        self.packets_out += len(packets)
+        return packets
+
+    async def get_packet(self):
+        start = _clock()
+        packet = await self.packet_queue.get()
+        self.get_wait += _clock() - start
+        self.packets_out += 1
+        return packet
+
+    def snapshot(self):
+        return {
+            'packets_in': self.packets_in,
+            'packets_out': self.packets_out,
+            'depth': len(self.packet_queue),
+            'high_water': self.high_water,
+            'dropped': self.packet_queue.dropped,
+            'put_wait': self.put_wait,
+            'get_wait': self.get_wait,
+        }
+
+
+class ComponentMetrics:
+    """
+    Component on_packet latency histogram and busy time. The busy ratio is the average number of on_packet calls in
+    progress since metrics have been enabled (0 when idle, up to the component concurrency).
+    """
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.busy = 0.0
+        self.started = _clock()
+
+    def add(self, duration, count=1):
+        """
+        Record a dispatch of `count` packets which took `duration` seconds: each packet gets an equal share of it in the
+        latency histogram.
+        """
+        self.latency.add(duration / count, count)
+        self.busy += duration
+
+    def snapshot(self):
+        elapsed = _clock() - self.started
+        return {
+            'latency': self.latency.snapshot(),
+            'busy': self.busy,
+            'busy_ratio': self.busy / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def instrument_component(component):
+    """
+    Enable metrics on a component: its dispatch methods are replaced by timed ones.
+    :param component: component to instrument
+    :return: the component metrics
+    """
+    metrics = ComponentMetrics()
+    dispatch = component._dispatch
+    dispatch_batch = component._dispatch_batch
+
+    async def timed_dispatch(input_port, packet, previous=None):
+        start = _clock()
+        try:
+            await dispatch(input_port, packet, previous)
+        finally:
+            metrics.add(_clock() - start)
+
+    async def timed_dispatch_batch(input_port, packets, previous=None):
+        start = _clock()
+        try:
+            await dispatch_batch(input_port, packets, previous)
+        finally:
+            metrics.add(_clock() - start, len(packets))
+
+    component._dispatch = timed_dispatch
+    component._dispatch_batch = timed_dispatch_batch
+    component.metrics = metrics
+    return metrics
@@ -1,19 +1,122 @@
+import copy
+import itertools
+import time
 from uuid import uuid4
 
+_sequence = itertools.count(1)
+# Clock deadlines are given in: time.monotonic(), which is also the clock of the default event loops
+deadline_clock = time.monotonic
+
+# Packet priorities: priority buffers deliver packets with a higher priority first (see hbflow.core.buffer). Commands
+# are delivered before data packets.
+DEFAULT_PRIORITY = 0
+COMMAND_PRIORITY = 1000
+
+
 class Packet:
-    def __init__(self):
-        self.id = uuid4()
+    """
+    Base packet class.
+    Packets are identified by `seq`, a process wide monotonic sequence number. A UUID is only generated the first time
+    `id` is read.
+    A packet may have a `priority` (see DEFAULT_PRIORITY) and a `deadline`, the deadline_clock() time after which it is
+    useless: processes don't handle packets past their deadline, they send them to their `_expired_out` port instead
+    (see Component).
+    """
+    __slots__ = ('seq', '_uuid', 'priority', 'deadline')
+
+    def __init__(self, priority=DEFAULT_PRIORITY, deadline=None):
+        self.seq = next(_sequence)
+        self._uuid = None
+        self.priority = priority
+        self.deadline = deadline
+
+    @property
+    def id(self):
+        if self._uuid is None:
+            self._uuid = uuid4()
+        return self._uuid
+
+    def copy(self):
+        """
+        Copy a packet so that it can be modified independently of the original one. Packets without mutable content
+        are shared and returned as is.
+        :return: the packet copy
+        """
+        return self
+
+    def set_deadline(self, timeout):
+        """
+        Set the packet deadline `timeout` seconds from now
+        """
+        self.deadline = deadline_clock() + timeout
+
+    def expired(self):
+        return self.deadline is not None and self.deadline < deadline_clock()
 
 
 class DataPacket(Packet):
-    def __init__(self, payload=None):
-        super().__init__()
+    __slots__ = ('payload',)
+
+    def __init__(self, payload=None, priority=DEFAULT_PRIORITY, deadline=None):
+        super().__init__(priority, deadline)
         self.payload = payload
 
+    def copy(self):
+        return DataPacket(copy.deepcopy(self.payload), self.priority, self.deadline)
+
 
 class CommandPacket(Packet):
+    __slots__ = ('command', 'args')
+
     def __init__(self, command, args=None):
-        super().__init__()
+        super().__init__(COMMAND_PRIORITY)
         self.command = command
         self.args = args
 
+
+class PacketPool:
+    """
+    Free-list of DataPacket instances.
+    Released packets are recycled by later acquire() calls instead of being allocated again. When a payload_factory is
+    given, packets keep their payload when released so that fixed-shape payloads (buffers, arrays, ...) are recycled
+    too and can be filled in place.
+    """
+    def __init__(self, size=1024, payload_factory=None):
+        self.size = size
+        self.payload_factory = payload_factory
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self, payload=None):
+        """
+        Get a packet from the pool.
+        :param payload: packet payload. If None and the pool has a payload_factory, the packet comes with a recycled
+        (or new) payload.
+        :return: a DataPacket with a fresh sequence number
+        """
+        if self._free:
+            packet = self._free.pop()
+            packet.seq = next(_sequence)
+            packet._uuid = None
+            packet.priority = DEFAULT_PRIORITY
+            packet.deadline = None
+            if payload is not None or self.payload_factory is None:
+                packet.payload = payload
+            elif packet.payload is None:
+                packet.payload = self.payload_factory()
+            return packet
+        if payload is None and self.payload_factory is not None:
+            payload = self.payload_factory()
+        return DataPacket(payload)
+
+    def release(self, packet):
+        """
+        Give a packet back to the pool. The packet must not be used anymore by the caller.
+        :param packet: packet to recycle
+        """
+        if len(self._free) < self.size:
+            if self.payload_factory is None:
+                packet.payload = None
+            self._free.append(packet)
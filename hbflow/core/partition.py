@@ -0,0 +1,176 @@
+import zlib
+from collections import deque
+from uuid import uuid4
+from .component import Connection, DEFAULT_CAPACITY
+
+# Partitioning modes of the packets sent to the replicas of a process
+PARTITION_ROUND_ROBIN = 'round_robin'
+PARTITION_HASH = 'hash'
+PARTITION_LEAST_LOADED = 'least_loaded'
+PARTITION_MODES = (PARTITION_ROUND_ROBIN, PARTITION_HASH, PARTITION_LEAST_LOADED)
+# Merge mode restoring, downstream of the replicas, the order in which packets were partitioned
+MERGE_ORDERED = 'ordered'
+
+
+def replica_name(process_name, index):
+    return "%s[%d]" % (process_name, index)
+
+
+def _payload_key(payload, key):
+    if key is None:
+        return payload
+    try:
+        return payload[key]
+    except (TypeError, KeyError, IndexError):
+        return getattr(payload, key, None)
+
+
+def _stable_hash(key):
+    """
+    Hash of a partitioning key which is the same in every interpreter run, unlike hash() of str and bytes, so that keys
+    go to the same replica after a restart (replica states are restored from checkpoints). Keys other than strings
+    and bytes are hashed by their repr.
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif not isinstance(key, (bytes, bytearray, memoryview)):
+        key = repr(key).encode('utf-8')
+    return zlib.crc32(key)
+
+
+class Partitioner:
+    """
+    Sends the packets of an output port to the replicas of a process.
+    The partitioner sits in the output port connections as a single connection, so fan-out modes apply to the replica
+    set as a whole, and is the source of one connection per replica. Each packet goes to one replica, chosen by mode:
+      - PARTITION_ROUND_ROBIN: replicas in turn
+      - PARTITION_HASH: hash of the payload `key` item (or attribute, or of the payload itself if no key is given),
+        so that packets with the same key always go to the same replica, across restarts too
+      - PARTITION_LEAST_LOADED: replica whose connection holds the fewest packets (see Connection.depth)
+    The replica chosen for each packet is appended to the `routings` deques, read by ordered merges (see
+    MergeConnection).
+    """
+    __slots__ = ('id', 'name', 'component', 'mode', 'key', 'connections', 'routings', 'ready', '_next', '_retry')
+
+    def __init__(self, port, mode=PARTITION_ROUND_ROBIN, key=None, routings=None):
+        """
+        :param port: output port the partitioner is connected to
+        :param mode: one of PARTITION_MODES
+        :param key: payload key hashed in PARTITION_HASH mode
+        :param routings: list of deques the chosen replica indexes are appended to
+        """
+        self.id = uuid4()
+        self.name = port.name
+        self.component = port.component
+        self.mode = mode
+        self.key = key
+        self.connections = []
+        self.routings = routings if routings is not None else []
+        self.ready = False
+        self._next = 0
+        # (packet, replica index) of the last packet refused by put_packet_nowait, put again with put_packet
+        self._retry = None
+
+    def add_connection(self, connection):
+        self.connections.append(connection)
+
+    def remove_connection(self, connection):
+        self.connections.remove(connection)
+        self._next = 0
+
+    def _select(self, packet):
+        retry = self._retry
+        if retry is not None:
+            self._retry = None
+            if retry[0] is packet:
+                return retry[1]
+        connections = self.connections
+        if self.mode == PARTITION_HASH:
+            return _stable_hash(_payload_key(packet.payload, self.key)) % len(connections)
+        if self.mode == PARTITION_LEAST_LOADED:
+            return min(range(len(connections)), key=lambda index: connections[index].depth())
+        index = self._next
+        self._next = (index + 1) % len(connections)
+        return index
+
+    def _route(self, index):
+        for routing in self.routings:
+            routing.append(index)
+
+    async def put_packet(self, packet):
+        index = self._select(packet)
+        self._route(index)
+        await self.connections[index].put_packet(packet)
+
+    def put_packet_nowait(self, packet):
+        index = self._select(packet)
+        if self.connections[index].put_packet_nowait(packet):
+            self._route(index)
+            return True
+        self._retry = (packet, index)
+        return False
+
+    def put_batch_nowait(self, packets):
+        for count, packet in enumerate(packets):
+            if not self.put_packet_nowait(packet):
+                self._retry = None
+                return count
+        return len(packets)
+
+    async def put_batch(self, packets):
+        for packet in packets:
+            await self.put_packet(packet)
+
+
+class MergeConnection(Connection):
+    """
+    Ordered merge of the outputs of the replicas of a process into an input port.
+    Each replica sends to its own lane connection, whose target is the merge connection. Packets are taken from the
+    lanes in the order their inputs were partitioned (see Partitioner.routings), so the input port gets them in the
+    order the replicas received them. Replicas must send exactly one packet for each packet they receive.
+    """
+    __slots__ = ('component', 'lanes', 'routing')
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY, routing=None, loop=None):
+        super().__init__(name, capacity, loop=loop)
+        self.component = None
+        self.lanes = []
+        self.routing = routing if routing is not None else deque()
+
+    def link(self, source, target):
+        self.component = target.component if target is not None else None
+        super().link(source, target)
+
+    # Lanes are linked to the merge connection as to an input port, in replica index order
+    def add_connection(self, lane):
+        self.lanes.append(lane)
+
+    def remove_connection(self, lane):
+        self.lanes.remove(lane)
+
+    def notify_ready(self, lane):
+        self._advance()
+
+    def _advance(self):
+        routing = self.routing
+        queue = self.packet_queue
+        moved = False
+        while routing and not queue.full():
+            lane = self.lanes[routing[0]]
+            if lane.packet_queue.empty():
+                break
+            queue.put_nowait(lane.get_packet_nowait())
+            routing.popleft()
+            moved = True
+        if moved and self.target is not None:
+            self.target.notify_ready(self)
+
+    def get_packet_nowait(self):
+        packet = self.packet_queue.get_nowait()
+        self._advance()
+        return packet
+
+    def get_batch_nowait(self, max_items):
+        packets = self.packet_queue.get_many_nowait(max_items)
+        self._advance()
+        return packets
@@ -0,0 +1,422 @@
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from .buffer import DropOldestBuffer, DropNewestBuffer, LatestValueBuffer
+from .component import Component
+from .metrics import InstrumentedConnection, LatencyHistogram
+
+_clock = time.perf_counter
+_cpu_clock = time.thread_time
+
+# Profiling modes: on_packet and connection timings only, or timings with a cProfile profiler or a stack sampler
+# running for the profiled processes
+PROFILE_TIMING = 'timing'
+PROFILE_CPROFILE = 'cprofile'
+PROFILE_SAMPLING = 'sampling'
+PROFILE_MODES = (PROFILE_TIMING, PROFILE_CPROFILE, PROFILE_SAMPLING)
+# Interval in seconds between two stack samples
+SAMPLING_INTERVAL = 0.005
+# Files written by Profiler.export
+REPORT_FILE = 'profile.json'
+CRITICAL_PATH_FILE = 'critical_path.txt'
+STACKS_FILE = 'stacks.collapsed'
+CPROFILE_SUFFIX = '.prof'
+
+# Buffers dropping packets: packets residence time isn't tracked in their connections
+_DROPPING_BUFFERS = (DropOldestBuffer, DropNewestBuffer, LatestValueBuffer)
+
+# Stack of [process profile, CPU time of nested steps] of the on_packet calls running on the event loop thread. Calls
+# are nested when a fused connection (see FusedConnection) delivers packets.
+_running = []
+
+
+class ProfilingException(Exception):
+    pass
+
+
+class ProcessProfile:
+    """
+    Timings of the on_packet (or on_batch) calls of a process: wall time, from dispatch to return, including the time
+    spent waiting and in the fused processes it delivers packets to, and CPU time spent in the process own code.
+    """
+    def __init__(self, name, cprofile=False, sampled=False):
+        self.name = name
+        self.calls = 0
+        self.packets = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.latency = LatencyHistogram()
+        self.profile = cProfile.Profile() if cprofile else None
+        self.sampled = sampled
+
+    def add(self, packets, wall):
+        self.calls += 1
+        self.packets += packets
+        self.wall += wall
+        self.latency.add(wall / packets)
+
+    def snapshot(self):
+        packets = self.packets or 1
+        return {
+            'calls': self.calls,
+            'packets': self.packets,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'wall_per_packet': self.wall / packets,
+            'cpu_per_packet': self.cpu / packets,
+            'latency': self.latency.snapshot(),
+        }
+
+
+def _enter(profile):
+    if _running:
+        parent = _running[-1][0].profile
+        if parent is not None:
+            parent.disable()
+    _running.append([profile, 0.0])
+    if profile.profile is not None:
+        profile.profile.enable()
+
+
+def _leave(elapsed):
+    profile, nested = _running.pop()
+    profile.cpu += elapsed - nested
+    if profile.profile is not None:
+        profile.profile.disable()
+    if _running:
+        parent = _running[-1]
+        parent[1] += elapsed
+        if parent[0].profile is not None:
+            parent[0].profile.enable()
+
+
+class _ProfiledCall:
+    """
+    Await a dispatch coroutine step by step, measuring the CPU time of each step: time spent by other tasks while the
+    coroutine waits isn't counted.
+    """
+    __slots__ = ('_coro', '_profile')
+
+    def __init__(self, coro, profile):
+        self._coro = coro
+        self._profile = profile
+
+    def __await__(self):
+        coro = self._coro
+        value = None
+        error = None
+        while True:
+            _enter(self._profile)
+            start = _cpu_clock()
+            try:
+                if error is None:
+                    future = coro.send(value)
+                else:
+                    future = coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                _leave(_cpu_clock() - start)
+            try:
+                value = yield future
+                error = None
+            except BaseException as e:
+                value = None
+                error = e
+
+
+_AWAIT_CODE = _ProfiledCall.__await__.__code__
+# Frames of the engine dispatch, between the profiled call and on_packet (or on_batch)
+_DISPATCH_CODES = (Component._dispatch.__code__, Component._dispatch_batch.__code__)
+
+
+def _frame_name(code):
+    return "%s:%s" % (os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+
+
+class StackSampler:
+    """
+    Sample the stack of the event loop thread every `interval` seconds, from a background thread. Samples taken while
+    a sampled process handles packets are counted by process and stack, from on_packet (or on_batch) to the innermost
+    frame.
+    """
+    def __init__(self, thread_id=None, interval=SAMPLING_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        # (process name, frame names...) -> number of samples
+        self.stacks = dict()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='hbflow-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        self.samples += 1
+        try:
+            profile = _running[-1][0]
+        except IndexError:
+            return
+        if not profile.sampled:
+            return
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None and frame.f_code is not _AWAIT_CODE:
+            if frame.f_code not in _DISPATCH_CODES:
+                names.append(_frame_name(frame.f_code))
+            frame = frame.f_back
+        if frame is None:
+            # The process step ended meanwhile
+            return
+        key = (profile.name,) + tuple(reversed(names))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self):
+        """
+        :return: samples in collapsed stack format ('frame;frame;... count' lines), read by flame graph tools
+        """
+        return ["%s %d" % (';'.join(key), count) for key, count in sorted(self.stacks.items())]
+
+
+class ProfiledConnection(InstrumentedConnection):
+    """
+    Instrumented connection measuring the residence time of packets in its buffer, from the time they are queued to
+    the time the target takes them.
+    """
+    __slots__ = ('residence', '_stamps')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.residence = LatencyHistogram()
+        # packet sequence number -> time it was queued
+        self._stamps = None if isinstance(self.packet_queue, _DROPPING_BUFFERS) else dict()
+
+    def _stamp(self, packets):
+        if self._stamps is not None:
+            now = _clock()
+            for packet in packets:
+                self._stamps[packet.seq] = now
+
+    def _unstamp(self, packets):
+        if self._stamps is not None:
+            now = _clock()
+            for packet in packets:
+                stamp = self._stamps.pop(packet.seq, None)
+                if stamp is not None:
+                    self.residence.add(now - stamp)
+
+    async def put_packet(self, packet):
+        await super().put_packet(packet)
+        self._stamp((packet,))
+
+    def put_packet_nowait(self, packet):
+        if super().put_packet_nowait(packet):
+            self._stamp((packet,))
+            return True
+        return False
+
+    async def put_batch(self, packets):
+        await super().put_batch(packets)
+        self._stamp(packets)
+
+    def put_batch_nowait(self, packets):
+        count = super().put_batch_nowait(packets)
+        self._stamp(packets[:count])
+        return count
+
+    def get_packet_nowait(self):
+        packet = super().get_packet_nowait()
+        self._unstamp((packet,))
+        return packet
+
+    def get_batch_nowait(self, max_items):
+        packets = super().get_batch_nowait(max_items)
+        self._unstamp(packets)
+        return packets
+
+    async def get_packet(self):
+        packet = await super().get_packet()
+        self._unstamp((packet,))
+        return packet
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['residence'] = self.residence.snapshot()
+        return snapshot
+
+
+def critical_path(edges):
+    """
+    Find the path of a graph with the largest latency. Edges closing a cycle are ignored.
+    :param edges: list of (edge name, source node, target node, latency)
+    :return: (path latency, list of the path edges, from source to target)
+    """
+    outgoing = dict()
+    indegree = dict()
+    for edge in edges:
+        outgoing.setdefault(edge[1], []).append(edge)
+        indegree.setdefault(edge[1], 0)
+        indegree[edge[2]] = indegree.get(edge[2], 0) + 1
+    # node -> (latency of the slowest path ending at the node, last edge of the path)
+    best = dict((node, (0.0, None)) for node, count in indegree.items() if count == 0)
+    ready = list(best)
+    while ready:
+        node = ready.pop()
+        latency = best[node][0]
+        for edge in outgoing.get(node, ()):
+            target = edge[2]
+            if target not in best or latency + edge[3] > best[target][0]:
+                best[target] = (latency + edge[3], edge)
+            indegree[target] -= 1
+            if indegree[target] == 0:
+                ready.append(target)
+    if not best:
+        return 0.0, []
+    node = max(best, key=lambda name: best[name][0])
+    total = best[node][0]
+    path = []
+    edge = best[node][1]
+    while edge is not None:
+        path.append(edge)
+        edge = best[edge[1]][1]
+    path.reverse()
+    return total, path
+
+
+class Profiler:
+    """
+    Profiling of the processes and connections of an engine (see GraphEngine `profile`).
+    All processes are timed (see ProcessProfile) and, in PROFILE_CPROFILE and PROFILE_SAMPLING modes, the processes
+    named in `processes` (all processes if None) are profiled with cProfile or sampled by a StackSampler. Profiled
+    connections (see ProfiledConnection) measure packets residence time.
+    The latency of a connection is the mean residence time of its packets plus the mean wall time its target spends
+    per packet: the critical path is the path of connections with the largest latency.
+    """
+    def __init__(self, mode=PROFILE_TIMING, processes=None, interval=SAMPLING_INTERVAL):
+        if mode not in PROFILE_MODES:
+            raise ProfilingException("Invalid profiling mode '%s'" % mode)
+        self.logger = logging.getLogger(__name__)
+        self.mode = mode
+        self.scope = set(processes) if processes else None
+        self.interval = interval
+        self.profiles = dict()
+        self.sampler = None
+
+    def _in_scope(self, process_name):
+        return self.scope is None or process_name in self.scope
+
+    def instrument(self, component):
+        """
+        Replace the dispatch methods of a component by profiled ones
+        :return: the component ProcessProfile
+        """
+        scoped = self._in_scope(component.name)
+        profile = ProcessProfile(component.name, cprofile=scoped and self.mode == PROFILE_CPROFILE,
+                                 sampled=scoped and self.mode == PROFILE_SAMPLING)
+        dispatch = component._dispatch
+        dispatch_batch = component._dispatch_batch
+
+        async def profiled_dispatch(input_port, packet):
+            start = _clock()
+            try:
+                await _ProfiledCall(dispatch(input_port, packet), profile)
+            finally:
+                profile.add(1, _clock() - start)
+
+        async def profiled_dispatch_batch(input_port, packets):
+            start = _clock()
+            try:
+                await _ProfiledCall(dispatch_batch(input_port, packets), profile)
+            finally:
+                profile.add(len(packets), _clock() - start)
+
+        component._dispatch = profiled_dispatch
+        component._dispatch_batch = profiled_dispatch_batch
+        self.profiles[component.name] = profile
+        return profile
+
+    def start(self):
+        if self.mode == PROFILE_SAMPLING and self.sampler is None:
+            self.sampler = StackSampler(interval=self.interval)
+            self.sampler.start()
+
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def report(self, connections):
+        """
+        :param connections: connections of the engine
+        :return: dict with 'processes' and 'connections' timings by name, and the 'critical_path'
+        """
+        edges = []
+        connection_reports = dict()
+        for cnx in connections:
+            if not isinstance(cnx, ProfiledConnection) or cnx.source is None or cnx.target is None:
+                continue
+            connection_reports[cnx.name] = cnx.snapshot()
+            target = self.profiles.get(cnx.target.component.name)
+            processing = target.wall / target.packets if target is not None and target.packets else 0.0
+            queue = cnx.residence.total / cnx.residence.count if cnx.residence.count else 0.0
+            edges.append((cnx.name, cnx.source.component.name, cnx.target.component.name, queue + processing,
+                          queue, processing))
+        total, path = critical_path(edges)
+        return {
+            'processes': dict((name, profile.snapshot()) for name, profile in self.profiles.items()),
+            'connections': connection_reports,
+            'critical_path': {
+                'latency': total,
+                'edges': [{'connection': edge[0], 'source': edge[1], 'target': edge[2], 'latency': edge[3],
+                           'queue': edge[4], 'processing': edge[5], 'share': edge[3] / total if total else 0.0}
+                          for edge in path],
+            },
+            'samples': self.sampler.samples if self.sampler is not None else 0,
+        }
+
+    def export(self, directory, connections):
+        """
+        Write the profiling results to a directory: the report as JSON (REPORT_FILE), the critical path as a table
+        (CRITICAL_PATH_FILE), sampled stacks in collapsed format (STACKS_FILE) and cProfile statistics of each profiled
+        process (<process name>.prof, read with pstats)
+        :return: list of the written files paths
+        """
+        os.makedirs(directory, exist_ok=True)
+        report = self.report(connections)
+        paths = [os.path.join(directory, REPORT_FILE), os.path.join(directory, CRITICAL_PATH_FILE)]
+        with open(paths[0], 'w') as stream:
+            json.dump(report, stream, indent=2)
+        with open(paths[1], 'w') as stream:
+            stream.write("%-24s %-16s %-16s %12s %12s %12s %7s\n" % ("connection", "source", "target", "latency (s)",
+                                                                   "queue (s)", "process (s)", "share"))
+            for edge in report['critical_path']['edges']:
+                stream.write("%-24s %-16s %-16s %12.6f %12.6f %12.6f %6.1f%%\n" % (
+                    edge['connection'], edge['source'], edge['target'], edge['latency'], edge['queue'],
+                    edge['processing'], edge['share'] * 100))
+            stream.write("%-58s %12.6f\n" % ("total", report['critical_path']['latency']))
+        if self.sampler is not None:
+            paths.append(os.path.join(directory, STACKS_FILE))
+            with open(paths[-1], 'w') as stream:
+                stream.writelines(line + '\n' for line in self.sampler.collapsed())
+        for name, profile in sorted(self.profiles.items()):
+            if profile.profile is not None:
+                paths.append(os.path.join(directory, name + CPROFILE_SUFFIX))
+                profile.profile.dump_stats(paths[-1])
+        self.logger.debug("Profile written to '%s'" % directory)
+        return paths
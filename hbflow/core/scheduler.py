@@ -0,0 +1,151 @@
+import asyncio
+import time
+
+_clock = time.monotonic
+
+# Longest time, in seconds, a process is held back by processes of higher priority before handling its next packet,
+# and longest time a process of lower priority runs without giving the event loop a chance to run other tasks
+TIME_SLICE = 0.005
+
+
+def _release_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Scheduler:
+    """
+    Cooperative priority scheduler of the processes of an engine (see Component.priority).
+    Processes share the event loop, which runs ready tasks in FIFO order, and a process handling packets available on
+    its ports doesn't give the loop back until they are all handled. The scheduler tracks the input ports holding
+    packets by priority of their process: before each on_packet (or on_batch) call, a process whose priority is lower
+    than the priority of a port holding packets waits until these ports are drained. A process is held back
+    `time_slice` seconds at most for each packet, so lower priority processes keep progressing (and higher priority
+    processes waiting on them too). Processes of lower priority also yield to the event loop when it didn't run other
+    tasks for more than `time_slice` seconds, so that higher priority sources are not delayed by bulk work.
+    Processes check preempts() before each call, and wait with admit() when it returns True.
+    """
+    def __init__(self, time_slice=TIME_SLICE, loop=None):
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        self.time_slice = time_slice
+        # Highest priority of the ports holding packets, None when no port holds packets
+        self.top = None
+        # Highest priority of the scheduled processes
+        self.highest = None
+        # Number of times processes have been held back
+        self.held = 0
+        # priority -> number of ports holding packets
+        self._ready = dict()
+        # priority -> futures of processes waiting to be admitted
+        self._waiters = dict()
+        # priority -> number of scheduled processes
+        self._priorities = dict()
+        # Time of the last yield to the event loop
+        self._slice_start = _clock()
+        self._yielding = False
+
+    def attach(self, component):
+        """
+        Schedule a component: its data input ports report to the scheduler when they hold packets
+        """
+        if component._scheduler is self:
+            return
+        component._scheduler = self
+        priority = component.priority
+        self._priorities[priority] = self._priorities.get(priority, 0) + 1
+        if self.highest is None or priority > self.highest:
+            self.highest = priority
+        for port in component._input_ports:
+            if port.name == '_command_in':
+                continue
+            port._scheduler = self
+            port._priority = component.priority
+            if port._ready:
+                self.port_ready(port._priority)
+
+    def detach(self, component):
+        if component._scheduler is not self:
+            return
+        priority = component.priority
+        count = self._priorities[priority] - 1
+        if count:
+            self._priorities[priority] = count
+        else:
+            del self._priorities[priority]
+            self.highest = max(self._priorities) if self._priorities else None
+        for port in component._input_ports:
+            if port._scheduler is self:
+                port._scheduler = None
+                if port._ready:
+                    self.port_drained(port._priority)
+        component._scheduler = None
+
+    def port_ready(self, priority):
+        """
+        Called by an input port when it starts holding packets
+        """
+        self._ready[priority] = self._ready.get(priority, 0) + 1
+        if self.top is None or priority > self.top:
+            self.top = priority
+
+    def port_drained(self, priority):
+        """
+        Called by an input port when it doesn't hold packets anymore
+        """
+        count = self._ready[priority] - 1
+        if count:
+            self._ready[priority] = count
+            return
+        del self._ready[priority]
+        if priority == self.top:
+            self.top = max(self._ready) if self._ready else None
+            self._wakeup()
+
+    def _wakeup(self):
+        top = self.top
+        for priority in [priority for priority in self._waiters if top is None or priority >= top]:
+            for waiter in self._waiters.pop(priority):
+                _release_waiter(waiter)
+
+    def preempts(self, priority):
+        """
+        :return: True if a process of this priority must wait with admit() before handling its next packet
+        """
+        if priority >= self.highest:
+            return False
+        top = self.top
+        return (top is not None and top > priority) or _clock() - self._slice_start > self.time_slice
+
+    def _new_slice(self):
+        self._slice_start = _clock()
+        self._yielding = False
+
+    async def admit(self, priority):
+        """
+        Wait until no port of a priority higher than `priority` holds packets, for time_slice at most, or give the
+        event loop a chance to run other tasks when the time slice is over
+        """
+        self.held += 1
+        top = self.top
+        if top is None or top <= priority:
+            if not self._yielding:
+                self._yielding = True
+                self._loop.call_soon(self._new_slice)
+            await asyncio.sleep(0)
+            return
+        waiter = self._loop.create_future()
+        self._waiters.setdefault(priority, []).append(waiter)
+        timer = self._loop.call_later(self.time_slice, _release_waiter, waiter)
+        try:
+            await waiter
+            self._slice_start = _clock()
+        finally:
+            timer.cancel()
+            waiters = self._waiters.get(priority)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[priority]
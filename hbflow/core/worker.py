@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import multiprocessing
+from .graph import GraphException
+from .channel import wait_fd
+
+
+class GroupWorker:
+    """
+    OS process running the processes of a graph group.
+    The worker binds its own GraphEngine, restricted to the group, to the graph plan and receives engine commands from
+    the parent engine through a control pipe. Commands are published on the worker engine command bus, and the
+    worker sends back the names of the processes which applied them. Only the component modules of the group are
+    imported by the worker.
+    """
+    def __init__(self, group, plan, channels, context=None, loop=None):
+        self.logger = logging.getLogger(__name__)
+        if loop:
+            self._loop = loop
+        else:
+            self._loop = asyncio.get_event_loop()
+        if context is None:
+            context = multiprocessing.get_context()
+        self.group = group
+        self._commands = None
+        self._control, self._worker_control = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(group, plan, channels, self._worker_control),
+                                       name="hbflow-%s" % group, daemon=True)
+
+    async def start(self):
+        """
+        Start the worker process and wait until its engine is bound to the graph
+        """
+        self.process.start()
+        self._worker_control.close()
+        try:
+            status, message = await self._loop.run_in_executor(None, self._control.recv)
+        except EOFError:
+            status, message = 'error', "worker process exited"
+        if status != 'bound':
+            raise GraphException("Can't bind group '%s': %s" % (self.group, message))
+        self.logger.debug("Group '%s' running in process %d" % (self.group, self.process.pid))
+
+    def attach(self, commands):
+        """
+        Forward the commands of a command bus targeting the group processes to the worker
+        :param commands: parent engine CommandBus
+        """
+        self._commands = commands
+        commands.add_group(self.group, self.forward_command)
+        self._loop.add_reader(self._control.fileno(), self._on_control)
+
+    def forward_command(self, entry):
+        self._control.send(('command', entry.version, entry.packet.command, entry.packet.args, entry.processes,
+                            entry.groups))
+
+    def _on_control(self):
+        try:
+            message = self._control.recv()
+        except (EOFError, OSError):
+            self._loop.remove_reader(self._control.fileno())
+            return
+        status, version, process_names = message
+        if status == 'ack' and self._commands is not None:
+            self._commands.acknowledge(version, process_names)
+
+    async def stop(self, timeout=5):
+        if self._commands is not None:
+            self._loop.remove_reader(self._control.fileno())
+            self._commands = None
+        try:
+            self._control.send(None)
+        except OSError:
+            pass
+        await self._loop.run_in_executor(None, self.process.join, timeout)
+        if self.process.is_alive():
+            self.logger.warning("Group '%s' worker didn't stop, terminating it" % self.group)
+            self.process.terminate()
+        self._control.close()
+
+
+def run_worker(group, plan, channels, control):
+    """
+    Worker process entry point: run a GraphEngine bound to a group of the graph until the parent engine stops it
+    """
+    from .engine import GraphEngine
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    engine = GraphEngine(loop=loop, group=group, channels=channels)
+    try:
+        loop.run_until_complete(engine.bind(plan))
+    except Exception as e:
+        control.send(('error', "%s: %s" % (e, e.__cause__) if e.__cause__ else str(e)))
+        return
+    control.send(('bound', None))
+    loop.run_until_complete(_control_loop(engine, control, loop))
+    loop.close()
+
+
+async def _control_loop(engine, control, loop):
+    while True:
+        await wait_fd(loop, control.fileno(), loop.add_reader, loop.remove_reader)
+        try:
+            message = control.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        kind, version, command, args, processes, groups = message
+        targets = engine.commands.targets(processes, groups)
+        missing = await engine.wait_acknowledged(await engine.send_command(command, args, processes, groups))
+        control.send(('ack', version, [name for name in targets if name not in missing]))
+    await engine.stop()
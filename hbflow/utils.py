@@ -1,4 +1,5 @@
 import itertools
+from transitions import MachineError
 
 
 class InstanceCounterMeta(type):
@@ -10,7 +11,75 @@ class InstanceCounterMeta(type):
 
 
 class IdentifiableObject(object, metaclass=InstanceCounterMeta):
+    __slots__ = ('_seq_id',)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._seq_id = next(self.__class__._ids)
-        self._instance_name = self.__class__.__name__ + "_" + str(self._seq_id)
+
+    @property
+    def _instance_name(self):
+        return self.__class__.__name__ + "_" + str(self._seq_id)
+
+
+class StateTable:
+    """
+    States and transitions compiled once per class, shared by all its instances.
+    This is a lightweight replacement of a transitions.Machine per instance: the current state of an object is a
+    string stored in its `state` attribute, and install() adds to the class the same methods a Machine adds to its
+    model (one method per trigger, is_<state>() and to_<state>()). Invalid triggers raise transitions.MachineError.
+    """
+    def __init__(self, states, transitions=(), initial=None):
+        self.states = tuple(states)
+        self.initial = initial or self.states[0]
+        # trigger -> {source state: destination state}
+        self.triggers = dict()
+        for transition in transitions:
+            sources = transition['source']
+            if isinstance(sources, str):
+                sources = [sources]
+            table = self.triggers.setdefault(transition['trigger'], dict())
+            for source in sources:
+                table.setdefault(source, transition['dest'])
+
+    def trigger(self, obj, trigger):
+        try:
+            obj.state = self.triggers[trigger][obj.state]
+        except KeyError:
+            raise MachineError("Can't trigger event %s from state %s!" % (trigger, obj.state))
+        return True
+
+    def install(self, cls):
+        """
+        Add trigger, is_<state>() and to_<state>() methods to a class. Methods already defined by the class are kept.
+        """
+        methods = dict()
+        for trigger in self.triggers:
+            methods[trigger] = self._trigger_method(trigger)
+        for state in self.states:
+            methods['is_' + state] = self._is_method(state)
+            methods['to_' + state] = self._to_method(state)
+        for name, method in methods.items():
+            if not hasattr(cls, name):
+                setattr(cls, name, method)
+
+    def _trigger_method(self, trigger):
+        def trigger_method(obj):
+            return self.trigger(obj, trigger)
+        trigger_method.__name__ = trigger
+        return trigger_method
+
+    @staticmethod
+    def _is_method(state):
+        def is_state(obj):
+            return obj.state == state
+        is_state.__name__ = 'is_' + state
+        return is_state
+
+    @staticmethod
+    def _to_method(state):
+        def to_state(obj):
+            obj.state = state
+            return True
+        to_state.__name__ = 'to_' + state
+        return to_state
@@ -8,7 +8,7 @@ def read_yaml_config(config_file):
     config = None
     try:
         with open(config_file, 'r') as stream:
-            config = yaml.load(stream)
+            config = yaml.safe_load(stream)
     except yaml.YAMLError as exc:
         print("Invalid config_file %s: %s" % (config_file, exc))
     return config
@@ -0,0 +1,137 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+"""
+Components, graph specifications and test case base shared by the tests.
+"""
+import unittest
+import asyncio
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.engine import GraphEngine
+from hbflow.core.packet import DataPacket
+
+COMPONENT = 'hbflow.core.component.TestComponent'
+
+
+class Increment(Component):
+    """
+    Fusable component sending payload + 1
+    """
+    _in = IN()
+    _out = OUT()
+
+    fusable = True
+
+    async def on_packet(self, from_port, packet):
+        if packet.payload is None:
+            raise ValueError("no payload")
+        await self._out.send_packet(DataPacket(packet.payload + 1))
+
+
+class Collector(Component):
+    """
+    Record the payloads received. Shared memory views are copied.
+    """
+    _in = IN()
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.received = []
+
+    async def on_packet(self, from_port, packet):
+        if isinstance(packet.payload, memoryview):
+            self.received.append(bytes(packet.payload))
+        else:
+            self.received.append(packet.payload)
+
+
+def chain_spec(capacity=1):
+    """
+    source -> inc_0 -> inc_1 -> inc_2 -> sink, connections named 'source-inc_0'...
+    """
+    processes = {'source': {'component': COMPONENT}, 'sink': {'component': 'tests.components.Collector'}}
+    names = ['source']
+    for i in range(3):
+        names.append('inc_%d' % i)
+        processes[names[-1]] = {'component': 'tests.components.Increment'}
+    names.append('sink')
+    connections = [{'name': '%s-%s' % (source, target), 'capacity': capacity,
+                    'source': {'process': source, 'port': '_out'}, 'target': {'process': target, 'port': '_in'}}
+                   for source, target in zip(names, names[1:])]
+    return {'processes': processes, 'connections': connections}
+
+
+def component_chain_spec(*components, capacity=4, concurrency=None):
+    """
+    p0 -> p1 ... running the given components, the last one with `concurrency`
+    """
+    processes = dict(('p%d' % index, {'component': component}) for index, component in enumerate(components))
+    if concurrency:
+        processes['p%d' % (len(components) - 1)]['concurrency'] = concurrency
+    connections = [{'capacity': capacity, 'source': {'process': 'p%d' % index, 'port': '_out'},
+                    'target': {'process': 'p%d' % (index + 1), 'port': '_in'}} for index in range(len(components) - 1)]
+    return {'processes': processes, 'connections': connections}
+
+
+def graph_spec(*connections):
+    """
+    Two processes 'first' and 'second', linked by the given connections (source and target can be overridden)
+    """
+    return {
+        'graph': {
+            'name': 'test_graph',
+            'processes': {
+                'first': {'component': COMPONENT},
+                'second': {'component': COMPONENT},
+            },
+            'connections': [dict({'source': {'process': 'first', 'port': '_out'},
+                                  'target': {'process': 'second', 'port': '_in'}}, **cnx) for cnx in connections]
+        }
+    }
+
+
+class LoopTestCase(unittest.TestCase):
+    """
+    Test case running on its own event loop. Tasks left pending by a test are cancelled before the loop is closed.
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def init_engine(self, spec, **options):
+        """
+        :return: a GraphEngine created with `options` and bound to the graph specification
+        """
+        engine = GraphEngine(loop=self.loop, **options)
+        self.loop.run_until_complete(engine.init_from_dictionary(spec))
+        return engine
+
+    def run_graph(self, engine, count, feed=None, start=True, stop=True, timeout=5):
+        """
+        Run a bound engine until its 'sink' process received `count` packets
+        :param feed: coroutine function called with the engine once started, to send packets or check the engine
+        :param start: start the engine (START command) first
+        :param stop: stop the engine once the packets are received
+        :return: the packets received by the sink
+        """
+        async def run():
+            try:
+                if start:
+                    await engine.start()
+                if feed is not None:
+                    await feed(engine)
+                received = engine._get_process('sink').received
+                while len(received) < count:
+                    await asyncio.sleep(0.005)
+                return received
+            finally:
+                if stop:
+                    await engine.stop()
+        return self.loop.run_until_complete(asyncio.wait_for(run(), timeout))
@@ -0,0 +1,202 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import shutil
+import tempfile
+from hbflow.core.buffer import PacketBuffer, SpillBuffer, PriorityBuffer, new_buffer, BufferException
+from hbflow.core.packet import DataPacket, CommandPacket
+from tests.components import LoopTestCase
+
+
+class PacketBufferTest(LoopTestCase):
+    def test_capacity_in_packets(self):
+        buffer = PacketBuffer(3)
+        self.assertEqual(buffer.put_many_nowait([1, 2, 3, 4, 5]), 3)
+        self.assertTrue(buffer.full())
+        self.assertRaises(asyncio.QueueFull, buffer.put_nowait, 6)
+        self.assertEqual(buffer.get_many_nowait(2), [1, 2])
+        self.assertEqual(buffer.put_many_nowait([1, 2, 3, 4, 5], 3), 2)
+        self.assertEqual(list(buffer), [3, 4, 5])
+
+    def test_put_waits_for_room(self):
+        async def test_coro():
+            buffer = PacketBuffer(1)
+            await buffer.put('a')
+            put = asyncio.ensure_future(buffer.put('b'))
+            await asyncio.sleep(0)
+            self.assertFalse(put.done())
+            self.assertEqual(buffer.get_nowait(), 'a')
+            await put
+            return await buffer.get()
+        self.assertEqual(self.loop.run_until_complete(test_coro()), 'b')
+
+    def test_wait_empty(self):
+        async def test_coro():
+            buffer = PacketBuffer(1)
+            await buffer.put('a')
+            empty = asyncio.ensure_future(buffer.wait_empty())
+            await asyncio.sleep(0)
+            put = asyncio.ensure_future(buffer.put('b'))
+            await asyncio.sleep(0)
+            self.assertEqual(buffer.get_nowait(), 'a')
+            await asyncio.wait_for(empty, 1)
+            # The wakeup taken by the drain wait has been passed on to the putter
+            await asyncio.wait_for(put, 1)
+            self.assertEqual(list(buffer), ['b'])
+        self.loop.run_until_complete(test_coro())
+
+    def test_set_capacity(self):
+        async def test_coro():
+            buffer = PacketBuffer(1)
+            await buffer.put('a')
+            put = asyncio.ensure_future(buffer.put('b'))
+            await asyncio.sleep(0)
+            self.assertFalse(put.done())
+            buffer.set_capacity(2)
+            await put
+            # Reduced capacity keeps packets already held
+            buffer.set_capacity(1)
+            self.assertEqual(buffer.get_many_nowait(2), ['a', 'b'])
+            return buffer.delivered
+        self.assertEqual(self.loop.run_until_complete(test_coro()), 2)
+
+    def test_unbounded(self):
+        buffer = PacketBuffer(None)
+        self.assertEqual(buffer.put_many_nowait(list(range(1000))), 1000)
+        self.assertFalse(buffer.full())
+        self.assertIsNone(buffer.free())
+
+
+class BufferPolicyTest(LoopTestCase):
+    def fill(self, policy, capacity, packets):
+        buffer = new_buffer(policy, capacity)
+        buffer.put_nowait(packets[0])
+        self.assertEqual(buffer.put_many_nowait(packets, 1), len(packets) - 1)
+        return buffer
+
+    def test_drop_oldest(self):
+        buffer = self.fill('drop_oldest', 3, [1, 2, 3, 4, 5])
+        self.assertEqual(list(buffer), [3, 4, 5])
+        self.assertEqual(buffer.dropped, 2)
+        buffer.put_many_nowait([6, 7, 8, 9])
+        self.assertEqual(list(buffer), [7, 8, 9])
+        self.assertEqual(buffer.dropped, 6)
+        buffer.set_capacity(1)
+        self.assertEqual(list(buffer), [9])
+        self.assertEqual(buffer.dropped, 8)
+
+    def test_drop_newest(self):
+        buffer = self.fill('drop_newest', 3, [1, 2, 3, 4, 5])
+        self.assertEqual(list(buffer), [1, 2, 3])
+        self.assertEqual(buffer.dropped, 2)
+
+    def test_latest(self):
+        buffer = self.fill('latest', 10, [1, 2, 3])
+        self.assertEqual(list(buffer), [3])
+        self.assertEqual(buffer.dropped, 2)
+
+    def test_unbounded(self):
+        buffer = self.fill('unbounded', 1, list(range(100)))
+        self.assertEqual(len(buffer), 100)
+        self.assertRaises(BufferException, buffer.set_capacity, 10)
+
+    def test_invalid_policy(self):
+        self.assertRaises(BufferException, new_buffer, 'unknown')
+        self.assertRaises(BufferException, new_buffer, 'drop_oldest', None)
+
+
+class SpillBufferTest(LoopTestCase):
+    def test_spill_keeps_order(self):
+        buffer = SpillBuffer(2, segment_size=256)
+        packets = [DataPacket(i) for i in range(50)] + [DataPacket(b'raw'), CommandPacket('STOP')]
+        self.assertEqual(buffer.put_many_nowait(packets), len(packets))
+        self.assertFalse(buffer.full())
+        self.assertEqual(len(buffer), len(packets))
+        self.assertEqual(buffer.spilled, len(packets) - 2)
+        self.assertGreater(len(buffer._segments), 1)
+        self.assertEqual([p.seq for p in buffer], [p.seq for p in packets])
+        received = [buffer.get_nowait() for i in range(10)]
+        received += buffer.get_many_nowait(100)
+        self.assertEqual([p.payload for p in received[:51]], list(range(50)) + [b'raw'])
+        self.assertEqual([p.seq for p in received[:51]], [p.seq for p in packets[:51]])
+        self.assertEqual(received[51].command, 'STOP')
+        self.assertEqual((len(buffer), buffer.spilled, buffer.spilled_bytes), (0, 0, 0))
+        # Read segments are recycled
+        self.assertEqual(len(buffer._segments), 1)
+        self.assertIsNotNone(buffer._spare)
+        buffer.close()
+        self.assertEqual(len(buffer._segments), 0)
+
+    def test_max_spill(self):
+        async def test_coro():
+            buffer = new_buffer('spill', 1, options={'max_spill': 1})
+            await buffer.put(DataPacket(1))
+            await buffer.put(DataPacket(2))
+            self.assertTrue(buffer.full())
+            put = asyncio.ensure_future(buffer.put(DataPacket(3)))
+            await asyncio.sleep(0)
+            self.assertFalse(put.done())
+            self.assertEqual(buffer.get_nowait().payload, 1)
+            await put
+            return [p.payload for p in buffer.get_many_nowait(10)]
+        self.assertEqual(self.loop.run_until_complete(test_coro()), [2, 3])
+
+    def test_spill_keeps_priority(self):
+        buffer = SpillBuffer(1, segment_size=256)
+        packets = [DataPacket(1), DataPacket(2, priority=3), DataPacket(3, deadline=10.0)]
+        buffer.put_many_nowait(packets)
+        received = buffer.get_many_nowait(3)
+        self.assertEqual([(p.seq, p.priority, p.deadline) for p in received],
+                         [(p.seq, p.priority, p.deadline) for p in packets])
+
+    def test_set_capacity(self):
+        buffer = SpillBuffer(1)
+        buffer.put_many_nowait([DataPacket(i) for i in range(5)])
+        buffer.set_capacity(3)
+        self.assertEqual((len(buffer._packets), buffer.spilled), (3, 2))
+        self.assertRaises(BufferException, buffer.set_capacity, None)
+        self.assertRaises(BufferException, new_buffer, 'spill', None)
+
+    def test_options(self):
+        directory = tempfile.mkdtemp()
+        try:
+            buffer = new_buffer('spill', 1, options={'directory': directory, 'segment_size': 512, 'max_spill': 4096})
+            self.assertEqual((buffer.directory, buffer.segment_size, buffer.max_spill), (directory, 512, 4096))
+            buffer.put_many_nowait([DataPacket(i) for i in range(3)])
+            self.assertEqual(buffer._segments[0].size, 512)
+            buffer.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertRaises(BufferException, new_buffer, 'spill', 1, options={'unknown': 1})
+        self.assertRaises(BufferException, new_buffer, 'blocking', 1, options={'max_spill': 1})
+
+
+class PriorityBufferTest(LoopTestCase):
+    def test_priority_order(self):
+        buffer = new_buffer('priority', 10)
+        self.assertIsInstance(buffer, PriorityBuffer)
+        packets = [DataPacket(1), DataPacket(2, priority=5), DataPacket(3), DataPacket(4, priority=5),
+                   CommandPacket('stop')]
+        self.assertEqual(buffer.put_many_nowait(packets[:3]), 3)
+        buffer.put_nowait(packets[3])
+        buffer.load([packets[4]])
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(list(buffer), [packets[4], packets[1], packets[3], packets[0], packets[2]])
+        self.assertIs(buffer.get_nowait(), packets[4])
+        self.assertEqual([p.payload for p in buffer.get_many_nowait(10)], [2, 4, 1, 3])
+        self.assertEqual(buffer.delivered, 5)
+        self.assertRaises(asyncio.QueueEmpty, buffer.get_nowait)
+
+    def test_put_waits_for_room(self):
+        async def test_coro():
+            buffer = PriorityBuffer(1)
+            await buffer.put(DataPacket('low'))
+            put = asyncio.ensure_future(buffer.put(DataPacket('high', priority=1)))
+            await asyncio.sleep(0)
+            self.assertFalse(put.done())
+            self.assertRaises(asyncio.QueueFull, buffer.put_nowait, DataPacket())
+            self.assertEqual(buffer.get_nowait().payload, 'low')
+            await put
+            return (await buffer.get()).payload
+        self.assertEqual(self.loop.run_until_complete(test_coro()), 'high')
@@ -0,0 +1,96 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import multiprocessing
+from types import SimpleNamespace
+from hbflow.core.component import InputPort, OutputPort
+from hbflow.core.channel import new_channel, ChannelException
+from hbflow.core.packet import DataPacket, CommandPacket
+from tests.components import LoopTestCase
+
+
+class ChannelTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.context = multiprocessing.get_context()
+
+    def open_channel(self, transport, capacity, **kwargs):
+        channel = new_channel(transport, self.context, capacity, **kwargs)
+        writer = channel.open_writer('cnx', capacity, loop=self.loop)
+        reader = channel.open_reader('cnx', capacity, loop=self.loop)
+        channel.close()
+        output = OutputPort('out', SimpleNamespace(name='source'))
+        port = InputPort('in', SimpleNamespace(name='target'))
+        writer.link(output, None)
+        reader.link(None, port)
+        return writer, reader, output, port
+
+    def test_pipe(self):
+        async def test_coro():
+            writer, reader, output, port = self.open_channel('pipe', 5)
+            await output.send_batch([DataPacket(i) for i in range(20)])
+            await output.send_packet(CommandPacket('start'))
+            payloads = []
+            for i in range(20):
+                port_, packet = await port.read_packet()
+                payloads.append(packet.payload)
+            port_, packet = await port.read_packet()
+            writer.close()
+            reader.close()
+            return payloads, packet
+
+        payloads, command = self.loop.run_until_complete(asyncio.wait_for(test_coro(), 5))
+        self.assertEqual(payloads, list(range(20)))
+        self.assertEqual(command.command, 'start')
+
+    def test_pipe_depth(self):
+        async def test_coro():
+            writer, reader, output, port = self.open_channel('pipe', 5)
+            # Nobody reads the pipe: packets pile up in the writer outgoing buffer once the pipe is full
+            while writer.put_packet_nowait(DataPacket(bytes(4096))):
+                pass
+            depth = writer.depth()
+            self.assertGreater(depth, 0)
+            # Reading packets lets the writer flush its outgoing buffer
+            for i in range(depth):
+                await port.read_packet()
+            await asyncio.sleep(0.01)
+            self.assertLess(writer.depth(), depth)
+            writer.close()
+            reader.close()
+
+        self.loop.run_until_complete(asyncio.wait_for(test_coro(), 5))
+
+    def test_shm_zero_copy(self):
+        async def test_coro():
+            writer, reader, output, port = self.open_channel('shm', 2, slot_size=1024)
+            await output.send_packet(DataPacket(b'first'))
+            await output.send_packet(DataPacket({'key': 'value'}))
+            # Slots are in use until the reader gives them back
+            self.assertEqual(writer.depth(), 2)
+            # The ring is full until the reader releases slots
+            third = asyncio.ensure_future(output.send_packet(DataPacket(bytearray(b'third'))))
+            port_, first = await port.read_packet()
+            self.assertIsInstance(first.payload, memoryview)
+            self.assertEqual(bytes(first.payload), b'first')
+            await asyncio.sleep(0.01)
+            self.assertFalse(third.done())
+            port_, second = await port.read_packet()
+            self.assertEqual(second.payload, {'key': 'value'})
+            await asyncio.wait_for(third, 1)
+            port_, packet = await port.read_packet()
+            self.assertEqual(bytes(packet.payload), b'third')
+            await asyncio.sleep(0.01)
+            self.assertEqual(writer.depth(), 1)
+            with self.assertRaises(ChannelException):
+                await output.send_packet(DataPacket(bytes(2048)))
+            writer.close()
+            reader.close()
+            # Views are released and both mappings closed
+            with self.assertRaises(ValueError):
+                bytes(packet.payload)
+            self.assertIsNone(writer._shm.buf)
+            self.assertIsNone(reader._shm.buf)
+
+        self.loop.run_until_complete(asyncio.wait_for(test_coro(), 5))
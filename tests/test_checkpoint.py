@@ -0,0 +1,133 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import os
+import pickle
+import tempfile
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.engine import EngineException
+from hbflow.core.checkpoint import load_checkpoint, CheckpointException
+from hbflow.core.packet import DataPacket
+from tests.components import LoopTestCase, chain_spec
+
+COMPONENT = 'hbflow.core.component.TestComponent'
+
+
+class Counter(Component):
+    _in = IN()
+    _out = OUT()
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.count = 0
+        self.delay = 0
+
+    async def on_packet(self, from_port, packet):
+        self.count += 1
+        await asyncio.sleep(self.delay)
+        await self._out.send_packet(packet)
+
+    def snapshot_state(self):
+        return self.count
+
+    def restore_state(self, state):
+        self.count = state
+
+
+def counter_spec():
+    counter = 'tests.test_checkpoint.Counter'
+    return {
+        'processes': {'source': {'component': COMPONENT}, 'first': {'component': counter},
+                      'second': {'component': counter}},
+        'connections': [
+            {'name': 'in', 'capacity': 100, 'source': {'process': 'source', 'port': '_out'},
+             'target': {'process': 'first', 'port': '_in'}},
+            {'name': 'middle', 'capacity': 2, 'source': {'process': 'first', 'port': '_out'},
+             'target': {'process': 'second', 'port': '_in'}},
+        ]
+    }
+
+
+class CheckpointTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'graph.checkpoint')
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def test_checkpoint_restore(self):
+        engine = self.init_engine(counter_spec())
+        first = engine._get_process('first')
+        second = engine._get_process('second')
+
+        async def test_coro():
+            for i in range(20):
+                engine.connections['in'].put_packet_nowait(DataPacket(i))
+            await asyncio.sleep(0)
+            checkpoint = await engine.checkpoint(self.path)
+            # Processes go on once the checkpoint is taken
+            await asyncio.sleep(0.01)
+            return checkpoint
+
+        checkpoint = self.loop.run_until_complete(test_coro())
+        self.assertEqual(second.count, 20)
+        self.assertEqual(engine.connections['middle'].capacity, 2)
+        self.assertIsNone(first._barrier)
+        # The snapshot is consistent: each packet is either queued or counted
+        counts = checkpoint.processes
+        queued = dict((key, len(packets)) for key, packets in checkpoint.connections.items())
+        self.assertEqual(counts['first'] + queued.get('in', 0), 20)
+        self.assertEqual(counts['second'] + queued.get('middle', 0), counts['first'])
+        self.assertLess(counts['second'], 20)
+
+        restored = self.init_engine(counter_spec())
+
+        async def restore_coro():
+            await restored.restore(self.path)
+            self.assertEqual(restored._get_process('first').count, counts['first'])
+            self.assertEqual(len(restored.connections['in'].packet_queue), queued.get('in', 0))
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(restore_coro())
+        self.assertEqual(restored._get_process('first').count, 20)
+        self.assertEqual(restored._get_process('second').count, 20)
+        self.assertEqual(restored._checkpoint_id, checkpoint.checkpoint_id)
+
+    def test_checkpoint_timeout(self):
+        engine = self.init_engine(counter_spec())
+        first = engine._get_process('first')
+        first.delay = 1
+
+        async def test_coro():
+            engine.connections['in'].put_packet_nowait(DataPacket(0))
+            await asyncio.sleep(0)
+            with self.assertRaises(EngineException):
+                await engine.checkpoint(self.path, timeout=0.01)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertIsNone(first._barrier)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_checkpoint_fused_metrics(self):
+        # Instrumented dispatch of fused targets must not unbalance the busy counts
+        engine = self.init_engine(chain_spec(), metrics=True)
+
+        async def test_coro():
+            for i in range(3):
+                await engine._get_process('source')._out.send_packet(DataPacket(i))
+            await asyncio.sleep(0.01)
+            self.assertEqual([process._busy for process in engine.processes.values()], [0] * 5)
+            await engine.checkpoint(timeout=0.1)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertEqual(engine._get_process('sink').received, [3, 4, 5])
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as stream:
+            pickle.dump((0, 1, {}, {}, {}), stream)
+        self.assertRaises(CheckpointException, load_checkpoint, self.path)
+        self.assertRaises(CheckpointException, load_checkpoint, self.path + '.missing')
@@ -0,0 +1,125 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import os
+import sys
+import shutil
+import tempfile
+from hbflow.core.compiler import compile_graph, graph_from_dictionary, load_plan, spec_hash, PLAN_SUFFIX
+from hbflow.core.engine import GraphEngine
+from hbflow.core.graph import GraphValidationException
+from tests.components import LoopTestCase
+
+MODULE = 'hbflow_compiler_test_components'
+MODULE_SOURCE = """
+from hbflow.core.component import Component, IN, OUT
+
+
+class Relay(Component):
+    _in = IN()
+    _out = OUT()
+"""
+
+
+def plan_spec(component):
+    return {
+        'graph': {
+            'name': 'compiled',
+            'processes': {
+                'first': {'component': component},
+                'second': {'component': component, 'group': 'workers'},
+            },
+            'connections': [{'name': 'cnx', 'source': {'process': 'first', 'port': '_out'},
+                             'target': {'process': 'second', 'port': '_in'}, 'capacity': 4}]
+        }
+    }
+
+
+class CompilerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.module_dir = tempfile.mkdtemp()
+        self.module_path = os.path.join(self.module_dir, MODULE + '.py')
+        with open(self.module_path, 'w') as stream:
+            stream.write(MODULE_SOURCE)
+        sys.path.insert(0, self.module_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.module_dir)
+        sys.modules.pop(MODULE, None)
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.module_dir)
+        super().tearDown()
+
+    def test_compile(self):
+        plan = compile_graph(graph_from_dictionary(plan_spec(MODULE + '.Relay')))
+        self.assertEqual(plan.groups, {'first': None, 'second': 'workers'})
+        self.assertEqual(plan.ports[MODULE + '.Relay']['_in'], 'in')
+        self.assertEqual(plan.ports[MODULE + '.Relay']['_out'], 'out')
+        self.assertEqual(plan.connections[0].capacity, 4)
+        self.assertEqual(plan.modules[MODULE][0], self.module_path)
+
+    def test_compile_errors(self):
+        spec = plan_spec(MODULE + '.Unknown')
+        spec['graph']['connections'][0]['buffer'] = 'unknown'
+        with self.assertRaises(GraphValidationException) as cm:
+            compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(len(cm.exception.errors), 3)
+
+    def test_compile_buffer_options(self):
+        spec = plan_spec(MODULE + '.Relay')
+        options = {'directory': self.cache_dir, 'segment_size': 4096, 'max_spill': 65536}
+        spec['graph']['connections'][0].update(buffer='spill', buffer_options=options)
+        # Both processes in the engine: the connection buffer is local
+        del spec['graph']['processes']['second']['group']
+        plan = compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(plan.connections[0].buffer_options, options)
+        engine = GraphEngine(loop=self.loop)
+        self.loop.run_until_complete(engine.bind(plan))
+        buffer = engine.connections['cnx'].packet_queue
+        self.assertEqual((buffer.directory, buffer.segment_size, buffer.max_spill),
+                         (self.cache_dir, 4096, 65536))
+        spec['graph']['connections'][0]['buffer'] = 'blocking'
+        with self.assertRaises(GraphValidationException) as cm:
+            compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(len(cm.exception.errors), 3)
+
+    def test_compile_shm_buffer(self):
+        spec = plan_spec(MODULE + '.Relay')
+        spec['graph']['connections'][0].update(transport='shm', buffer='unbounded')
+        compile_graph(graph_from_dictionary(spec))
+        spec['graph']['connections'][0]['buffer'] = 'priority'
+        with self.assertRaises(GraphValidationException) as cm:
+            compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(len(cm.exception.errors), 1)
+
+    def test_plan_cache(self):
+        spec = plan_spec(MODULE + '.Relay')
+        plan = load_plan(spec, self.cache_dir)
+        path = os.path.join(self.cache_dir, spec_hash(spec) + PLAN_SUFFIX)
+        self.assertTrue(os.path.exists(path))
+
+        # Cached plans don't import component modules until a class is needed
+        sys.modules.pop(MODULE)
+        cached = load_plan(spec, self.cache_dir)
+        self.assertEqual(cached.spec_hash, plan.spec_hash)
+        self.assertNotIn(MODULE, sys.modules)
+        self.assertEqual(cached.component_class('first').__name__, 'Relay')
+        self.assertIn(MODULE, sys.modules)
+
+        # A module change makes the cached plan stale
+        mtime = os.path.getmtime(self.module_path)
+        os.utime(self.module_path, (mtime + 10, mtime + 10))
+        self.assertTrue(cached.is_stale())
+        recompiled = load_plan(spec, self.cache_dir)
+        self.assertFalse(recompiled.is_stale())
+        self.assertEqual(recompiled.modules[MODULE][1], mtime + 10)
+
+    def test_engine_binds_plan(self):
+        spec = plan_spec('hbflow.core.component.TestComponent')
+        del spec['graph']['processes']['second']['group']
+        engine = GraphEngine(loop=self.loop)
+        self.loop.run_until_complete(engine.init_from_dictionary(spec, cache_dir=self.cache_dir))
+        self.assertEqual(len(engine.processes), 2)
+        self.assertEqual(engine._get_process('second')._in.connections[0].name, 'cnx')
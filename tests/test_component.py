@@ -0,0 +1,448 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import logging
+import os
+import threading
+import time
+from types import SimpleNamespace
+from hbflow.core.component import InputPort, OutputPort, Connection, Component, IN, OUT, FANOUT_ANY, FANOUT_NOWAIT, \
+    EXECUTION_THREAD, EXECUTION_PROCESS, ComponentException
+from transitions import MachineError
+from hbflow.core.packet import DataPacket
+from tests.components import LoopTestCase
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+log = logging.getLogger(__name__)
+
+
+def new_connections(target, count, **kwargs):
+    connections = []
+    for i in range(count):
+        source = OutputPort('out', SimpleNamespace(name='source_%d' % i))
+        cnx = Connection(**kwargs)
+        cnx.link(source, target)
+        connections.append(cnx)
+    return connections
+
+
+class SlowComponent(Component):
+    _in = IN()
+    _unordered_in = IN(ordered=False)
+    _out = OUT()
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.received = []
+        self.running = 0
+        self.max_running = 0
+
+    async def on_packet(self, from_port, packet):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(packet.payload)
+        self.received.append((from_port.name, packet.payload))
+        self.running -= 1
+
+
+class BatchComponent(SlowComponent):
+    batch_size = 4
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.batches = []
+
+    async def on_batch(self, from_port, packets):
+        self.batches.append([packet.payload for packet in packets])
+        await super().on_batch(from_port, packets)
+
+
+class BlockingComponent(Component):
+    _in = IN(ordered=False)
+    _out = OUT()
+    execution = EXECUTION_THREAD
+    pool_size = 4
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.factor = 10
+
+    def on_packet(self, from_port, packet):
+        time.sleep(0.05)
+        self.emit(self._out, DataPacket((os.getpid(), packet.payload * self.factor)))
+
+
+class OrderedBlockingComponent(Component):
+    """
+    Blocking component reading an ordered port: later packets are handled faster than earlier ones
+    """
+    _in = IN()
+    _out = OUT()
+    execution = EXECUTION_THREAD
+    pool_size = 4
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def on_packet(self, from_port, packet):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01 * (8 - packet.payload % 8))
+        with self.lock:
+            self.running -= 1
+        self.emit(self._out, DataPacket((os.getpid(), packet.payload)))
+
+
+class InputPortTest(LoopTestCase):
+    def test_read_round_robin(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            connections = new_connections(port, 3, capacity=10)
+            for cnx in connections:
+                for i in range(2):
+                    await cnx.put_packet(DataPacket((cnx.name, i)))
+            payloads = []
+            for i in range(6):
+                from_port, packet = await port.read_packet()
+                self.assertIs(from_port, port)
+                payloads.append(packet.payload)
+            return connections, payloads
+
+        connections, payloads = self.loop.run_until_complete(test_coro())
+        names = [cnx.name for cnx in connections]
+        self.assertEqual(payloads, [(names[0], 0), (names[1], 0), (names[2], 0),
+                                    (names[0], 1), (names[1], 1), (names[2], 1)])
+
+    def test_read_weighted(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            heavy = new_connections(port, 1, capacity=10, weight=3)[0]
+            light = new_connections(port, 1, capacity=10)[0]
+            for i in range(4):
+                await heavy.put_packet(DataPacket('heavy'))
+                await light.put_packet(DataPacket('light'))
+            return [(await port.read_packet())[1].payload for i in range(8)]
+
+        payloads = self.loop.run_until_complete(test_coro())
+        self.assertEqual(payloads, ['heavy', 'heavy', 'heavy', 'light', 'heavy', 'light', 'light', 'light'])
+
+    def test_read_lossless(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            connections = new_connections(port, 64)
+            received = []
+
+            async def producer(cnx):
+                for i in range(10):
+                    await cnx.put_packet(DataPacket(i))
+
+            async def consumer():
+                while True:
+                    port_, packet = await port.read_packet()
+                    received.append(packet)
+
+            producers = [asyncio.ensure_future(producer(cnx)) for cnx in connections]
+            # Cancel and restart reads while producers are running: no packet may be lost
+            for i in range(5):
+                reader = asyncio.ensure_future(consumer())
+                await asyncio.sleep(0)
+                reader.cancel()
+            reader = asyncio.ensure_future(consumer())
+            await asyncio.gather(*producers)
+            while len(received) < 640:
+                await asyncio.sleep(0)
+            reader.cancel()
+            return received
+
+        received = self.loop.run_until_complete(test_coro())
+        self.assertEqual(len(received), 640)
+        self.assertEqual(len(set(id(p) for p in received)), 640)
+
+    def test_read_batch(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            first, second = new_connections(port, 2, capacity=3)
+            await first.put_batch([DataPacket(i) for i in range(3)])
+            await second.put_batch([DataPacket(10), DataPacket(11)])
+            batches = []
+            for i in range(2):
+                port_, packets = await port.read_batch(4)
+                batches.append([packet.payload for packet in packets])
+
+            async def producer():
+                for i in range(3):
+                    await asyncio.sleep(0.005)
+                    await first.put_packet(DataPacket(20 + i))
+            task = asyncio.ensure_future(producer())
+            port_, packets = await port.read_batch(4, 0.05)
+            batches.append([packet.payload for packet in packets])
+            await task
+            return batches
+
+        batches = self.loop.run_until_complete(test_coro())
+        self.assertEqual(batches, [[0, 10, 1, 11], [2], [20, 21, 22]])
+
+    def test_read_batch_single_connection(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            cnx = new_connections(port, 1, capacity=10)[0]
+            cnx.put_batch_nowait([DataPacket(i) for i in range(6)])
+            gets = []
+            get_many_nowait = cnx.packet_queue.get_many_nowait
+            cnx.packet_queue.get_many_nowait = lambda max_items: gets.append(max_items) or get_many_nowait(max_items)
+            # A single ready connection delivers the whole batch at once, whatever its weight
+            self.assertEqual(len(port.get_batch_nowait(4)), 4)
+            self.assertEqual(gets, [4])
+            self.assertEqual(len(cnx.packet_queue), 2)
+
+        self.loop.run_until_complete(test_coro())
+
+    def test_send_batch(self):
+        async def test_coro():
+            port = InputPort('in', SimpleNamespace(name='target'))
+            output = OutputPort('out', SimpleNamespace(name='source'))
+            for i in range(2):
+                Connection(capacity=2).link(output, port)
+            sender = asyncio.ensure_future(output.send_batch([DataPacket(i) for i in range(3)]))
+            payloads = []
+            while len(payloads) < 6:
+                port_, packet = await port.read_packet()
+                payloads.append(packet.payload)
+            await sender
+            return payloads
+
+        self.assertEqual(sorted(self.loop.run_until_complete(test_coro())), [0, 0, 1, 1, 2, 2])
+
+
+class OutputPortTest(LoopTestCase):
+    def new_output(self, count, **kwargs):
+        output = OutputPort('out', SimpleNamespace(name='source'), **kwargs)
+        connections = [Connection(capacity=1) for i in range(count)]
+        for i, cnx in enumerate(connections):
+            cnx.link(output, InputPort('in', SimpleNamespace(name='target_%d' % i)))
+        return output, connections
+
+    def test_fanout_all(self):
+        async def test_coro():
+            output, (full, free) = self.new_output(2)
+            await full.put_packet(DataPacket('first'))
+            packet = DataPacket('second')
+            send = asyncio.ensure_future(output.send_packet(packet))
+            await asyncio.sleep(0)
+            # The free connection got the packet even though the other one is full
+            self.assertIs(free.get_packet_nowait(), packet)
+            self.assertFalse(send.done())
+            full.get_packet_nowait()
+            await send
+            self.assertIs(full.get_packet_nowait(), packet)
+        self.loop.run_until_complete(test_coro())
+
+    def test_fanout_any(self):
+        async def test_coro():
+            output, (full, free) = self.new_output(2, fanout=FANOUT_ANY)
+            await full.put_packet(DataPacket('first'))
+            await output.send_packet(DataPacket('second'))
+            self.assertEqual(free.get_packet_nowait().payload, 'second')
+            self.assertEqual(full.get_packet_nowait().payload, 'first')
+            await asyncio.sleep(0)
+            self.assertEqual(full.get_packet_nowait().payload, 'second')
+        self.loop.run_until_complete(test_coro())
+
+    def test_fanout_any_backlog(self):
+        async def test_coro():
+            output, (stuck, free) = self.new_output(2, fanout=FANOUT_ANY)
+            for i in range(1000):
+                await output.send_packet(DataPacket(i))
+                free.get_packet_nowait()
+            # One packet queued and one background put at most for the stuck connection, others are dropped
+            self.assertEqual(len(output._background), 1)
+            self.assertEqual(output.dropped, 998)
+            self.assertEqual(stuck.get_packet_nowait().payload, 0)
+            await asyncio.sleep(0.001)
+            self.assertEqual(stuck.get_packet_nowait().payload, 1)
+            self.assertEqual(len(output._background), 0)
+            # With all connections busy, sending waits
+            output, (stuck,) = self.new_output(1, fanout=FANOUT_ANY)
+            await output.send_packet(DataPacket('first'))
+            send = asyncio.ensure_future(output.send_packet(DataPacket('second')))
+            await asyncio.sleep(0.01)
+            self.assertFalse(send.done())
+            third = asyncio.ensure_future(output.send_packet(DataPacket('third')))
+            await asyncio.sleep(0.01)
+            self.assertFalse(third.done())
+            self.assertEqual(stuck.get_packet_nowait().payload, 'first')
+            await send
+            self.assertEqual(stuck.get_packet_nowait().payload, 'second')
+            await third
+            self.assertEqual(stuck.get_packet_nowait().payload, 'third')
+            self.assertEqual(output.dropped, 0)
+        self.loop.run_until_complete(test_coro())
+
+    def test_fanout_nowait(self):
+        async def test_coro():
+            output, (full, free) = self.new_output(2, fanout=FANOUT_NOWAIT)
+            await full.put_packet(DataPacket('first'))
+            await output.send_packet(DataPacket('second'))
+            self.assertEqual(output.dropped, 1)
+            self.assertEqual(free.get_packet_nowait().payload, 'second')
+            await output.send_batch([DataPacket(i) for i in range(3)])
+            self.assertEqual(output.dropped, 6)
+        self.loop.run_until_complete(test_coro())
+
+    def test_copy_on_send(self):
+        async def test_coro():
+            output, connections = self.new_output(2, copy_on_send=True)
+            packet = DataPacket({'key': 'value'})
+            await output.send_packet(packet)
+            first, second = [cnx.get_packet_nowait() for cnx in connections]
+            self.assertEqual(first.payload, packet.payload)
+            self.assertIsNot(first.payload, packet.payload)
+            self.assertIsNot(first.payload, second.payload)
+        self.loop.run_until_complete(test_coro())
+
+
+class ComponentDispatchTest(LoopTestCase):
+    def run_component(self, component, packets):
+        async def test_coro():
+            connections = {}
+            for port_name, delay in packets:
+                if port_name not in connections:
+                    connections[port_name] = new_connections(component.input_port(port_name), 1, capacity=100)[0]
+                await connections[port_name].put_packet(DataPacket(delay))
+            while len(component.received) < len(packets):
+                await asyncio.sleep(0.001)
+        self.loop.run_until_complete(asyncio.wait_for(test_coro(), 5))
+
+    def test_dispatch_data_ports(self):
+        component = SlowComponent()
+        self.run_component(component, [('_in', 0), ('_unordered_in', 0), ('_in', 0)])
+        self.assertEqual(sorted(component.received), [('_in', 0), ('_in', 0), ('_unordered_in', 0)])
+        self.assertEqual(component.max_running, 1)
+
+    def test_dispatch_concurrency(self):
+        component = SlowComponent()
+        component.concurrency = 3
+        self.run_component(component, [('_unordered_in', 0.03), ('_unordered_in', 0.02), ('_unordered_in', 0.01)])
+        self.assertEqual(component.max_running, 3)
+        self.assertEqual([payload for port, payload in component.received], [0.01, 0.02, 0.03])
+
+    def test_dispatch_ordered(self):
+        component = SlowComponent()
+        component.concurrency = 3
+        self.run_component(component, [('_in', 0.03), ('_in', 0.02), ('_in', 0.01), ('_unordered_in', 0.01)])
+        self.assertEqual(component.max_running, 2)
+        self.assertEqual([payload for port, payload in component.received if port == '_in'], [0.03, 0.02, 0.01])
+
+    def test_cancelled_dispatch_not_busy(self):
+        component = SlowComponent()
+        component.concurrency = 2
+
+        async def test_coro():
+            cnx = new_connections(component._unordered_in, 1, capacity=10)[0]
+            await cnx.put_batch([DataPacket(0.05) for i in range(3)])
+            await asyncio.sleep(0.01)
+            # Two packets are handled, the third one waits for a dispatch slot
+            self.assertEqual(component._busy, 3)
+            component._packet_task.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(component._busy, 2)
+            await asyncio.wait_for(component._wait_idle(), 1)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertEqual(component._busy, 0)
+        self.assertEqual(len(component.received), 2)
+
+    def test_dispatch_batch(self):
+        component = BatchComponent()
+        self.run_component(component, [('_in', i / 1000) for i in range(6)])
+        self.assertEqual(component.batches, [[0, 0.001, 0.002, 0.003], [0.004, 0.005]])
+
+
+class ExecutionModeTest(LoopTestCase):
+    def run_component(self, component, count):
+        async def test_coro():
+            source = new_connections(component._in, 1, capacity=count)[0]
+            target = InputPort('in', SimpleNamespace(name='target'))
+            Connection(capacity=1).link(component._out, target)
+            await source.put_batch([DataPacket(i) for i in range(count)])
+            start = time.perf_counter()
+            payloads = [(await target.read_packet())[1].payload for i in range(count)]
+            return payloads, time.perf_counter() - start
+        try:
+            return self.loop.run_until_complete(asyncio.wait_for(test_coro(), 10))
+        finally:
+            component.close()
+
+    def test_thread_execution(self):
+        component = BlockingComponent()
+        payloads, elapsed = self.run_component(component, 8)
+        self.assertEqual(sorted(payload for pid, payload in payloads), [i * 10 for i in range(8)])
+        self.assertLess(elapsed, 8 * 0.05)
+
+    def test_thread_execution_ordered(self):
+        component = OrderedBlockingComponent()
+        payloads, elapsed = self.run_component(component, 8)
+        self.assertEqual([payload for pid, payload in payloads], list(range(8)))
+        self.assertGreater(component.max_running, 1)
+        self.assertLess(elapsed, 0.01 * sum(range(1, 9)))
+
+    def test_process_execution(self):
+        component = BlockingComponent()
+        component.factor = 100
+        component.set_execution(EXECUTION_PROCESS, 2)
+        payloads, elapsed = self.run_component(component, 4)
+        self.assertEqual(sorted(payload for pid, payload in payloads), [i * 100 for i in range(4)])
+        self.assertNotIn(os.getpid(), [pid for pid, payload in payloads])
+
+    def test_invalid_execution(self):
+        component = SlowComponent()
+        self.assertRaises(ComponentException, component.set_execution, EXECUTION_THREAD)
+        self.assertRaises(ComponentException, component.set_execution, 'unknown')
+
+
+class ComponentSchemaTest(LoopTestCase):
+    def test_port_table(self):
+        table = SlowComponent.port_table()
+        self.assertEqual(set(table), {'_in', '_unordered_in', '_out', '_log_out', '_command_in', '_status_out',
+                                      '_expired_out'})
+        self.assertFalse(table['_unordered_in'].ordered)
+        self.assertIs(SlowComponent.port_table(), table)
+        component = SlowComponent()
+        self.assertIsInstance(component._in, InputPort)
+        self.assertIsInstance(component._out, OutputPort)
+
+    def test_lazy_ports(self):
+        component = SlowComponent()
+        self.assertEqual(component._input_ports, [])
+        port = component.get_port('_in')
+        self.assertIs(component._in, port)
+        self.assertEqual(component._input_ports, [port])
+        self.assertNotIn('_status_out', component.__dict__)
+        # The packet loop reads every input port
+        component._start_packet_loop()
+        self.assertEqual(sorted(port.name for port in component._input_ports),
+                         ['_command_in', '_in', '_log_out', '_unordered_in'])
+        component.close()
+
+    def test_lifecycle_state(self):
+        component = SlowComponent()
+        self.assertTrue(component.is_new())
+        component.start()
+        component.start_ok()
+        self.assertEqual(component.state, 'idle')
+        self.assertRaises(MachineError, component.start)
+        self.assertEqual(SlowComponent().state, 'new')
+
+    def test_connection_slots(self):
+        port = InputPort('in', SimpleNamespace(name='sink'))
+        cnx = new_connections(port, 1)[0]
+        self.assertTrue(cnx.is_linked())
+        self.assertFalse(hasattr(cnx, '__dict__'))
+        self.assertFalse(hasattr(port, '__dict__'))
+        self.assertTrue(port.connected_event.is_set())
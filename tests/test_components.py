@@ -0,0 +1,173 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import os
+import tempfile
+from hbflow.core.component import ComponentException
+from hbflow.core.commands import SET_CONTEXT
+from hbflow.core.engine import GraphEngine
+from hbflow.core.packet import DataPacket
+from hbflow.components import FrameDecoder, FRAME_HEADER, MODE_CHUNKS
+from hbflow.components import files
+from hbflow.components.sockets import ConnectionPool, SocketSink
+from tests.components import LoopTestCase, component_chain_spec
+
+
+def frames(records):
+    return b''.join(FRAME_HEADER.pack(len(record)) + record for record in records)
+
+
+class StreamComponentTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def write_file(self, content):
+        path = os.path.join(self.directory.name, 'input')
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        return path
+
+    async def run_chain(self, settings, *components, concurrency=None):
+        """
+        Run a chain of processes p0 -> p1 ... with settings by process name, until p0 has finished reading
+        """
+        engine = GraphEngine(loop=self.loop)
+        await engine.init_from_dictionary(component_chain_spec(*components, concurrency=concurrency))
+        for name, values in settings.items():
+            await engine.send_command(SET_CONTEXT, values, processes=[name])
+        await engine.start()
+        await asyncio.wait_for(engine._get_process('p0').finished.wait(), 5)
+        await asyncio.sleep(0.01)
+        return engine
+
+    def test_file_lines(self):
+        lines = [b'line %d' % i for i in range(100)] + [b'x' * 50, b'', b'last']
+        path = self.write_file(b'\n'.join(lines))
+        read_size = files.READ_SIZE
+        files.READ_SIZE = 16
+        try:
+            engine = self.loop.run_until_complete(self.run_chain({'p0': {'path': path, 'max_batch': 7}},
+                                                                 'hbflow.components.FileReader',
+                                                                 'tests.components.Collector'))
+        finally:
+            files.READ_SIZE = read_size
+        self.assertEqual(engine._get_process('p1').received, lines)
+        self.assertEqual(engine._get_process('p0').packets, len(lines))
+
+    def test_file_chunks(self):
+        path = self.write_file(bytes(range(256)) * 10)
+        engine = self.loop.run_until_complete(self.run_chain({'p0': {'path': path, 'mode': MODE_CHUNKS,
+                                                                     'chunk_size': 1000, 'max_batch': 2}},
+                                                             'hbflow.components.FileReader',
+                                                             'tests.components.Collector'))
+        received = engine._get_process('p1').received
+        self.assertEqual([len(chunk) for chunk in received], [1000, 1000, 560])
+        self.assertEqual(b''.join(received), bytes(range(256)) * 10)
+
+    def test_socket_source(self):
+        records = [b'record %d' % i for i in range(1000)]
+
+        async def serve(reader, writer):
+            data = frames(records)
+            # Records span writes
+            for start in range(0, len(data), 100):
+                writer.write(data[start:start + 100])
+                await writer.drain()
+            writer.close()
+
+        async def test_coro():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await self.run_chain({'p0': {'host': '127.0.0.1', 'port': port, 'read_size': 64}},
+                                            'hbflow.components.SocketSource', 'hbflow.components.FrameDecoder',
+                                            'tests.components.Collector')
+            finally:
+                server.close()
+
+        engine = self.loop.run_until_complete(test_coro())
+        self.assertEqual(engine._get_process('p2').received, records)
+
+    def test_socket_sink(self):
+        lines = [b'line %d' % i for i in range(2000)]
+        path = self.write_file(b'\n'.join(lines))
+        socket_path = os.path.join(self.directory.name, 'socket')
+        received = bytearray()
+        connections = []
+
+        async def serve(reader, writer):
+            connections.append(writer)
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                received.extend(data)
+
+        async def test_coro():
+            server = await asyncio.start_unix_server(serve, socket_path)
+            try:
+                engine = await self.run_chain({'p0': {'path': path, 'max_batch': 100},
+                                               'p2': {'path': socket_path}},
+                                              'hbflow.components.FileReader', 'hbflow.components.FrameEncoder',
+                                              'hbflow.components.SocketSink', concurrency=2)
+                await asyncio.sleep(0.05)
+                await engine.stop()
+                return engine
+            finally:
+                server.close()
+
+        engine = self.loop.run_until_complete(test_coro())
+        sink = engine._get_process('p2')
+        self.assertEqual(sink.bytes, len(received))
+        self.assertLessEqual(len(connections), 2)
+        decoded = []
+        offset = 0
+        while offset < len(received):
+            length = FRAME_HEADER.unpack_from(received, offset)[0]
+            decoded.append(bytes(received[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+        self.assertEqual(sorted(decoded), sorted(lines))
+
+    def test_socket_sink_cancelled(self):
+        socket_path = os.path.join(self.directory.name, 'socket')
+        connections = []
+
+        async def serve(reader, writer):
+            # Never read: writes wait for the socket to drain
+            connections.append(writer)
+
+        async def test_coro():
+            server = await asyncio.start_unix_server(serve, socket_path)
+            sink = SocketSink('sink', loop=self.loop)
+            sink.path = socket_path
+            sink.connections = 1
+            sink._pool = ConnectionPool(path=socket_path, write_buffer=1024, loop=self.loop)
+            try:
+                task = self.loop.create_task(sink.on_batch(None, [DataPacket(b'x' * (8 * 1024 * 1024))]))
+                await asyncio.sleep(0.1)
+                self.assertFalse(task.done())
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                return sink._pool._opened, len(sink._pool._idle)
+            finally:
+                sink.close()
+                server.close()
+
+        opened, idle = self.loop.run_until_complete(test_coro())
+        # The cancelled write closed its connection instead of leaking it or giving it back half written
+        self.assertEqual((opened, idle), (0, 0))
+        self.assertEqual(len(connections), 1)
+
+    def test_invalid_frame(self):
+        decoder = FrameDecoder('decoder')
+        decoder.max_frame = 10
+        with self.assertRaises(ComponentException):
+            self.loop.run_until_complete(decoder.on_batch(None, [DataPacket(frames([b'x' * 20]))]))
+        self.assertEqual(len(decoder._buffer), 0)
@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+from hbflow.core.component import Component, IN
+from hbflow.core.control import CommandBus
+from tests.components import LoopTestCase
+
+
+class Listener(Component):
+    _in = IN()
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.commands = []
+
+    def _handle_command_ping(self, packet):
+        self.commands.append(packet.args)
+
+
+class CommandBusTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.groups = {'a': None, 'b': None, 'remote': 'workers'}
+        self.bus = CommandBus(self.groups, loop=self.loop)
+        self.listeners = dict((name, Listener(name)) for name in ('a', 'b'))
+        for listener in self.listeners.values():
+            self.bus.subscribe(listener)
+        self.forwarded = []
+        self.bus.add_group('workers', self.forwarded.append)
+
+    def test_broadcast(self):
+        version = self.bus.publish('ping', 1)
+        self.assertEqual(version, 1)
+        self.assertEqual([listener.commands for listener in self.listeners.values()], [[1], [1]])
+        self.assertEqual(self.listeners['a'].command_version, 1)
+        self.assertEqual([entry.version for entry in self.forwarded], [1])
+        self.assertEqual(self.loop.run_until_complete(self.bus.wait_acknowledged(version, 0.01)), {'remote'})
+        self.bus.acknowledge(version, ['remote'])
+        self.assertEqual(self.loop.run_until_complete(self.bus.wait_acknowledged(version)), set())
+        self.assertEqual(len(self.bus.log), 1)
+
+    def test_targets(self):
+        self.bus.publish('ping', 1, processes=['b'])
+        self.bus.publish('ping', 2, groups=[None])
+        self.bus.publish('ping', 3, groups=['workers'])
+        self.assertEqual(self.listeners['a'].commands, [2])
+        self.assertEqual(self.listeners['b'].commands, [1, 2])
+        self.assertEqual([entry.packet.args for entry in self.forwarded], [3])
+
+    def test_unsubscribe(self):
+        version = self.bus.publish('ping', 1, groups=['workers'])
+        self.bus.remove_group('workers')
+        self.assertEqual(self.loop.run_until_complete(self.bus.wait_acknowledged(version, 0.01)), set())
+        self.bus.unsubscribe('a')
+        self.assertIsNone(self.listeners['a']._command_bus)
+        self.bus.publish('ping', 2)
+        self.assertEqual(self.listeners['a'].commands, [])
+
+
+class EngineCommandTest(LoopTestCase):
+    def test_send_command(self):
+        spec = {'processes': dict(('p%d' % i, {'component': 'tests.test_control.Listener'}) for i in range(3))}
+        engine = self.init_engine(spec)
+        self.assertEqual(self.loop.run_until_complete(engine.start()), set())
+
+        async def test_coro():
+            version = await engine.send_command('ping', 'hello', processes=['p1'])
+            return await engine.wait_acknowledged(version)
+        self.assertEqual(self.loop.run_until_complete(test_coro()), set())
+        self.assertEqual([engine._get_process('p%d' % i).commands for i in range(3)], [[], ['hello'], []])
+        # Processes don't read their command port when they receive commands from the bus
+        self.assertTrue(all(not process._command_in.connections for process in engine.processes.values()))
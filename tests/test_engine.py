@@ -0,0 +1,195 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import logging
+from hbflow.core.engine import GraphEngine
+from hbflow.core.graph import GraphException, GraphValidationException
+from hbflow.core.buffer import DropOldestBuffer, PacketBuffer
+from hbflow.core.component import Connection, FusedConnection
+from hbflow.core.packet import DataPacket
+from hbflow.core.compiler import graph_from_dictionary
+from hbflow.core.engine import EngineException
+from tests.components import LoopTestCase, COMPONENT, chain_spec, graph_spec
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+log = logging.getLogger(__name__)
+
+
+class GraphEngineTest(LoopTestCase):
+    def test_connection_capacity(self):
+        engine = self.init_engine(graph_spec({'name': 'default'}, {'name': 'large', 'capacity': 50},
+                                             {'name': 'ring', 'capacity': 10, 'buffer': 'drop_oldest'}))
+        default = engine.connections['default']
+        self.assertEqual(default.packet_queue.capacity, 1)
+        self.assertIsInstance(default.packet_queue, PacketBuffer)
+        self.assertEqual(engine.connections['large'].packet_queue.capacity, 50)
+        ring = engine.connections['ring'].packet_queue
+        self.assertIsInstance(ring, DropOldestBuffer)
+        self.assertEqual(ring.capacity, 10)
+
+    def test_invalid_buffer_policy(self):
+        engine = GraphEngine(loop=self.loop)
+        with self.assertRaises(GraphException):
+            self.loop.run_until_complete(engine.init_from_dictionary(graph_spec({'buffer': 'unknown'})))
+
+    def test_validation_reports_all_errors(self):
+        spec = graph_spec({'name': 'bad_source', 'source': {'process': 'unknown', 'port': '_out'}},
+                          {'name': 'bad_port', 'target': {'process': 'second', 'port': 'nothing'}},
+                          {'name': 'wrong_direction', 'source': {'process': 'first', 'port': '_in'}},
+                          {'name': 'good'})
+        spec['graph']['processes']['third'] = {'component': 'hbflow.core.component.Unknown'}
+        engine = GraphEngine(loop=self.loop)
+        with self.assertRaises(GraphValidationException) as cm:
+            self.loop.run_until_complete(engine.init_from_dictionary(spec))
+        errors = cm.exception.errors
+        self.assertEqual(len(errors), 4)
+        self.assertTrue(errors[0].startswith("Process 'third'"))
+        self.assertIn("unknown source process 'unknown'", errors[1])
+        self.assertIn("no input port named 'nothing'", errors[2])
+        self.assertIn("no output port named '_in'", errors[3])
+        self.assertEqual(engine.processes, dict())
+
+    def test_process_index(self):
+        engine = self.init_engine(graph_spec({'name': 'cnx'}))
+        second = engine._get_process('second')
+        self.assertEqual(second.name, 'second')
+        self.assertIsNone(engine._get_process('unknown'))
+        self.assertEqual(second._in.connections[0].name, 'cnx')
+        self.assertIs(engine.processes['second'], second)
+        # Binding doesn't generate ids
+        self.assertIsNone(second._id)
+        self.assertIsNone(engine.connections['cnx']._id)
+
+    def test_fusion(self):
+        engine = self.init_engine(chain_spec())
+        self.assertIsInstance(engine.connections['source-inc_0'], FusedConnection)
+        self.assertIsInstance(engine.connections['inc_2-sink'], Connection)
+        self.assertNotIsInstance(engine.connections['inc_2-sink'], FusedConnection)
+
+        async def test_coro():
+            source = engine._get_process('source')
+            for payload in (1, None, 10):
+                await source._out.send_packet(DataPacket(payload))
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertEqual(engine._get_process('sink').received, [4, 13])
+        self.assertEqual(engine.connections['inc_0-inc_1'].packets, 2)
+
+    def test_no_fusion(self):
+        engine = self.init_engine(chain_spec(), fusion=False)
+        self.assertFalse(any(isinstance(cnx, FusedConnection) for cnx in engine.connections.values()))
+        engine = self.init_engine(chain_spec(capacity=10))
+        self.assertFalse(any(isinstance(cnx, FusedConnection) for cnx in engine.connections.values()))
+
+
+def collect_spec():
+    return {
+        'processes': {
+            'source': {'component': COMPONENT},
+            'sink': {'component': 'tests.components.Collector'},
+            'other': {'component': 'tests.components.Collector'},
+        },
+        'connections': [{'name': 'cnx', 'capacity': 10, 'source': {'process': 'source', 'port': '_out'},
+                         'target': {'process': 'sink', 'port': '_in'}}]
+    }
+
+
+class ReconfigurationTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.engine = self.init_engine(collect_spec())
+
+    def process(self, name):
+        return self.engine._get_process(name)
+
+    def queue_packets(self, count):
+        cnx = self.engine.connections['cnx']
+        for i in range(count):
+            cnx.put_packet_nowait(DataPacket(i))
+        return cnx
+
+    def test_remove_connection_drains(self):
+        cnx = self.queue_packets(5)
+        self.loop.run_until_complete(self.engine.remove_connection('cnx'))
+        self.assertEqual(self.process('sink').received, [0, 1, 2, 3, 4])
+        self.assertEqual(self.process('source')._out.connections, [])
+        self.assertEqual(self.process('sink')._in.connections, [])
+        self.assertTrue(cnx.is_unlinked())
+        self.assertNotIn(cnx.id, self.engine.connections)
+        self.assertEqual(self.engine._graph.connections_desc, [])
+
+    def test_remove_connection_without_drain(self):
+        async def test_coro():
+            self.queue_packets(3)
+            await self.engine.remove_connection('cnx', drain=False)
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertEqual(self.process('sink').received, [])
+        self.assertRaises(EngineException, self.loop.run_until_complete, self.engine.remove_connection('cnx'))
+
+    def test_redirect_connection(self):
+        async def test_coro():
+            self.queue_packets(3)
+            await self.engine.redirect_connection('cnx', target_process_name='other')
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(test_coro())
+        self.assertEqual(self.process('sink').received, [])
+        self.assertEqual(self.process('other').received, [0, 1, 2])
+        self.assertEqual(self.engine._graph.connections_desc[0].target_process_name, 'other')
+
+    def test_add_remove_process(self):
+        async def test_coro():
+            await self.engine.add_process('extra', 'tests.components.Collector')
+            await self.engine.add_connection('to_extra', 'source', '_out', 'extra', '_in', capacity=5)
+            await self.process('source')._out.send_packet(DataPacket('x'))
+            await asyncio.sleep(0.01)
+            extra = self.process('extra')
+            self.assertEqual(extra.received, ['x'])
+            self.assertEqual(self.process('sink').received, ['x'])
+            await self.engine.remove_process('extra')
+            await asyncio.sleep(0.01)
+            return extra
+
+        extra = self.loop.run_until_complete(test_coro())
+        self.assertIsNone(self.process('extra'))
+        self.assertTrue(extra._packet_task.done())
+        self.assertEqual(len(self.process('source')._out.connections), 1)
+        self.assertNotIn('to_extra', self.engine.connections)
+        with self.assertRaises(EngineException):
+            self.loop.run_until_complete(self.engine.add_connection('bad', 'source', '_out', 'unknown', '_in'))
+
+    def test_reconfigure(self):
+        spec = collect_spec()
+        spec['processes']['late'] = {'component': 'tests.components.Collector'}
+        spec['connections'][0]['target']['process'] = 'other'
+        spec['connections'].append({'name': 'late_cnx', 'source': {'process': 'source', 'port': '_out'},
+                                    'target': {'process': 'late', 'port': '_in'}})
+        del spec['processes']['sink']
+        graph = graph_from_dictionary(spec)
+        diff = self.engine._graph.diff(graph)
+        self.assertEqual([p.process_name for p in diff.added_processes], ['late'])
+        self.assertEqual(diff.removed_processes, ['sink'])
+        self.assertEqual([c.connection_name for c in diff.redirected_connections], ['cnx'])
+        self.assertEqual([c.connection_name for c in diff.added_connections], ['late_cnx'])
+
+        source = self.process('source')
+
+        async def test_coro():
+            # Packets queued for the removed sink are delivered to the process the connection is redirected to
+            cnx = self.queue_packets(2)
+            await self.engine.reconfigure(graph)
+            await asyncio.sleep(0.01)
+            return cnx
+
+        cnx = self.loop.run_until_complete(test_coro())
+        self.assertEqual(self.process('other').received, [0, 1])
+        self.assertIs(self.process('source'), source)
+        self.assertIs(self.engine.connections['cnx'], cnx)
+        self.assertIsNone(self.process('sink'))
+        self.assertEqual(sorted(self.engine.processes), ['late', 'other', 'source'])
+        self.assertEqual(self.engine._graph.diff(graph), ([], [], [], [], []))
@@ -0,0 +1,85 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+from hbflow.core.engine import EngineException
+from hbflow.core.flow import TokenBucket, FlowController, FlowException
+from tests.components import LoopTestCase, chain_spec
+
+
+class TokenBucketTest(LoopTestCase):
+    def test_rate(self):
+        async def test_coro():
+            bucket = TokenBucket(1000, 10)
+            start = self.loop.time()
+            for i in range(60):
+                await bucket.acquire()
+            # The first 10 packets go at once, the next 50 at 1000 packets per second
+            return self.loop.time() - start
+        self.assertGreaterEqual(self.loop.run_until_complete(test_coro()), 0.045)
+
+    def test_invalid_rate(self):
+        self.assertRaises(FlowException, TokenBucket, 0)
+
+
+class FlowControllerTest(LoopTestCase):
+    def bind(self, **kwargs):
+        return self.init_engine(chain_spec(), fusion=False, **kwargs)
+
+    def deliver(self, engine, counts):
+        for cnx in engine.connections.values():
+            if cnx.name in counts:
+                cnx.packet_queue.delivered += counts[cnx.name]
+
+    def capacities(self, engine):
+        return dict((name, stats['capacity']) for name, stats in engine.flow.snapshot().items())
+
+    def test_requires_target(self):
+        self.assertRaises(FlowException, FlowController, None)
+
+    def test_latency_target(self):
+        # 4 connections on the path: each one gets 0.1s worth of packets
+        engine = self.bind(latency_target=0.4)
+        engine.flow.stop()
+        engine.flow.adjust(1.0)
+        self.assertEqual(set(self.capacities(engine).values()), {1})
+        self.deliver(engine, dict((name, 2000) for name in self.capacities(engine)))
+        engine.flow.adjust(1.0)
+        self.assertEqual(set(self.capacities(engine).values()), {100})
+        self.loop.run_until_complete(engine.stop())
+        self.assertIsNone(engine.flow)
+
+    def test_buffer_budget(self):
+        engine = self.bind(latency_target=0.4, buffer_budget=40)
+        engine.flow.stop()
+        engine.flow.adjust(1.0)
+        self.deliver(engine, dict((name, 2000) for name in self.capacities(engine)))
+        engine.flow.adjust(1.0)
+        self.assertEqual(set(self.capacities(engine).values()), {10})
+
+    def test_budget_shared_by_throughput(self):
+        engine = self.bind(buffer_budget=100)
+        engine.flow.stop()
+        engine.flow.adjust(1.0)
+        self.deliver(engine, {'source-inc_0': 300, 'inc_0-inc_1': 100})
+        engine.flow.adjust(1.0)
+        capacities = self.capacities(engine)
+        self.assertEqual(capacities['source-inc_0'], 75)
+        self.assertEqual(capacities['inc_0-inc_1'], 25)
+        self.assertEqual(capacities['inc_2-sink'], 1)
+
+    def test_controller_runs(self):
+        engine = self.bind(latency_target=0.4)
+        engine.flow.interval = 0.01
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(len(engine.flow.snapshot()), 4)
+        self.loop.run_until_complete(engine.stop())
+
+    def test_set_rate_limit(self):
+        engine = self.bind()
+        engine.set_rate_limit('source', '_out', 100)
+        self.assertEqual(engine._get_process('source')._out.limiter.rate, 100)
+        engine.set_rate_limit('source', '_out', None)
+        self.assertIsNone(engine._get_process('source')._out.limiter)
+        self.assertRaises(EngineException, engine.set_rate_limit, 'source', '_in', 100)
+        self.assertRaises(EngineException, engine.set_rate_limit, 'source', '_out', -1)
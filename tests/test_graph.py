@@ -2,9 +2,9 @@
 #
 # See the file license.txt for copying permission.
 import logging
-import unittest
 import yaml
-import asyncio
+from hbflow.core.graph import Graph, GraphException
+from tests.components import LoopTestCase
 
 formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
 logging.basicConfig(level=logging.DEBUG, format=formatter)
@@ -15,20 +15,13 @@ def read_yaml(file):
     dict = None
     try:
         with open(file, 'r') as stream:
-            dict = yaml.load(stream)
+            dict = yaml.safe_load(stream)
     except yaml.YAMLError as exc:
         log.error("Invalid config_file %s: %s" % (file, exc))
     return dict
 
 
-class GraphTest(unittest.TestCase):
-    def setUp(self):
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-
-    def tearDown(self):
-        self.loop.close()
-
+class GraphTest(LoopTestCase):
     def test_create_from_dictionary(self):
         yaml_config = """
 graph:
@@ -38,5 +31,22 @@ graph:
   revision : 1.0
   date : 2016-01-10
                 """
-        dict = yaml.load(yaml_config)
-        print(dict)
\ No newline at end of file
+        dict = yaml.safe_load(yaml_config)
+        print(dict)
+
+    def test_changes(self):
+        graph = Graph('changes')
+        graph.add_process('first', 'module.Component')
+        graph.add_process('second', 'module.Component')
+        graph.add_connection('cnx', 'first', '_out', 'second', '_in', 1)
+        graph.add_connection(None, 'second', '_out', 'first', '_in', 1)
+        self.assertRaises(GraphException, graph.add_process, 'first', 'module.Component')
+        self.assertRaises(GraphException, graph.add_connection, 'cnx', 'second', '_out', 'first', '_in', 1)
+        copy = graph.copy()
+        key = ('second', '_out', 'first', '_in')
+        copy.replace_connection(key, copy.connections[key]._replace(target_process_name='second'))
+        copy.remove_connection('cnx')
+        copy.remove_process('first')
+        self.assertEqual([p.process_name for p in copy.processes_desc], ['second'])
+        self.assertEqual(list(copy.connections), [('second', '_out', 'second', '_in')])
+        self.assertEqual(len(graph.connections_desc), 2)
@@ -0,0 +1,150 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+import asyncio
+from hbflow.core.engine import EngineException
+from hbflow.core.component import Connection, InputPort, Component, IN
+from hbflow.core.metrics import LatencyHistogram, InstrumentedConnection, instrument_component
+from hbflow.core.packet import DataPacket
+from tests.components import LoopTestCase
+
+COMPONENT = 'hbflow.core.component.TestComponent'
+SPEC = {
+    'processes': {
+        'first': {'component': COMPONENT},
+        'second': {'component': COMPONENT},
+    },
+    'connections': [{'name': 'cnx', 'capacity': 10, 'source': {'process': 'first', 'port': '_out'},
+                     'target': {'process': 'second', 'port': '_in'}}]
+}
+
+
+class BatchSleeper(Component):
+    _in = IN()
+    batch_size = 10
+
+    async def on_batch(self, from_port, packets):
+        await asyncio.sleep(0.05)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for i in range(90):
+            histogram.add(0.000010)
+        for i in range(10):
+            histogram.add(0.001)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['p50'], 16 / 1000000)
+        self.assertEqual(snapshot['p99'], 0.001)
+        self.assertEqual(snapshot['max'], 0.001)
+
+    def test_merge(self):
+        histogram = LatencyHistogram()
+        histogram.add(0.000010)
+        other = LatencyHistogram()
+        other.add(0.001)
+        histogram.merge(other)
+        self.assertEqual(histogram.count, 2)
+        self.assertEqual(histogram.max, 0.001)
+        self.assertEqual(histogram.percentile(100), 0.001)
+
+
+class MetricsTest(LoopTestCase):
+    def test_disabled(self):
+        engine = self.init_engine(SPEC)
+        cnx = list(engine.connections.values())[0]
+        self.assertIs(type(cnx), Connection)
+        self.assertIsNone(engine.processes['second'].metrics)
+        self.assertNotIn('_dispatch', engine.processes['second'].__dict__)
+        self.assertRaises(EngineException, engine.metrics_snapshot)
+
+    def test_instrumented_connection(self):
+        async def test_coro():
+            cnx = InstrumentedConnection(capacity=2)
+            await cnx.put_packet(DataPacket(1))
+            cnx.put_batch_nowait([DataPacket(2), DataPacket(3)])
+            put = asyncio.ensure_future(cnx.put_packet(DataPacket(4)))
+            await asyncio.sleep(0.01)
+            cnx.get_batch_nowait(2)
+            await put
+            self.assertEqual(cnx.get_packet_nowait().payload, 4)
+            return cnx.snapshot()
+
+        snapshot = self.loop.run_until_complete(test_coro())
+        self.assertEqual(snapshot['packets_in'], 3)
+        self.assertEqual(snapshot['packets_out'], 3)
+        self.assertEqual(snapshot['depth'], 0)
+        self.assertEqual(snapshot['high_water'], 2)
+        self.assertGreater(snapshot['put_wait'], 0)
+
+    def test_get_wait(self):
+        async def test_coro():
+            cnx = InstrumentedConnection(capacity=2)
+            port = InputPort('in', None)
+            cnx.link(None, port)
+            read = asyncio.ensure_future(port.read_packet())
+            await asyncio.sleep(0.02)
+            await cnx.put_packet(DataPacket(1))
+            await read
+            # No wait when packets are available
+            get_wait = cnx.get_wait
+            await cnx.put_packet(DataPacket(2))
+            await port.read_batch(1)
+            self.assertEqual(cnx.get_wait, get_wait)
+            return cnx.snapshot()
+
+        snapshot = self.loop.run_until_complete(test_coro())
+        self.assertGreaterEqual(snapshot['get_wait'], 0.015)
+        self.assertEqual(snapshot['packets_out'], 2)
+
+    def test_batch_busy(self):
+        component = BatchSleeper(loop=self.loop)
+        metrics = instrument_component(component)
+
+        async def test_coro():
+            cnx = Connection(capacity=50)
+            cnx.link(None, component._in)
+            await cnx.put_batch([DataPacket(i) for i in range(50)])
+            while metrics.latency.count < 50:
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(asyncio.wait_for(test_coro(), 5))
+        component.close()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['latency']['count'], 50)
+        self.assertGreaterEqual(snapshot['busy'], 0.25)
+        self.assertGreater(snapshot['busy_ratio'], 0.5)
+        self.assertLess(snapshot['latency']['mean'], 0.05)
+
+    def test_engine_snapshot(self):
+        engine = self.init_engine(SPEC, metrics=True)
+        first = engine.processes['first']
+
+        async def test_coro():
+            for i in range(5):
+                await first._out.send_packet(DataPacket(i))
+            await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(test_coro())
+        snapshot = engine.metrics_snapshot()
+        self.assertEqual(snapshot['connections']['cnx']['packets_in'], 5)
+        self.assertEqual(snapshot['connections']['cnx']['packets_out'], 5)
+        self.assertEqual(snapshot['processes']['second']['latency']['count'], 5)
+        self.assertEqual(snapshot['processes']['first']['latency']['count'], 0)
+
+    def test_periodic_reports(self):
+        engine = self.init_engine(SPEC, metrics=True, metrics_interval=0.01)
+        first = engine.processes['first']
+
+        async def test_coro():
+            await first._out.send_packet(DataPacket(1))
+            await asyncio.sleep(0.05)
+
+        self.loop.run_until_complete(test_coro())
+        reports = engine._process_manager.metrics_reports
+        self.assertEqual(set(reports), {'first', 'second'})
+        self.assertEqual(reports['second']['latency']['count'], 1)
+        self.loop.run_until_complete(engine.stop())
@@ -0,0 +1,62 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import unittest
+from uuid import UUID
+from hbflow.core.packet import DataPacket, CommandPacket, PacketPool, DEFAULT_PRIORITY, COMMAND_PRIORITY
+
+
+class PacketTest(unittest.TestCase):
+    def test_sequence(self):
+        first = DataPacket()
+        second = CommandPacket('start')
+        self.assertGreater(second.seq, first.seq)
+
+    def test_lazy_id(self):
+        packet = DataPacket('payload')
+        self.assertIsNone(packet._uuid)
+        self.assertIsInstance(packet.id, UUID)
+        self.assertEqual(packet.id, packet.id)
+
+    def test_slots(self):
+        packet = DataPacket('payload')
+        self.assertFalse(hasattr(packet, '__dict__'))
+        with self.assertRaises(AttributeError):
+            packet.other = 1
+
+    def test_priority_and_deadline(self):
+        packet = DataPacket('payload', priority=5)
+        self.assertEqual((packet.priority, packet.deadline), (5, None))
+        self.assertFalse(packet.expired())
+        self.assertEqual(CommandPacket('stop').priority, COMMAND_PRIORITY)
+        packet.set_deadline(-1)
+        self.assertTrue(packet.expired())
+        copy = packet.copy()
+        self.assertEqual((copy.priority, copy.deadline), (5, packet.deadline))
+        packet.set_deadline(60)
+        self.assertFalse(packet.expired())
+
+
+class PacketPoolTest(unittest.TestCase):
+    def test_recycle(self):
+        pool = PacketPool(size=1)
+        packet = pool.acquire('a')
+        seq = packet.seq
+        pool.release(packet)
+        pool.release(DataPacket('b'))
+        self.assertEqual(len(pool), 1)
+        packet.priority = 3
+        packet.set_deadline(1)
+        recycled = pool.acquire('c')
+        self.assertIs(recycled, packet)
+        self.assertEqual((recycled.priority, recycled.deadline), (DEFAULT_PRIORITY, None))
+        self.assertEqual(recycled.payload, 'c')
+        self.assertGreater(recycled.seq, seq)
+
+    def test_recycle_payload(self):
+        pool = PacketPool(payload_factory=lambda: bytearray(16))
+        packet = pool.acquire()
+        buffer = packet.payload
+        self.assertEqual(len(buffer), 16)
+        pool.release(packet)
+        self.assertIs(pool.acquire().payload, buffer)
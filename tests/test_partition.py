@@ -0,0 +1,190 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import os
+import random
+import subprocess
+import sys
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.compiler import compile_graph, graph_from_dictionary
+from hbflow.core.engine import EngineException
+from hbflow.core.graph import GraphValidationException
+from hbflow.core.packet import DataPacket
+from tests.components import LoopTestCase
+
+PACKET_COUNT = 60
+# Prints the replica chosen by a hash partitioner for string and bytes keys
+HASH_SCRIPT = '''
+from types import SimpleNamespace
+from hbflow.core.packet import DataPacket
+from hbflow.core.partition import Partitioner, PARTITION_HASH
+partitioner = Partitioner(SimpleNamespace(name='_out', component=None), PARTITION_HASH, 'user')
+for index in range(5):
+    partitioner.add_connection(None)
+keys = ['user-%d' % i for i in range(20)] + [b'user-%d' % i for i in range(20)]
+print(' '.join(str(partitioner._select(DataPacket({'user': key}))) for key in keys))
+'''
+
+
+class Emitter(Component):
+    _out = OUT()
+
+    payloads = list(range(PACKET_COUNT))
+
+    def _handle_command_start(self, packet):
+        self._producer = asyncio.ensure_future(self._produce())
+
+    async def _produce(self):
+        for payload in self.payloads:
+            await self._out.send_packet(DataPacket(payload))
+
+
+class Worker(Component):
+    """
+    Tag payloads with the replica name, after a random delay when `jitter` is set
+    """
+    _in = IN()
+    _out = OUT()
+
+    jitter = False
+
+    async def on_packet(self, from_port, packet):
+        if self.jitter:
+            await asyncio.sleep(random.random() * 0.002)
+        await self._out.send_packet(DataPacket((self.name, packet.payload)))
+
+
+class JitterWorker(Worker):
+    jitter = True
+
+
+class Splitter(Component):
+    _in = IN(array_size=2)
+    _out = OUT(array_size=3)
+
+    async def on_packet(self, from_port, packet):
+        await self._out[packet.payload % 3].send_packet(packet)
+
+
+def replica_spec(worker='tests.test_partition.Worker', **options):
+    return {
+        'processes': {
+            'source': {'component': 'tests.test_partition.Emitter'},
+            'work': dict({'component': worker, 'replicas': 3}, **options),
+            'sink': {'component': 'tests.components.Collector'},
+        },
+        'connections': [
+            {'name': 'in', 'capacity': 4, 'source': {'process': 'source', 'port': '_out'},
+             'target': {'process': 'work', 'port': '_in'}},
+            {'name': 'out', 'capacity': 4, 'source': {'process': 'work', 'port': '_out'},
+             'target': {'process': 'sink', 'port': '_in'}},
+        ]
+    }
+
+
+class ArrayPortTest(LoopTestCase):
+    def test_array_ports(self):
+        splitter = Splitter('splitter')
+        self.assertEqual([port.name for port in splitter._out], ['_out[0]', '_out[1]', '_out[2]'])
+        self.assertIs(splitter.get_port('_in[1]'), splitter._in[1])
+        self.assertIsNone(splitter.get_port('_in[2]'))
+        self.assertIn('_out[2]', Splitter.port_index())
+        self.assertNotIn('_out', Splitter.port_index())
+        self.assertEqual(len([port for port in splitter._input_ports if port.name.startswith('_in')]), 2)
+
+    def test_connect_array_ports(self):
+        spec = {
+            'processes': {
+                'source': {'component': 'tests.test_partition.Emitter'},
+                'splitter': {'component': 'tests.test_partition.Splitter'},
+                'sink': {'component': 'tests.components.Collector'},
+            },
+            'connections': [
+                {'source': {'process': 'source', 'port': '_out'}, 'target': {'process': 'splitter', 'port': '_in[1]'}},
+                {'source': {'process': 'splitter', 'port': '_out[2]'}, 'target': {'process': 'sink', 'port': '_in'}},
+            ]
+        }
+        received = self.run_graph(self.init_engine(spec), PACKET_COUNT // 3)
+        self.assertEqual(received, list(range(2, PACKET_COUNT, 3)))
+
+        spec['connections'][1]['source']['port'] = '_out[3]'
+        with self.assertRaises(GraphValidationException):
+            compile_graph(graph_from_dictionary(spec))
+
+
+class ReplicaTest(LoopTestCase):
+    def run_replicas(self, spec, payloads=None):
+        engine = self.init_engine(spec)
+        if payloads is not None:
+            engine._get_process('source').payloads = payloads
+        received = self.run_graph(engine, len(payloads if payloads is not None else Emitter.payloads))
+        return engine, received
+
+    def replicas_of(self, received):
+        replicas = dict()
+        for name, payload in received:
+            replicas.setdefault(payload if not isinstance(payload, dict) else payload['user'], set()).add(name)
+        return replicas
+
+    def test_expansion(self):
+        plan = compile_graph(graph_from_dictionary(replica_spec()))
+        self.assertEqual(sorted(plan.processes), ['sink', 'source', 'work[0]', 'work[1]', 'work[2]'])
+        self.assertEqual([c.connection_name for c in plan.connections],
+                         ['in[0]', 'in[1]', 'in[2]', 'out[0]', 'out[1]', 'out[2]'])
+        self.assertEqual(plan.connections[1].partition.index, 1)
+        self.assertIsNone(plan.connections[3].partition)
+
+    def test_round_robin(self):
+        engine, received = self.run_replicas(replica_spec())
+        counts = dict()
+        for name, payload in received:
+            counts[name] = counts.get(name, 0) + 1
+        self.assertEqual(counts, {'work[0]': 20, 'work[1]': 20, 'work[2]': 20})
+        self.assertEqual(sorted(payload for name, payload in received), list(range(PACKET_COUNT)))
+
+    def test_hash(self):
+        payloads = [{'user': i % 7, 'value': i} for i in range(PACKET_COUNT)]
+        engine, received = self.run_replicas(replica_spec(partition='hash', partition_key='user'), payloads)
+        self.assertEqual(set(len(names) for names in self.replicas_of(received).values()), {1})
+
+    def test_hash_stable(self):
+        mappings = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            output = subprocess.check_output([sys.executable, '-c', HASH_SCRIPT], env=env,
+                                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            mappings.add(output)
+        self.assertEqual(len(mappings), 1)
+        self.assertGreater(len(set(mappings.pop().split())), 1)
+
+    def test_least_loaded(self):
+        engine, received = self.run_replicas(replica_spec(partition='least_loaded'))
+        self.assertEqual(sorted(payload for name, payload in received), list(range(PACKET_COUNT)))
+        self.assertEqual(len(set(name for name, payload in received)), 3)
+
+    def test_ordered_merge(self):
+        engine, received = self.run_replicas(replica_spec('tests.test_partition.JitterWorker', merge='ordered'))
+        self.assertEqual([payload for name, payload in received], list(range(PACKET_COUNT)))
+        self.assertEqual(len(set(name for name, payload in received)), 3)
+
+    def test_replicated_process_not_changeable(self):
+        engine = self.init_engine(replica_spec())
+        with self.assertRaises(EngineException):
+            self.loop.run_until_complete(engine.remove_process('work[0]'))
+        with self.assertRaises(EngineException):
+            self.loop.run_until_complete(engine.remove_connection('in[1]'))
+
+    def test_validation(self):
+        spec = replica_spec(partition='random', merge='sorted')
+        spec['processes']['other'] = {'component': 'tests.test_partition.Emitter'}
+        spec['connections'].append({'source': {'process': 'other', 'port': '_out'},
+                                    'target': {'process': 'work', 'port': '_in'}})
+        with self.assertRaises(GraphValidationException) as cm:
+            compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(len(cm.exception.errors), 2)
+
+        spec = replica_spec(merge='ordered', group=['a', 'b'])
+        with self.assertRaises(GraphValidationException) as cm:
+            compile_graph(graph_from_dictionary(spec))
+        self.assertEqual(len(cm.exception.errors), 1)
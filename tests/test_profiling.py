@@ -0,0 +1,121 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import os
+import pstats
+import tempfile
+import time
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.engine import GraphEngine, EngineException
+from hbflow.core.packet import DataPacket
+from hbflow.core.profiling import PROFILE_TIMING, PROFILE_SAMPLING, PROFILE_CPROFILE, STACKS_FILE, REPORT_FILE, \
+    CRITICAL_PATH_FILE, critical_path
+from tests.components import LoopTestCase, chain_spec
+
+COMPONENT = 'hbflow.core.component.TestComponent'
+
+
+class Spinner(Component):
+    _in = IN()
+    _out = OUT()
+
+    async def on_packet(self, from_port, packet):
+        # Spin on CPU time: wall clock time spent preempted must not count
+        deadline = time.thread_time() + packet.payload
+        while time.thread_time() < deadline:
+            pass
+        await self._out.send_packet(packet)
+
+
+class Sleeper(Component):
+    _in = IN()
+    _out = OUT()
+
+    async def on_packet(self, from_port, packet):
+        await asyncio.sleep(packet.payload)
+        await self._out.send_packet(packet)
+
+
+def profile_spec():
+    names = ['source', 'spin', 'sleep', 'sink']
+    return {
+        'processes': {'source': {'component': COMPONENT}, 'spin': {'component': 'tests.test_profiling.Spinner'},
+                      'sleep': {'component': 'tests.test_profiling.Sleeper'},
+                      'sink': {'component': 'tests.components.Collector'}},
+        'connections': [{'name': '%s-%s' % (source, target), 'capacity': 10,
+                         'source': {'process': source, 'port': '_out'}, 'target': {'process': target, 'port': '_in'}}
+                        for source, target in zip(names, names[1:])]
+    }
+
+
+class ProfilingTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        self.directory.cleanup()
+
+    def profile_graph(self, spec, packets, payload, **kwargs):
+        engine = self.init_engine(spec, **kwargs)
+
+        async def feed(engine):
+            source = engine._get_process('source')
+            for i in range(packets):
+                await source._out.send_packet(DataPacket(payload))
+
+        self.run_graph(engine, packets, feed, start=False)
+        return engine
+
+    def test_timing(self):
+        engine = self.profile_graph(profile_spec(), 4, 0.01, profile=PROFILE_TIMING)
+        report = engine.profile_report()
+        spin = report['processes']['spin']
+        sleep = report['processes']['sleep']
+        self.assertEqual(spin['packets'], 4)
+        self.assertGreaterEqual(spin['cpu'], 0.03)
+        self.assertGreaterEqual(sleep['wall'], 0.04)
+        self.assertLess(sleep['cpu'], sleep['wall'] / 2)
+        self.assertEqual(report['connections']['spin-sleep']['residence']['count'], 4)
+        path = report['critical_path']
+        self.assertEqual([edge['connection'] for edge in path['edges']], ['source-spin', 'spin-sleep', 'sleep-sink'])
+        self.assertAlmostEqual(sum(edge['share'] for edge in path['edges']), 1.0)
+        self.assertEqual(report['samples'], 0)
+        self.assertRaises(EngineException, GraphEngine(loop=self.loop).profile_report)
+
+    def test_fused_chain(self):
+        engine = self.profile_graph(chain_spec(), 3, 1, profile=PROFILE_TIMING)
+        report = engine.profile_report()
+        for name in ('inc_0', 'inc_1', 'inc_2', 'sink'):
+            self.assertEqual(report['processes'][name]['packets'], 3)
+        # Fused processes wall time includes the processes they deliver packets to
+        self.assertGreaterEqual(report['processes']['inc_0']['wall'], report['processes']['inc_1']['wall'])
+
+    def test_sampling(self):
+        engine = self.profile_graph(profile_spec(), 4, 0.05, profile=PROFILE_SAMPLING, profile_processes=['spin'])
+        self.assertGreater(engine.profile_report()['samples'], 0)
+        paths = engine.export_profile(self.directory.name)
+        self.assertEqual([os.path.basename(path) for path in paths], [REPORT_FILE, CRITICAL_PATH_FILE, STACKS_FILE])
+        with open(paths[2]) as stream:
+            stacks = stream.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(all(line.startswith('spin;test_profiling:on_packet') for line in stacks))
+
+    def test_cprofile(self):
+        engine = self.profile_graph(profile_spec(), 2, 0.01, profile=PROFILE_CPROFILE, profile_processes=['spin'])
+        paths = engine.export_profile(self.directory.name)
+        self.assertEqual(os.path.basename(paths[-1]), 'spin.prof')
+        functions = [function for (filename, line, function) in pstats.Stats(paths[-1]).stats]
+        self.assertIn('on_packet', functions)
+        self.assertRaises(EngineException, GraphEngine, loop=self.loop, profile='unknown')
+
+    def test_critical_path(self):
+        edges = [('a-b', 'a', 'b', 1.0), ('b-d', 'b', 'd', 1.0), ('a-c', 'a', 'c', 3.0), ('c-d', 'c', 'd', 0.5),
+                 ('d-b', 'd', 'b', 10.0)]
+        total, path = critical_path(edges[:4])
+        self.assertEqual(total, 3.5)
+        self.assertEqual([edge[0] for edge in path], ['a-c', 'c-d'])
+        # Edges closing a cycle are not followed
+        self.assertEqual(critical_path(edges), (total, path))
@@ -0,0 +1,169 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+from hbflow.core.component import Component, IN
+from hbflow.core.graph import GraphValidationException
+from hbflow.core.packet import DataPacket
+from hbflow.core.scheduler import Scheduler
+from tests.components import LoopTestCase, chain_spec
+
+COMPONENT = 'hbflow.core.component.TestComponent'
+RECORDER = 'tests.test_scheduler.Recorder'
+
+# (process name, payload) of the packets handled by Recorder processes, in order
+handled = []
+
+
+class Recorder(Component):
+    _in = IN()
+
+    def __init__(self, name=None):
+        super().__init__(name)
+        self.received = []
+
+    async def on_packet(self, from_port, packet):
+        self.received.append(packet.payload)
+        handled.append((self.name, packet.payload))
+
+
+class BatchRecorder(Recorder):
+    batch_size = 4
+
+    async def on_batch(self, from_port, packets):
+        for packet in packets:
+            await self.on_packet(from_port, packet)
+
+
+def priority_spec(urgent_priority):
+    return {
+        'processes': {'bulk': {'component': COMPONENT}, 'urgent': {'component': COMPONENT},
+                      'bulk_sink': {'component': RECORDER},
+                      'urgent_sink': {'component': RECORDER, 'priority': urgent_priority}},
+        'connections': [{'source': {'process': name, 'port': '_out'}, 'target': {'process': name + '_sink', 'port': '_in'},
+                         'capacity': 10} for name in ('bulk', 'urgent')]
+    }
+
+
+def deadline_spec(sink_component=RECORDER):
+    return {
+        'processes': {'source': {'component': COMPONENT}, 'sink': {'component': sink_component},
+                      'late': {'component': RECORDER}},
+        'connections': [{'source': {'process': 'source', 'port': '_out'}, 'target': {'process': 'sink', 'port': '_in'},
+                         'capacity': 10},
+                        {'source': {'process': 'sink', 'port': '_expired_out'},
+                         'target': {'process': 'late', 'port': '_in'}, 'capacity': 10}]
+    }
+
+
+class SchedulerTest(LoopTestCase):
+    def setUp(self):
+        super().setUp()
+        del handled[:]
+
+    def run_priority(self, urgent_priority):
+        engine = self.init_engine(priority_spec(urgent_priority))
+
+        async def test_coro():
+            await engine._get_process('bulk')._out.send_batch([DataPacket(i) for i in range(5)])
+            await engine._get_process('urgent')._out.send_batch([DataPacket(i) for i in range(2)])
+            while len(handled) < 7:
+                await asyncio.sleep(0.001)
+            await engine.stop()
+
+        self.loop.run_until_complete(test_coro())
+        return engine
+
+    def test_priority(self):
+        engine = self.run_priority(5)
+        self.assertIsNotNone(engine.scheduler)
+        self.assertEqual(engine._get_process('urgent_sink').priority, 5)
+        self.assertEqual(handled[:2], [('urgent_sink', 0), ('urgent_sink', 1)])
+        self.assertEqual(engine._get_process('bulk_sink').received, list(range(5)))
+        self.assertGreater(engine.scheduler.held, 0)
+
+    def test_no_priority(self):
+        engine = self.run_priority(None)
+        self.assertIsNone(engine.scheduler)
+        self.assertEqual(handled[0], ('bulk_sink', 0))
+
+    def test_admit(self):
+        async def test_coro():
+            scheduler = Scheduler(0.02)
+            bulk = Recorder()
+            urgent = Recorder()
+            urgent.priority = 5
+            scheduler.attach(bulk)
+            scheduler.attach(urgent)
+            self.assertEqual(scheduler.highest, 5)
+            self.assertFalse(scheduler.preempts(0))
+            scheduler.port_ready(5)
+            self.assertTrue(scheduler.preempts(0))
+            self.assertFalse(scheduler.preempts(5))
+            # Held back time_slice at most
+            start = self.loop.time()
+            await scheduler.admit(0)
+            self.assertGreaterEqual(self.loop.time() - start, 0.015)
+            # Admitted once higher priority ports are drained
+            admit = asyncio.ensure_future(scheduler.admit(0))
+            await asyncio.sleep(0)
+            self.assertFalse(admit.done())
+            scheduler.port_drained(5)
+            await asyncio.sleep(0)
+            self.assertTrue(admit.done())
+            self.assertEqual((scheduler.top, scheduler.held), (None, 2))
+            scheduler.detach(urgent)
+            self.assertEqual(scheduler.highest, 0)
+        self.loop.run_until_complete(test_coro())
+
+    def run_deadline(self, spec, fusion=True):
+        engine = self.init_engine(spec, fusion=fusion)
+
+        async def test_coro():
+            expired = DataPacket(1)
+            expired.set_deadline(-1)
+            pending = DataPacket(3)
+            pending.set_deadline(60)
+            await engine._get_process('source')._out.send_batch([expired, DataPacket(2), pending])
+            await asyncio.sleep(0.01)
+            await engine.stop()
+
+        self.loop.run_until_complete(test_coro())
+        return engine
+
+    def test_deadline(self):
+        engine = self.run_deadline(deadline_spec())
+        sink = engine._get_process('sink')
+        self.assertEqual(sink.received, [2, 3])
+        self.assertEqual(sink.expired, 1)
+        self.assertEqual(engine._get_process('late').received, [1])
+
+    def test_deadline_batch(self):
+        engine = self.run_deadline(deadline_spec('tests.test_scheduler.BatchRecorder'))
+        self.assertEqual(engine._get_process('sink').received, [2, 3])
+        self.assertEqual(engine._get_process('late').received, [1])
+
+    def test_deadline_fused(self):
+        engine = self.run_deadline(chain_spec())
+        # Expired packets are dropped when the expired port isn't connected
+        self.assertEqual(engine._get_process('inc_0').expired, 1)
+        self.assertEqual(engine._get_process('sink').received, [5, 6])
+
+    def test_invalid_priority(self):
+        spec = priority_spec('high')
+        with self.assertRaises(GraphValidationException) as cm:
+            self.init_engine(spec)
+        self.assertIn("Process 'urgent_sink': invalid priority 'high'", cm.exception.errors)
+
+    def test_add_process(self):
+        engine = self.init_engine(priority_spec(None))
+
+        async def test_coro():
+            await engine.add_process('control', RECORDER, priority=3)
+            self.assertIs(engine._get_process('bulk_sink')._scheduler, engine.scheduler)
+            self.assertEqual(engine.scheduler.highest, 3)
+            await engine.remove_process('control')
+            self.assertEqual(engine.scheduler.highest, 0)
+            await engine.stop()
+
+        self.loop.run_until_complete(test_coro())
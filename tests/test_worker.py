@@ -0,0 +1,114 @@
+# Copyright (c) 2016 Nicolas JOUANIN
+#
+# See the file license.txt for copying permission.
+import asyncio
+import logging
+import os
+from hbflow.core.component import Component, IN, OUT
+from hbflow.core.graph import GraphException
+from hbflow.core.packet import DataPacket
+from tests.components import LoopTestCase
+
+formatter = "[%(asctime)s] %(name)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s"
+logging.basicConfig(level=logging.DEBUG, format=formatter)
+log = logging.getLogger(__name__)
+
+PACKET_COUNT = 100
+
+
+class CountSource(Component):
+    _out = OUT()
+
+    def _handle_command_start(self, packet):
+        asyncio.ensure_future(self._produce())
+
+    async def _produce(self):
+        for i in range(PACKET_COUNT):
+            await self._out.send_packet(DataPacket((os.getpid(), i)))
+
+
+class BytesSource(Component):
+    _out = OUT()
+
+    def _handle_command_start(self, packet):
+        asyncio.ensure_future(self._produce())
+
+    async def _produce(self):
+        for i in range(PACKET_COUNT):
+            await self._out.send_packet(DataPacket(bytes([i]) * 1000))
+
+
+class Relay(Component):
+    _in = IN()
+    _out = OUT()
+
+    async def on_packet(self, from_port, packet):
+        await self._out.send_packet(DataPacket((os.getpid(),) + packet.payload))
+
+
+def group_spec(source_group, relay_group):
+    return {
+        'processes': {
+            'source': {'component': 'tests.test_worker.CountSource', 'group': source_group},
+            'relay': {'component': 'tests.test_worker.Relay', 'group': relay_group},
+            'sink': {'component': 'tests.components.Collector'},
+        },
+        'connections': [
+            {'source': {'process': 'source', 'port': '_out'}, 'target': {'process': 'relay', 'port': '_in'}, 'capacity': 10},
+            {'source': {'process': 'relay', 'port': '_out'}, 'target': {'process': 'sink', 'port': '_in'}, 'capacity': 10},
+        ]
+    }
+
+
+class GroupWorkerTest(LoopTestCase):
+    def run_groups(self, spec):
+        engine = self.init_engine(spec)
+        groups = sorted(engine.workers)
+
+        async def start(engine):
+            # Worker processes acknowledge the command once applied
+            self.assertEqual(await engine.start(timeout=5), set())
+
+        return groups, self.run_graph(engine, PACKET_COUNT, start, start=False, timeout=10)
+
+    def test_groups(self):
+        groups, received = self.run_groups(group_spec('producers', 'relays'))
+        self.assertEqual(groups, ['producers', 'relays'])
+        self.assertEqual([payload[-1] for payload in received], list(range(PACKET_COUNT)))
+        relay_pid, source_pid = received[0][:2]
+        self.assertEqual(len(set([os.getpid(), relay_pid, source_pid])), 3)
+
+    def test_same_group(self):
+        groups, received = self.run_groups(group_spec('workers', 'workers'))
+        self.assertEqual(groups, ['workers'])
+        relay_pid, source_pid = received[0][:2]
+        self.assertEqual(relay_pid, source_pid)
+        self.assertNotEqual(relay_pid, os.getpid())
+
+    def test_group_bind_error(self):
+        spec = group_spec('producers', None)
+        spec['processes']['source']['component'] = 'tests.test_worker.Unknown'
+        with self.assertRaises(GraphException):
+            self.init_engine(spec)
+
+    def test_shared_memory_transport(self):
+        spec = {
+            'processes': {
+                'source': {'component': 'tests.test_worker.BytesSource', 'group': 'producers'},
+                'sink': {'component': 'tests.components.Collector'},
+            },
+            'connections': [
+                {'source': {'process': 'source', 'port': '_out'}, 'target': {'process': 'sink', 'port': '_in'},
+                 'capacity': 4, 'transport': 'shm', 'slot_size': 4096},
+            ]
+        }
+        groups, received = self.run_groups(spec)
+        self.assertEqual(received, [bytes([i]) * 1000 for i in range(PACKET_COUNT)])
+
+    def test_replicas_in_groups(self):
+        spec = group_spec(None, ['relays_0', 'relays_1'])
+        spec['processes']['relay']['replicas'] = 2
+        groups, received = self.run_groups(spec)
+        self.assertEqual(groups, ['relays_0', 'relays_1'])
+        self.assertEqual(sorted(payload[-1] for payload in received), list(range(PACKET_COUNT)))
+        self.assertEqual(len(set(payload[0] for payload in received)), 2)